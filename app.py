@@ -1,20 +1,60 @@
+import hashlib
+import hmac
 import os
+import threading
+import time
 from dotenv import load_dotenv
 
-from flask import Flask, render_template, request, flash, redirect, session, g
+from flask import (
+    Flask, render_template, request, flash, redirect, session, g, Response,
+    get_flashed_messages, jsonify, send_file, stream_template)
 from flask_debugtoolbar import DebugToolbarExtension
 from sqlalchemy.exc import IntegrityError
-from werkzeug.exceptions import Unauthorized
+from werkzeug.exceptions import BadGateway, NotFound, Unauthorized
 
 from flask_bcrypt import Bcrypt
 
-from forms import UserAddForm, LoginForm, MessageForm, CSRFProtectForm, EditProfileForm
-from models import db, connect_db, User, Message, Like
+from assets import asset_url, cli as assets_cli, send_asset
+from compression import Compressor, MinifyWhitespace
+from bulkimport import cli as imports_cli
+from caching import apply_cache_policy, cache_policy
+from exports import (
+    Exporter, cli as exports_cli, export_status, user_exports)
+from feed import (
+    add_follows, cli as feed_cli, fan_out, remove_follows, remove_messages)
+from forms import (
+    UserAddForm, LoginForm, MessageForm, CSRFProtectForm, EditProfileForm,
+    ExportForm)
+from imageproxy import (
+    CACHE_MAX_AGE, SIZES, ImageCache, ImageFetchError, sign, thumbnail_url)
+from likebuffer import (
+    LIKE_BUFFER_DIR, PENDING_KEY, LikeBuffer, merge_pending, pending_changes,
+    remember_pending)
+from metrics import init_app as init_metrics, record_lookup
+from models import db, connect_db, User, Message, Like, Follow, Export
+from partitions import cli as partitions_cli
+from profiler import Profiler, cli as profiler_cli
+from pubsub import Hub, backend_from_url, format_event, message_event
+from readmodels import (
+    feed_items, feed_query, followers_of, following_of, liked_by,
+    profile_counts, streamed, user_card_query, user_cards)
+from search import MessageSearch
+from shards import (
+    SHARD_URLS, ShardSet, cli as shards_cli, parse_shard_urls,
+    update_after_commit)
+from timeline import forget_timeline, home_timeline
+from sessions import (
+    ServerSessionInterface, cli as sessions_cli, store_from_name)
+from trending import TrendingIndex
+from viewer import (
+    bump_versions, forget_state, forget_user, get_current_user,
+    get_viewer_state, record_change, remember_user)
 
 load_dotenv()
 bcrypt = Bcrypt()
 
 CURR_USER_KEY = "curr_user"
+PASSWORD_CHECK_KEY = "password_check"
 
 app = Flask(__name__)
 
@@ -24,7 +64,87 @@ app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
 app.config['SECRET_KEY'] = os.environ['SECRET_KEY']
 toolbar = DebugToolbarExtension(app)
 
+# Sessions are kept server-side, the cookie holding only their id (see
+# sessions.py); buffered likes kept in them are merged, not overwritten
+app.session_interface = ServerSessionInterface(
+    store_from_name(os.environ.get('SESSION_STORE', 'database')),
+    user_key=CURR_USER_KEY,
+    mergers={PENDING_KEY: merge_pending} if LIKE_BUFFER_DIR else None)
+
+# First, so that the other request hooks are timed and profiled too (see
+# metrics.py and profiler.py)
+init_metrics(app)
+profiler = Profiler()
+profiler.init_app(app)
+
+# gzip/brotli responses, and optionally smaller templates (see compression.py)
+app.wsgi_app = Compressor(app.wsgi_app)
+if os.environ.get('MINIFY_HTML') == '1':
+    app.jinja_env.add_extension(MinifyWhitespace)
+
 connect_db(app)
+app.cli.add_command(partitions_cli)
+app.cli.add_command(assets_cli)
+app.cli.add_command(profiler_cli)
+app.cli.add_command(sessions_cli)
+app.cli.add_command(feed_cli)
+app.cli.add_command(exports_cli)
+app.cli.add_command(imports_cli)
+app.cli.add_command(shards_cli)
+app.add_template_global(asset_url)
+
+# Trending index, fed by like/unlike events and shared by every worker
+trending = TrendingIndex()
+
+message_search = MessageSearch()
+
+# New messages are pushed to open timeline streams in every worker
+hub = Hub(backend_from_url(os.environ.get('PUBSUB_URL')))
+
+# Seconds between keep-alive comments on idle timeline streams
+STREAM_KEEPALIVE = 15
+
+# Timeline streams this process serves at once under WSGI. Each holds a
+# worker thread, so they're off unless the server has threads to spare
+# (see gunicorn.conf.py); asgi.py serves them natively, without a limit.
+MAX_WSGI_STREAMS = int(os.environ.get('MAX_WSGI_STREAMS', 0))
+stream_slots = threading.BoundedSemaphore(MAX_WSGI_STREAMS)
+
+# Whether homepages open a timeline stream
+app.config['MESSAGE_STREAMS'] = MAX_WSGI_STREAMS > 0
+
+# Resized, cached copies of users' images (see imageproxy.py)
+image_cache = ImageCache()
+
+# Best-effort copies of users' messages, by user, for home timelines, if
+# SHARD_URLS is set (see shards.py)
+shard_set = None
+if SHARD_URLS:
+    shard_set = ShardSet(parse_shard_urls(SHARD_URLS))
+    shard_set.init_app(app)
+    shard_set.start_reconciler(app)
+
+# Likes written in batches, if LIKE_BUFFER_DIR is set (see likebuffer.py)
+like_buffer = None
+if LIKE_BUFFER_DIR:
+    like_buffer = LikeBuffer()
+    like_buffer.init_app(app)
+
+# Users' data exports, built in background threads (see exports.py)
+exporter = Exporter()
+exporter.init_app(app)
+
+# Characters of a streamed page sent at a time
+STREAM_CHUNK_SIZE = 16 * 1024
+
+# Seconds a confirmed password is remembered for profile edits
+PASSWORD_CHECK_SECONDS = int(os.environ.get('PASSWORD_CHECK_SECONDS', 15 * 60))
+
+# Form errors for User's unique fields
+UNIQUE_FIELD_ERRORS = {
+    'username': "Username already exists!",
+    'email': "Email is already associated with a user!",
+}
 
 
 ##############################################################################
@@ -33,25 +153,72 @@ connect_db(app)
 
 @app.before_request
 def add_user_to_g():
-    """If logged in, add curr user to Flask global."""
+    """If logged in, add curr user to Flask global.
+
+    Their display fields come from the session (see viewer.py)."""
 
     if CURR_USER_KEY in session:
-        g.user = User.query.get(session[CURR_USER_KEY])
+        g.user = get_current_user(session[CURR_USER_KEY],
+                                  session.user_version)
 
     else:
         g.user = None
 
+    g.viewer = (get_viewer_state(g.user, overlay=like_overlay(g.user.id))
+                if g.user else None)
+
+
+def like_overlay(user_id):
+    """User `user_id`'s likes not yet written by the like buffer, if any.
+
+    The logged-in user's own are kept in their session too, for requests
+    served by another process than the one buffering them."""
+
+    if not like_buffer:
+        return None
+
+    own = session.get(CURR_USER_KEY) == user_id
+    return like_buffer.overlay(user_id,
+                               pending_changes(session) if own else None)
+
 
 @app.before_request
-def do_csrf():
-    """Implement CSRF."""
-    g.csrf_form = CSRFProtectForm()
+def reset_csrf():
+    """Forget the CSRF form and token of the last request in this context.
+
+    They're made when first needed (see `csrf_form`), so requests that
+    render or check no forms don't pay for them."""
+
+    for name in ('csrf_form', 'csrf_field',
+                 app.config.get('WTF_CSRF_FIELD_NAME', 'csrf_token')):
+        g.pop(name, None)
+
+
+def csrf_form():
+    """The request's CSRFProtectForm, made on first use."""
+
+    if 'csrf_form' not in g:
+        g.csrf_form = CSRFProtectForm()
+
+    return g.csrf_form
+
+
+@app.template_global()
+def csrf_field():
+    """Hidden CSRF token input, rendered once per response."""
+
+    if 'csrf_field' not in g:
+        g.csrf_field = csrf_form().hidden_tag()
+
+    return g.csrf_field
 
 
 def do_login(user):
     """Log in user."""
 
+    session.rotate()
     session[CURR_USER_KEY] = user.id
+    remember_user(user)
 
 
 def do_logout():
@@ -60,6 +227,57 @@ def do_logout():
     if CURR_USER_KEY in session:
         del session[CURR_USER_KEY]
 
+    session.pop(PASSWORD_CHECK_KEY, None)
+    forget_state()
+    forget_user()
+    forget_timeline()
+
+
+def password_digest(user, password):
+    """Keyed digest of `password`, tied to `user`'s current password hash."""
+
+    return hmac.new(
+        app.config['SECRET_KEY'].encode(),
+        f"{user.id}:{user.password}:{password}".encode(),
+        hashlib.sha256,
+    ).hexdigest()
+
+
+def check_password(user, password):
+    """Check `password` is `user`'s, remembering a match in the session.
+
+    For PASSWORD_CHECK_SECONDS after a match, the same password is checked
+    against a keyed digest kept in the session rather than with bcrypt."""
+
+    digest = password_digest(user, password)
+    remembered = session.get(PASSWORD_CHECK_KEY)
+
+    if (remembered
+            and remembered['expires'] > time.time()
+            and hmac.compare_digest(remembered['digest'], digest)):
+        record_lookup('password_check', hit=True)
+        return True
+
+    record_lookup('password_check', hit=False)
+    if not user.check_password(password):
+        return False
+
+    session[PASSWORD_CHECK_KEY] = {
+        'digest': digest,
+        'expires': int(time.time()) + PASSWORD_CHECK_SECONDS,
+    }
+    return True
+
+
+def unique_violations(error):
+    """Return the User fields whose unique constraint `error` violated."""
+
+    # Postgres names the constraint (users_username_key), SQLite the column
+    # (users.username).
+    message = str(error.orig)
+    return [field for field in UNIQUE_FIELD_ERRORS
+            if f"users_{field}_key" in message or f"users.{field}" in message]
+
 
 @app.route('/signup', methods=["GET", "POST"])
 def signup():
@@ -125,7 +343,7 @@ def login():
 def logout():
     """Handle logout of user and redirect to homepage."""
 
-    form = g.csrf_form
+    form = csrf_form()
 
     if not g.user or not form.validate_on_submit():
         flash("Access unauthorized.", "danger")
@@ -140,6 +358,80 @@ def logout():
     #TODO: what going on here
 
 
+@app.post('/logout/everywhere')
+def logout_everywhere():
+    """Log user out of every session they have, and redirect to login."""
+
+    form = csrf_form()
+
+    if not g.user or not form.validate_on_submit():
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    app.session_interface.store.delete_user(g.user.id)
+    do_logout()
+    flash("Logged out everywhere.")
+    return redirect("/login")
+
+
+##############################################################################
+# Streamed pages
+#
+# Pages listing every user, or every message a user liked, are rendered as
+# they're sent, from rows read in batches (see readmodels.streamed), so
+# neither the page nor its rows are ever all in memory.
+
+
+def prepare_streamed():
+    """Ready the session to be saved before a streamed page is rendered."""
+
+    # Take the page's flashes, and store its CSRF token, now (both are kept
+    # for the template)
+    get_flashed_messages(with_categories=True)
+    if g.user:
+        csrf_field()
+
+
+def render_streamed(template, **context):
+    """Response rendering `template` as it's sent, in chunks."""
+
+    prepare_streamed()
+
+    # Keeps the request context while it's iterated
+    texts = stream_template(template, **context)
+
+    def chunks():
+        buffered = []
+        size = 0
+
+        for text in texts:
+            buffered.append(text)
+            size += len(text)
+            if size >= STREAM_CHUNK_SIZE:
+                yield ''.join(buffered)
+                buffered = []
+                size = 0
+
+        yield ''.join(buffered)
+
+    return Response(chunks())
+
+
+def stream_feed_items(query):
+    """Yield `query`'s FeedItems, looking up the viewer's likes per batch."""
+
+    for batch in streamed(query, feed_items):
+        g.viewer.prefetch(batch, keep=False)
+        yield from batch
+
+
+def stream_user_cards(query):
+    """Yield `query`'s UserCards."""
+
+    for batch in streamed(query, user_cards):
+        yield from batch
+
+
 ##############################################################################
 # General user routes:
 
@@ -155,13 +447,12 @@ def list_users():
 
     search = request.args.get('q')
 
-    if not search:
-        users = User.query.all()
-    else:
-        users = User.query.filter(User.username.like(f"%{search}%")).all()
+    query = user_card_query()
+    if search:
+        query = query.filter(User.username.like(f"%{search}%"))
 
-    return render_template('users/index.html',
-                           users=users)
+    return render_streamed('users/index.html',
+                           users=stream_user_cards(query))
 
 
 @app.get('/users/<int:user_id>')
@@ -173,9 +464,16 @@ def show_user(user_id):
         return redirect("/")
 
     user = User.query.get_or_404(user_id)
+    messages = feed_items(feed_query()
+                          .filter(Message.user_id == user_id)
+                          .order_by(Message.timestamp.desc()))
+    g.viewer.prefetch(messages)
 
     return render_template('users/show.html',
-                           user=user)
+                           user=user,
+                           counts=profile_counts(
+                               user_id, like_overlay(user_id)),
+                           messages=messages)
 
 
 @app.get('/users/<int:user_id>/following')
@@ -188,7 +486,11 @@ def show_following(user_id):
 
     user = User.query.get_or_404(user_id)
     return render_template('users/following.html',
-                           user=user)
+                           user=user,
+                           counts=profile_counts(
+                               user_id, like_overlay(user_id)),
+                           users=user_cards(
+                               following_of(user_card_query(), user_id)))
 
 
 @app.get('/users/<int:user_id>/followers')
@@ -201,7 +503,11 @@ def show_followers(user_id):
 
     user = User.query.get_or_404(user_id)
     return render_template('users/followers.html',
-                           user=user)
+                           user=user,
+                           counts=profile_counts(
+                               user_id, like_overlay(user_id)),
+                           users=user_cards(
+                               followers_of(user_card_query(), user_id)))
 
 
 @app.get('/users/<int:user_id>/likes')
@@ -212,27 +518,49 @@ def show_likes(user_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    # TODO: don't really need to pass in liked_messages explicitly?
     user = User.query.get_or_404(user_id)
-    return render_template('/likes/show.html',
+    liked_messages = stream_feed_items(
+        liked_by(feed_query(), user_id, like_overlay(user_id))
+        .order_by(Message.timestamp.desc()))
+    return render_streamed('/likes/show.html',
                            user=user,
-                           liked_messages=user.liked_messages)
+                           counts=profile_counts(
+                               user_id, like_overlay(user_id)),
+                           liked_messages=liked_messages)
 
 
 @app.post('/messages/<int:message_id>/like')
 def like_message(message_id):
     """Like a message from another user."""
 
-    form = g.csrf_form
+    form = csrf_form()
 
     if not g.user or not form.validate_on_submit():
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    liked_message = Message.query.get_or_404(message_id)
-    g.user.liked_messages.append(liked_message)
+    if like_buffer:
+        if not g.viewer.has_liked_id(message_id):
+            Message.query.get_or_404(message_id)
+            like_buffer.like(g.user.id, message_id)
+            remember_pending(session, message_id, True)
+            g.viewer.apply(liked=[message_id])
+            g.viewer.save()
+            trending.like(message_id)
+
+        return redirect(f"/users/{g.user.id}/likes")
+
+    liked = Like.add(g.user.id, message_id)
+    if liked:
+        record_change(g.viewer, liked=[message_id])
     db.session.commit()
 
+    if liked:
+        trending.like(message_id)
+    else:
+        # Already liked, or there's no such message
+        Message.query.get_or_404(message_id)
+
     return redirect(f"/users/{g.user.id}/likes")
 
 
@@ -240,16 +568,30 @@ def like_message(message_id):
 def unlike_message(message_id):
     """Unlike a message"""
 
-    form = g.csrf_form
+    form = csrf_form()
 
     if not g.user or not form.validate_on_submit():
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    liked_message = Message.query.get_or_404(message_id)
-    g.user.liked_messages.remove(liked_message)
+    if like_buffer:
+        if g.viewer.has_liked_id(message_id):
+            like_buffer.unlike(g.user.id, message_id)
+            remember_pending(session, message_id, False)
+            g.viewer.apply(unliked=[message_id])
+            g.viewer.save()
+            trending.unlike(message_id)
+
+        return redirect(f"/users/{g.user.id}/likes")
+
+    unliked = Like.remove(g.user.id, message_id)
+    if unliked:
+        record_change(g.viewer, unliked=[message_id])
     db.session.commit()
 
+    if unliked:
+        trending.unlike(message_id)
+
     return redirect(f"/users/{g.user.id}/likes")
 
 
@@ -259,14 +601,19 @@ def start_following(follow_id):
 
     Redirect to following page for the current user."""
 
-    form = g.csrf_form
+    form = csrf_form()
 
     if not g.user or not form.validate_on_submit():
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    followed_user = User.query.get_or_404(follow_id)
-    g.user.following.append(followed_user)
+    if Follow.add(g.user.id, follow_id):
+        record_change(g.viewer, followed=[follow_id])
+        add_follows(g.user.id, [follow_id])
+    else:
+        # Already following, or there's no such user
+        User.query.get_or_404(follow_id)
+
     db.session.commit()
 
     return redirect(f"/users/{g.user.id}/following")
@@ -278,14 +625,15 @@ def stop_following(follow_id):
 
     Redirect to current user's following page."""
 
-    form = g.csrf_form
+    form = csrf_form()
 
     if not g.user or not form.validate_on_submit():
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    followed_user = User.query.get_or_404(follow_id)
-    g.user.following.remove(followed_user)
+    if Follow.remove(g.user.id, follow_id):
+        record_change(g.viewer, unfollowed=[follow_id])
+        remove_follows(g.user.id, [follow_id])
     db.session.commit()
 
     return redirect(f"/users/{g.user.id}/following")
@@ -298,44 +646,111 @@ def profile():
     if not g.user:
         raise Unauthorized()
 
-    form = EditProfileForm(obj=g.user)
+    user = g.user.load()
+
+    form = EditProfileForm(obj=user)
 
     if form.validate_on_submit():
-        if User.authenticate(g.user.username, form.password.data):
+        if not check_password(user, form.password.data):
+            form.password.errors = ["Incorrect password."]
+
+        else:
             username = form.username.data
             email = form.email.data
-            image_url = form.image_url.data
-            header_image_url = form.header_image_url.data
-            bio = form.bio.data
-            location = form.location.data
 
-            is_valid = True
+            taken = User.taken(username, email, exclude_id=user.id)
+            for field in taken:
+                getattr(form, field).errors = [UNIQUE_FIELD_ERRORS[field]]
+
+            if not taken:
+                user.username = username or user.username
+                user.email = email or user.email
+                user.image_url = form.image_url.data or user.image_url
+                user.header_image_url = (form.header_image_url.data
+                                         or user.header_image_url)
+                user.bio = form.bio.data or user.bio
+                user.location = form.location.data or user.location
+
+                try:
+                    # Other sessions of theirs refresh their snapshot
+                    record_change(g.viewer)
+                    db.session.commit()
+
+                # Taken by someone else since the check above
+                except IntegrityError as e:
+                    db.session.rollback()
+                    fields = unique_violations(e)
+                    if not fields:
+                        raise
+
+                    for field in fields:
+                        getattr(form, field).errors = [
+                            UNIQUE_FIELD_ERRORS[field]]
+
+                else:
+                    remember_user(user)
+                    return redirect(f'/users/{user.id}')
 
-            if User.query.filter(User.username == username).first() and username != g.user.username:
-                form.username.errors = ["Username already exists!"]
-                is_valid = False
+    return render_template('/users/edit.html',
+                           form=form,
+                           user=user)
 
-            if User.query.filter(User.email == email).first() and email != g.user.email:
-                form.email.errors = [
-                    "Email is already associated with a user!"]
-                is_valid = False
 
-            if is_valid:
-                g.user.username = username or g.user.username
-                g.user.email = email or g.user.email
-                g.user.image_url = image_url or g.user.image_url
-                g.user.header_image_url = header_image_url or g.user.header_image_url
-                g.user.bio = bio or g.user.bio
-                g.user.location = location or g.user.location
 
-                db.session.commit()
+@app.route('/users/exports', methods=["GET", "POST"])
+def list_exports():
+    """Show current user's data exports, and start a new one."""
 
-                return redirect(f'/users/{g.user.id}')
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
 
-    return render_template('/users/edit.html',
+    form = ExportForm()
+    exports = user_exports(g.user.id)
+
+    if form.validate_on_submit():
+        if any(export_status(export) in ('pending', 'running')
+               for export in exports):
+            flash("An export is already being prepared.", "warning")
+
+        else:
+            # Written now, so the export includes buffered likes
+            if like_buffer:
+                like_buffer.flush()
+
+            exporter.start(g.user.id, form.format.data)
+            flash("Preparing your export.", "success")
+
+        return redirect("/users/exports")
+
+    return render_template('users/exports.html',
                            form=form,
-                           user=g.user)
+                           exports=exports,
+                           status=export_status)
+
+
+@app.get('/users/exports/<int:export_id>')
+def download_export(export_id):
+    """Download one of current user's data exports.
 
+    Range requests are answered, so downloads can be resumed."""
+
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    export = db.session.get(Export, export_id)
+    if (not export or export.user_id != g.user.id
+            or export.status != 'done'):
+        raise NotFound()
+
+    created = export.created.strftime('%Y-%m-%d')
+    response = send_file(
+        exporter.path(export), mimetype='application/zip',
+        as_attachment=True, conditional=True,
+        download_name=f"warbler-{g.user.username}-{created}.zip")
+    response.cache_control.private = True
+    return response
 
 
 @app.post('/users/delete')
@@ -343,24 +758,148 @@ def delete_user():
     """Delete user.
 
     Redirect to signup page."""
-    form = g.csrf_form
+    form = csrf_form()
 
     if not g.user or not form.validate_on_submit():
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
+    user = g.user.load()
     do_logout()
 
-    for message in g.user.messages:
+    # Their followers' and followees' counts change
+    bump_versions([other.id for other in user.followers + user.following])
+    message_ids = [message.id for message in user.messages]
+    remove_messages(message_ids)
+
+    for message in user.messages:
         db.session.delete(message)
         db.session.commit()
+        trending.forget(message.id)
+        message_search.remove(message)
 
-    db.session.delete(g.user)
+    exporter.remove(Export.query.filter_by(user_id=user.id))
+    db.session.delete(user)
     db.session.commit()
+    if shard_set:
+        update_after_commit(shard_set.remove_messages, message_ids)
+    app.session_interface.store.delete_user(user.id)
 
     return redirect("/signup")
 
 
+##############################################################################
+# Batch likes and follows, for API clients
+#
+# These take a JSON body {"ids": [...]} of up to MAX_BATCH_SIZE ids and
+# return {"results": [{"id": ..., "status": ...}, ...]}, one result per id
+# in request order, where status is the action taken ("liked", "followed",
+# ...), "unchanged" or "not_found". Only JSON bodies are accepted, which
+# browsers won't send cross-site without a CORS preflight, so no CSRF token
+# is needed.
+
+MAX_BATCH_SIZE = 500
+
+
+def get_batch_ids():
+    """Return the de-duplicated ids in the request, or None if invalid."""
+
+    data = request.get_json(silent=True)
+    ids = data.get('ids') if isinstance(data, dict) else None
+
+    if (not isinstance(ids, list)
+            or not 0 < len(ids) <= MAX_BATCH_SIZE
+            or not all(type(id) is int for id in ids)):
+        return None
+
+    return list(dict.fromkeys(ids))
+
+
+def run_batch(model, action, status, on_change=None):
+    """Apply `action` to the requested ids of `model` that exist.
+
+    `action(user_id, ids)` returns the ids it changed; `on_change(id)` is
+    called for each of those after committing."""
+
+    if not g.user:
+        return jsonify(error="Access unauthorized."), 401
+
+    ids = get_batch_ids()
+    if ids is None:
+        return jsonify(error=f"Expected a JSON object with 1 to "
+                             f"{MAX_BATCH_SIZE} integer ids."), 400
+
+    found = set(db.session.scalars(
+        db.select(model.id).where(model.id.in_(ids))))
+    changed = action(g.user.id, found) if found else set()
+    if changed:
+        # Statuses double as record_change's keywords
+        record_change(g.viewer, **{status: changed})
+    db.session.commit()
+
+    if on_change:
+        for id in changed:
+            on_change(id)
+
+    return jsonify(results=[
+        {'id': id,
+         'status': (status if id in changed
+                    else 'unchanged' if id in found
+                    else 'not_found')}
+        for id in ids])
+
+
+@app.post('/messages/like')
+def like_messages():
+    """Like a batch of messages."""
+
+    # Written now, so after any earlier buffered likes
+    if like_buffer:
+        like_buffer.flush()
+
+    return run_batch(Message, Like.add_many, 'liked', trending.like)
+
+
+@app.post('/messages/unlike')
+def unlike_messages():
+    """Unlike a batch of messages."""
+
+    if like_buffer:
+        like_buffer.flush()
+
+    return run_batch(Message, Like.remove_many, 'unliked', trending.unlike)
+
+
+@app.post('/users/follow')
+def follow_users():
+    """Follow a batch of users."""
+
+    return run_batch(User, follow_many, 'followed')
+
+
+@app.post('/users/stop-following')
+def stop_following_users():
+    """Stop following a batch of users."""
+
+    return run_batch(User, unfollow_many, 'unfollowed')
+
+
+def follow_many(user_id, user_ids):
+    """`Follow.add_many`, also filling the follower's feed."""
+
+    followed = Follow.add_many(user_id, user_ids)
+    add_follows(user_id, followed)
+    return followed
+
+
+def unfollow_many(user_id, user_ids):
+    """`Follow.remove_many`, also emptying the follower's feed of them."""
+
+    unfollowed = Follow.remove_many(user_id, user_ids)
+    remove_follows(user_id, unfollowed)
+    return unfollowed
+
+
 ##############################################################################
 # Messages routes:
 
@@ -377,9 +916,20 @@ def add_message():
     form = MessageForm()
 
     if form.validate_on_submit():
-        msg = Message(text=form.text.data)
-        g.user.messages.append(msg)
+        msg = Message(text=form.text.data, user_id=g.user.id)
+        db.session.add(msg)
+        record_change(g.viewer, posted=1)
+        fan_out(msg)
         db.session.commit()
+        message_search.add(msg)
+        if shard_set:
+            update_after_commit(shard_set.add_messages, [msg])
+        try:
+            hub.publish(message_event(
+                msg, thumbnail(msg.user.image_url, 'avatar')))
+        except Exception:
+            # The message is posted; only live updates of it are lost
+            app.logger.exception("Publishing message %s failed", msg.id)
 
         return redirect(f"/users/{g.user.id}")
 
@@ -387,6 +937,96 @@ def add_message():
                            form=form)
 
 
+@app.get('/messages/search')
+def search_messages():
+    """Search messages by text.
+
+    Takes a 'q' param with the search terms and an optional 'before' cursor
+    (a message id) for the next page of older results."""
+
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    query = request.args.get('q', '').strip()
+    before = request.args.get('before', type=int)
+
+    if query:
+        messages, cursor = message_search.search(query, before=before)
+    else:
+        messages, cursor = [], None
+
+    return render_template('messages/search.html',
+                           query=query,
+                           messages=messages,
+                           cursor=cursor)
+
+
+@app.get('/messages/stream')
+def stream_messages():
+    """Stream new messages from the current user and who they follow.
+
+    Server-Sent Events: one `data:` line of JSON per message (see
+    `message_event`), with a comment every STREAM_KEEPALIVE seconds. The
+    stream holds no DB connection while it's open, but holds a thread, so
+    at most MAX_WSGI_STREAMS are open at once; past that, the answer is a
+    204, which tells EventSource not to reconnect."""
+
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    if not stream_slots.acquire(blocking=False):
+        return '', 204
+
+    user_ids = g.viewer.following_ids() + [g.user.id]
+    subscription = hub.subscribe(user_ids)
+
+    def events():
+        yield f"retry: {STREAM_KEEPALIVE * 1000}\n\n"
+
+        while True:
+            event = subscription.get(timeout=STREAM_KEEPALIVE)
+
+            if event is None:
+                yield ": keep-alive\n\n"
+            else:
+                yield format_event(event)
+
+    def close():
+        hub.unsubscribe(subscription)
+        stream_slots.release()
+
+    response = Response(events(),
+                        mimetype='text/event-stream',
+                        headers={'X-Accel-Buffering': 'no'})
+    # Also called if the stream is closed before it starts
+    response.call_on_close(close)
+    return response
+
+
+@app.get('/messages/trending')
+def show_trending():
+    """Show the most-liked recent messages.
+
+    Ranking comes from the trending index; only the (at most K) trending
+    messages themselves are loaded."""
+
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    message_ids = trending.top()
+    by_id = {msg.id: msg
+             for msg in feed_items(
+                 feed_query().filter(Message.id.in_(message_ids)))}
+    messages = [by_id[id] for id in message_ids if id in by_id]
+    g.viewer.prefetch(messages)
+
+    return render_template('messages/trending.html',
+                           messages=messages)
+
+
 @app.get('/messages/<int:message_id>')
 def show_message(message_id):
     """Show a message."""
@@ -407,24 +1047,77 @@ def delete_message(message_id):
     Check that this message was written by the current user.
 
     Redirect to user page on success."""
-    form = g.csrf_form
+    form = csrf_form()
 
     if not g.user or not form.validate_on_submit():
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
     msg = Message.query.get_or_404(message_id)
+    if msg.user_id != g.user.id:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
     db.session.delete(msg)
+    remove_messages([message_id])
+    record_change(g.viewer, deleted=1, unliked=[message_id])
     db.session.commit()
+    trending.forget(message_id)
+    message_search.remove(msg)
+    if shard_set:
+        update_after_commit(shard_set.remove_messages, [message_id])
 
     return redirect(f"/users/{g.user.id}")
 
 
+##############################################################################
+# Images
+
+
+@app.template_global()
+def thumbnail(url, size):
+    """URL of the image at `url`, resized to `size` (see imageproxy.SIZES)."""
+
+    return thumbnail_url(app.config['SECRET_KEY'], url, size)
+
+
+@app.get('/images/<size>/<signature>')
+def show_image(size, signature):
+    """Serve a resized copy of the image at the `url` param.
+
+    Only URLs signed by `thumbnail` are served."""
+
+    url = request.args.get('url', '')
+
+    if size not in SIZES or not hmac.compare_digest(
+            signature, sign(app.config['SECRET_KEY'], url, size)):
+        raise NotFound()
+
+    try:
+        path, digest = image_cache.get(url, size)
+    except ImageFetchError:
+        raise BadGateway()
+
+    response = send_file(path, mimetype='image/webp', etag=f"{digest}-{size}",
+                         max_age=CACHE_MAX_AGE, conditional=True)
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    return response
+
+
+@app.get('/assets/<path:filename>')
+def show_asset(filename):
+    """Serve a fingerprinted static file built by `flask assets build`."""
+
+    return send_asset(filename)
+
+
 ##############################################################################
 # Homepage and error pages
 
 
 @app.get('/')
+@cache_policy(max_age=300, s_maxage=3600, stale_while_revalidate=86400)
 def homepage():
     """Show homepage:
 
@@ -432,15 +1125,10 @@ def homepage():
     - Logged in: 100 most recent messages of self & followed_users."""
 
     if g.user:
-        following = [following.id for following in g.user.following]
-
-        messages = (Message
-                    .query
-                    # can concat lists
-                    .filter((Message.user_id == g.user.id) | (Message.user_id.in_(following)))
-                    .order_by(Message.timestamp.desc())
-                    .limit(100)
-                    .all())
+        # Only what's new since the last visit is queried (see timeline.py)
+        messages = home_timeline(g.user.id, g.viewer.following_ids(),
+                                 shards=shard_set)
+        g.viewer.prefetch(messages)
 
         return render_template('home.html',
                                messages=messages)
@@ -451,8 +1139,17 @@ def homepage():
 
 @app.after_request
 def add_header(response):
-    """Add non-caching headers on every request."""
+    """Add non-caching headers to dynamic HTML pages, unless their view
+    has a cache policy and they're for an anonymous visitor (see
+    caching.py).
+
+    Static files, assets and images set their own caching policies."""
+
+    if apply_cache_policy(response):
+        return response
 
-    # https://developer.mozilla.org/en-US/docs/Web/HTTP/Headers/Cache-Control
-    response.cache_control.no_store = True
+    if (response.mimetype == 'text/html'
+            and response.cache_control.max_age is None):
+        # https://developer.mozilla.org/en-US/docs/Web/HTTP/Headers/Cache-Control
+        response.cache_control.no_store = True
     return response
@@ -0,0 +1,491 @@
+"""ASGI entry point, for serving Warbler from an event loop.
+
+    uvicorn asgi:application --workers 4
+
+The read routes (`homepage`, `show_user`, `list_users`, `show_likes`) and
+the timeline stream are served natively on the event loop, loading data
+with async SQLAlchemy sessions: a request waiting on the DB, or an idle
+stream, costs a coroutine rather than a thread. Every other route runs the
+regular Flask app on a pool of ASGI_THREADS threads.
+
+`list_users` and `show_likes` are streamed, as in the WSGI app: their
+templates are rendered as they're sent, with an async Jinja environment
+whose loops fetch rows in batches from server-side cursors.
+
+Native routes run inside their own Flask app and request contexts, so they
+share the Flask app's session cookie, templates, flashed messages and
+after_request hooks. They skip its before_request hooks, which query
+synchronously, and load the logged-in user with `load_viewer` instead.
+Loading the session, and `process_response` (which saves it), can query
+synchronously too (see sessions.py), so they run in threads.
+"""
+
+import asyncio
+import io
+import os
+from datetime import datetime
+
+from a2wsgi import WSGIMiddleware
+from a2wsgi.wsgi import build_environ
+from flask import (
+    Response, flash, g, redirect, render_template, request,
+    session as flask_session)
+from sqlalchemy import make_url, select
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from sqlalchemy.orm import configure_mappers
+from werkzeug.exceptions import HTTPException, NotFound
+
+from app import (
+    app, hub, like_overlay, prepare_streamed, CURR_USER_KEY, STREAM_CHUNK_SIZE,
+    STREAM_KEEPALIVE)
+from metrics import record_lookup, start_request
+from models import User, Message, Follow
+from viewer import ViewerState
+from partitions import NEWEST_WINDOWS
+from pubsub import AsyncSubscription, format_event
+from readmodels import (
+    STREAM_BATCH_SIZE, ProfileCounts, feed_items, feed_select, liked_by,
+    profile_counts_select, user_card_select, user_cards)
+
+ASGI_THREADS = int(os.environ.get('ASGI_THREADS', 10))
+
+# Streams cost a coroutine here (see `stream_messages`), so homepages can
+# always open one
+app.config['MESSAGE_STREAMS'] = True
+
+ASYNC_DRIVERS = {
+    'postgresql': 'postgresql+asyncpg',
+    'sqlite': 'sqlite+aiosqlite',
+}
+
+
+def async_database_url(url):
+    """Return database `url` with its driver swapped for an asyncio one."""
+
+    url = make_url(url)
+    return url.set(drivername=ASYNC_DRIVERS[url.get_backend_name()])
+
+
+engine = create_async_engine(
+    async_database_url(app.config['SQLALCHEMY_DATABASE_URI']),
+    echo=app.config['SQLALCHEMY_ECHO'])
+Session = async_sessionmaker(engine, expire_on_commit=False)
+
+wsgi = WSGIMiddleware(app, workers=ASGI_THREADS)
+
+# Renders streamed pages, whose loops can await rows
+async_jinja_env = app.jinja_env.overlay(enable_async=True)
+
+
+##############################################################################
+# Native views
+#
+# Templates can't lazy-load through an async session, so everything they
+# touch is loaded up front, mostly as read models (see readmodels.py), or
+# for streamed pages, loaded in batches as the template loops over them.
+
+
+# Set up backrefs (User.following, Message.user...) used below.
+configure_mappers()
+
+
+def unauthorized():
+    flash("Access unauthorized.", "danger")
+    return redirect("/")
+
+
+async def get_or_404(session, model, id):
+    instance = await session.get(model, id)
+    if instance is None:
+        raise NotFound()
+    return instance
+
+
+async def get_profile_counts(session, user_id):
+    return ProfileCounts(
+        *(await session.execute(
+            profile_counts_select(user_id, like_overlay(user_id)))).one())
+
+
+async def newest(session, stmt, limit):
+    """Async version of `partitions.newest`; returns rows."""
+
+    now = datetime.utcnow()
+    stmt = stmt.order_by(Message.timestamp.desc()).limit(limit)
+
+    for window in NEWEST_WINDOWS:
+        if window is None:
+            return (await session.execute(stmt)).all()
+
+        messages = (await session.execute(
+            stmt.where(Message.timestamp >= now - window))).all()
+
+        if len(messages) == limit:
+            return messages
+
+
+async def streamed(session, stmt, make, batch_size=STREAM_BATCH_SIZE):
+    """Async version of `readmodels.streamed`."""
+
+    result = await session.stream(
+        stmt.execution_options(yield_per=batch_size))
+
+    async for rows in result.partitions():
+        yield make(rows)
+
+
+async def stream_feed_items(session, stmt):
+    """Async version of `app.stream_feed_items`."""
+
+    viewer = g.viewer
+
+    async for batch in streamed(session, stmt, feed_items):
+        await session.run_sync(
+            lambda sync_session: viewer.prefetch(batch, sync_session,
+                                                 keep=False))
+        for item in batch:
+            yield item
+
+
+async def stream_user_cards(session, stmt):
+    """Async version of `app.stream_user_cards`."""
+
+    async for batch in streamed(session, stmt, user_cards):
+        for card in batch:
+            yield card
+
+
+class StreamedPage:
+    """A page that `run_view` sends as it's rendered; see
+    `render_streamed`."""
+
+    def __init__(self, template, context):
+        self.template = template
+        self.context = context
+
+    async def chunks(self):
+        """Yield the rendered page, in chunks."""
+
+        template = async_jinja_env.get_template(self.template)
+        app.update_template_context(self.context)
+
+        buffered = []
+        size = 0
+
+        async for text in template.generate_async(self.context):
+            buffered.append(text)
+            size += len(text)
+            if size >= STREAM_CHUNK_SIZE:
+                yield ''.join(buffered)
+                buffered = []
+                size = 0
+
+        yield ''.join(buffered)
+
+
+def render_streamed(template, **context):
+    """Async version of `app.render_streamed`."""
+
+    prepare_streamed()
+    return StreamedPage(template, context)
+
+
+async def load_viewer(session):
+    """Return the logged-in user and their `ViewerState`, or (None, None)."""
+
+    if CURR_USER_KEY not in flask_session:
+        return None, None
+
+    user = await session.get(User, flask_session[CURR_USER_KEY])
+    if user is None:
+        return None, None
+
+    overlay = like_overlay(user.id)
+    state = ViewerState.load(user, overlay)
+    record_lookup('viewer_state', hit=state is not None)
+    if state is None:
+        state = await session.run_sync(
+            lambda sync_session: ViewerState.build(
+                user, sync_session, overlay))
+        state.save()
+
+    # Too many to cache: the state falls back to the relationship
+    if state.following is None:
+        await session.refresh(user, ['following'])
+
+    return user, state
+
+
+async def prefetch(session, messages):
+    """Async version of `ViewerState.prefetch`, for g.viewer."""
+
+    viewer = g.viewer
+    await session.run_sync(
+        lambda sync_session: viewer.prefetch(messages, sync_session))
+
+
+async def load_viewer_id(session):
+    """Return the logged-in user's id if they still exist, or None."""
+
+    if CURR_USER_KEY not in flask_session:
+        return None
+
+    return await session.scalar(
+        select(User.id).where(User.id == flask_session[CURR_USER_KEY]))
+
+
+async def homepage(session):
+    if not g.user:
+        return render_template('home-anon.html')
+
+    following = g.viewer.following_ids()
+
+    messages = feed_items(await newest(
+        session,
+        feed_select()
+        .where((Message.user_id == g.user.id) | (Message.user_id.in_(following))),
+        limit=100))
+    await prefetch(session, messages)
+
+    return render_template('home.html',
+                           messages=messages)
+
+
+async def list_users(session):
+    if not g.user:
+        return unauthorized()
+
+    search = request.args.get('q')
+
+    stmt = user_card_select()
+    if search:
+        stmt = stmt.where(User.username.like(f"%{search}%"))
+
+    return render_streamed('users/index.html',
+                           users=stream_user_cards(session, stmt))
+
+
+async def show_user(session, user_id):
+    if not g.user:
+        return unauthorized()
+
+    user = await get_or_404(session, User, user_id)
+    messages = feed_items(await session.execute(
+        feed_select()
+        .where(Message.user_id == user_id)
+        .order_by(Message.timestamp.desc())))
+    await prefetch(session, messages)
+
+    return render_template('users/show.html',
+                           user=user,
+                           counts=await get_profile_counts(session, user_id),
+                           messages=messages)
+
+
+async def show_likes(session, user_id):
+    if not g.user:
+        return unauthorized()
+
+    user = await get_or_404(session, User, user_id)
+    liked_messages = stream_feed_items(
+        session,
+        liked_by(feed_select(), user_id, like_overlay(user_id))
+        .order_by(Message.timestamp.desc()))
+
+    return render_streamed('/likes/show.html',
+                           user=user,
+                           counts=await get_profile_counts(session, user_id),
+                           liked_messages=liked_messages)
+
+
+NATIVE_VIEWS = {
+    'homepage': homepage,
+    'list_users': list_users,
+    'show_user': show_user,
+    'show_likes': show_likes,
+}
+
+
+async def request_context(environ):
+    """Return a Flask request context for `environ`, with its session
+    loaded off the event loop."""
+
+    ctx = app.request_context(environ)
+
+    with app.app_context():
+        # Run with a copy of this context, so inside the app context
+        ctx.session = await asyncio.to_thread(
+            app.session_interface.open_session, app, ctx.request)
+
+    if ctx.session is None:
+        ctx.session = app.session_interface.make_null_session(app)
+
+    return ctx
+
+
+async def process_response(rv):
+    """`app.process_response` of view result `rv`, off the event loop."""
+
+    return await asyncio.to_thread(app.process_response, app.make_response(rv))
+
+
+async def run_view(environ, view, view_args, send):
+    """Run native `view` in a Flask request context, and send its
+    response."""
+
+    ctx = await request_context(environ)
+
+    with app.app_context(), ctx:
+        start_request()
+        async with Session() as session:
+            try:
+                g.user, g.viewer = await load_viewer(session)
+                rv = await view(session, **view_args)
+
+            except HTTPException as e:
+                rv = app.handle_user_exception(e)
+
+            except Exception as e:
+                rv = app.handle_exception(e)
+
+            if not isinstance(rv, StreamedPage):
+                await send_response(send, await process_response(rv))
+                return
+
+            # Headers go first, with the session saved; the page follows,
+            # rendered in this request's context and DB session
+            response = await process_response(
+                Response(iter(()), mimetype='text/html'))
+            await send_start(send, response)
+
+            try:
+                async for chunk in rv.chunks():
+                    await send({
+                        'type': 'http.response.body',
+                        'body': chunk.encode(),
+                        'more_body': True,
+                    })
+                await send({'type': 'http.response.body', 'body': b''})
+
+            finally:
+                response.close()
+
+
+async def send_start(send, response):
+    await send({
+        'type': 'http.response.start',
+        'status': response.status_code,
+        'headers': [(name.lower().encode('latin-1'), value.encode('latin-1'))
+                    for name, value in response.headers.items()],
+    })
+
+
+async def send_response(send, response):
+    await send_start(send, response)
+    await send({
+        'type': 'http.response.body',
+        'body': response.get_data(),
+    })
+    # Runs call_on_close callbacks, like metrics.py's
+    response.close()
+
+
+async def wait_for_disconnect(receive):
+    while (await receive())['type'] != 'http.disconnect':
+        pass
+
+
+async def stream_messages(environ, receive, send):
+    """Native version of `app.stream_messages`."""
+
+    ctx = await request_context(environ)
+
+    with app.app_context(), ctx:
+        async with Session() as session:
+            user_id = await load_viewer_id(session)
+
+            if user_id is None:
+                response = await process_response(unauthorized())
+            else:
+                following = (await session.scalars(
+                    select(Follow.user_being_followed_id)
+                    .where(Follow.user_following_id == user_id))).all()
+
+    if user_id is None:
+        await send_response(send, response)
+        return
+
+    subscription = hub.subscribe([*following, user_id], AsyncSubscription)
+    disconnected = asyncio.ensure_future(wait_for_disconnect(receive))
+
+    try:
+        await send({
+            'type': 'http.response.start',
+            'status': 200,
+            'headers': [
+                (b'content-type', b'text/event-stream; charset=utf-8'),
+                (b'cache-control', b'no-store'),
+                (b'x-accel-buffering', b'no'),
+            ],
+        })
+        chunk = f"retry: {STREAM_KEEPALIVE * 1000}\n\n"
+
+        while True:
+            await send({
+                'type': 'http.response.body',
+                'body': chunk.encode(),
+                'more_body': True,
+            })
+
+            next_event = asyncio.ensure_future(
+                subscription.get(timeout=STREAM_KEEPALIVE))
+            await asyncio.wait({next_event, disconnected},
+                               return_when=asyncio.FIRST_COMPLETED)
+
+            if disconnected.done():
+                next_event.cancel()
+                break
+
+            event = next_event.result()
+            chunk = ": keep-alive\n\n" if event is None else format_event(event)
+
+    finally:
+        disconnected.cancel()
+        hub.unsubscribe(subscription)
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+
+        elif message['type'] == 'lifespan.shutdown':
+            await engine.dispose()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def application(scope, receive, send):
+    """The ASGI application."""
+
+    if scope['type'] == 'lifespan':
+        return await lifespan(receive, send)
+
+    environ = build_environ(scope, io.BytesIO())
+
+    try:
+        endpoint, view_args = app.url_map.bind_to_environ(environ).match()
+    except HTTPException:
+        endpoint = None
+
+    if endpoint == 'stream_messages':
+        return await stream_messages(environ, receive, send)
+
+    view = NATIVE_VIEWS.get(endpoint)
+
+    if view is None:
+        return await wsgi(scope, receive, send)
+
+    await run_view(environ, view, view_args, send)
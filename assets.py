@@ -0,0 +1,182 @@
+"""Static asset pipeline: fingerprinted, precompressed, immutably cached.
+
+`flask assets build` copies every file under static/ into static/dist/
+with a hash of its contents in its name (style.css -> style.<hash>.css),
+rewriting /static/... references in stylesheets to match, and writes gzip
+and brotli variants of compressible files next to them. A manifest maps
+original paths to built ones.
+
+Templates link assets with `asset_url(path)`, and `/assets/<path>` serves
+built files in the best encoding the client accepts. Since a changed file
+gets a new name, they're cached as immutable for a year: repeat visits
+don't even revalidate them.
+
+Without a build (e.g. in development), `asset_url` falls back to the plain
+/static/ URL.
+"""
+
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+import re
+
+import brotli
+import click
+from flask import current_app, request, send_file
+from flask.cli import AppGroup
+from werkzeug.exceptions import NotFound
+from werkzeug.security import safe_join
+
+DIST = 'dist'
+MANIFEST = 'manifest.json'
+
+HASH_LENGTH = 12
+COMPRESSIBLE = {'.css', '.js', '.svg', '.ico', '.json', '.txt', '.map'}
+
+# Best first
+ENCODINGS = (('br', '.br'), ('gzip', '.gz'))
+
+CACHE_MAX_AGE = 365 * 24 * 60 * 60
+
+STATIC_REFERENCE_RE = re.compile(r"""url\((["']?)/static/([^"')]+)\1\)""")
+
+cli = AppGroup('assets', help="Build static assets.")
+
+_manifests = {}
+
+
+def fingerprint(path, data):
+    """Return `path` with a hash of `data` before its extension."""
+
+    stem, ext = os.path.splitext(path)
+    digest = hashlib.sha256(data).hexdigest()[:HASH_LENGTH]
+    return f"{stem}.{digest}{ext}"
+
+
+def _write(path, data):
+    """Write `data` to `path` atomically, as it may be served meanwhile."""
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, 'wb') as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+
+def build(static_dir, out_dir):
+    """Build the assets in `static_dir` into `out_dir`; return the manifest.
+
+    Files from earlier builds are left in place, so pages rendered before
+    a deploy can still load what they link to."""
+
+    sources = []
+    for root, dirs, files in os.walk(static_dir):
+        if os.path.abspath(root) == os.path.abspath(out_dir):
+            dirs.clear()
+            continue
+        dirs[:] = [d for d in dirs
+                   if os.path.abspath(os.path.join(root, d))
+                   != os.path.abspath(out_dir)]
+        for name in files:
+            sources.append(os.path.relpath(os.path.join(root, name),
+                                           static_dir).replace(os.sep, '/'))
+
+    # Stylesheets last, so the files they reference already have names.
+    sources.sort(key=lambda path: (path.endswith('.css'), path))
+
+    manifest = {}
+    for path in sources:
+        with open(os.path.join(static_dir, path), 'rb') as f:
+            data = f.read()
+
+        if path.endswith('.css'):
+            data = STATIC_REFERENCE_RE.sub(
+                lambda m: (f"url({m[1]}/assets/{manifest.get(m[2], m[2])}"
+                           f"{m[1]})"),
+                data.decode()).encode()
+
+        built = fingerprint(path, data)
+        manifest[path] = built
+        out = os.path.join(out_dir, built)
+        _write(out, data)
+
+        if os.path.splitext(path)[1] in COMPRESSIBLE:
+            for suffix, compressed in (
+                    ('.gz', gzip.compress(data, 9, mtime=0)),
+                    ('.br', brotli.compress(data))):
+                if len(compressed) < len(data):
+                    _write(out + suffix, compressed)
+
+    with open(os.path.join(out_dir, MANIFEST), 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+
+    return manifest
+
+
+def dist_dir(app):
+    return os.path.join(app.static_folder, DIST)
+
+
+def load_manifest(out_dir):
+    """Return the manifest in `out_dir` ({} if there's none), cached."""
+
+    if out_dir not in _manifests:
+        try:
+            with open(os.path.join(out_dir, MANIFEST)) as f:
+                _manifests[out_dir] = json.load(f)
+        except FileNotFoundError:
+            _manifests[out_dir] = {}
+
+    return _manifests[out_dir]
+
+
+def asset_url(path):
+    """URL of static file `path`, fingerprinted if assets have been built."""
+
+    built = load_manifest(dist_dir(current_app)).get(path)
+
+    if built is None:
+        return f"/static/{path}"
+
+    return f"/assets/{built}"
+
+
+def send_asset(filename):
+    """Response serving built asset `filename`, precompressed if accepted."""
+
+    path = safe_join(dist_dir(current_app), filename)
+    if path is None or not os.path.isfile(path):
+        raise NotFound()
+
+    mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+    encoding = None
+
+    for name, suffix in ENCODINGS:
+        if (request.accept_encodings.quality(name) > 0
+                and os.path.isfile(path + suffix)):
+            encoding = name
+            path += suffix
+            break
+
+    response = send_file(path, mimetype=mimetype, max_age=CACHE_MAX_AGE,
+                         conditional=True)
+    if encoding:
+        response.content_encoding = encoding
+    response.vary.add('Accept-Encoding')
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    return response
+
+
+@cli.command('build')
+def build_command():
+    """Fingerprint and precompress static files into static/dist."""
+
+    app = current_app
+    out_dir = dist_dir(app)
+    manifest = build(app.static_folder, out_dir)
+    _manifests.pop(out_dir, None)
+
+    click.echo(f"Built {len(manifest)} assets into {out_dir}.")
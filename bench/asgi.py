@@ -0,0 +1,179 @@
+"""Compare throughput of the WSGI (gunicorn) and ASGI (uvicorn) stacks.
+
+Start one stack at a time with the same number of worker processes, so
+both get the same memory:
+
+    gunicorn --workers 4 --bind 127.0.0.1:8000 app:app
+    uvicorn --workers 4 --port 8000 asgi:application
+
+then, from the project root:
+
+    python bench/asgi.py http://127.0.0.1:8000/users --user-id 1 \\
+        --connections 200 --streams 1000
+
+`--streams` opens that many idle timeline streams before measuring, as
+logged-in browsers sitting on the homepage would; streams the server
+doesn't answer within `--duration` seconds aren't counted as held. Then
+`--connections` clients send requests back to back for `--duration`
+seconds. The WSGI stack can only serve as many requests at a time as it
+has threads (see gunicorn.conf.py), and answers streams past
+MAX_WSGI_STREAMS with a 204.
+"""
+
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import time
+from urllib.parse import urlsplit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def session_cookie(user_id):
+    """Return a session cookie logging in as `user_id`.
+
+    The session is saved in the database, so the server must use the
+    database session store."""
+
+    from app import app, CURR_USER_KEY
+
+    with app.test_client() as client:
+        with client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = user_id
+        cookie = client.get_cookie(app.config['SESSION_COOKIE_NAME'])
+
+    return f"session={cookie.value}"
+
+
+def request_bytes(url, cookie):
+    parts = urlsplit(url)
+    path = parts.path or '/'
+    if parts.query:
+        path += f"?{parts.query}"
+
+    lines = [f"GET {path} HTTP/1.1", f"Host: {parts.netloc}"]
+    if cookie:
+        lines.append(f"Cookie: {cookie}")
+
+    return ("\r\n".join(lines) + "\r\n\r\n").encode()
+
+
+async def read_response(reader):
+    """Read one response; return (status, whether to keep the connection)."""
+
+    status = int((await reader.readline()).split()[1])
+    length = 0
+    keep_alive = True
+
+    while (line := await reader.readline()) not in (b"\r\n", b""):
+        name, _, value = line.decode('latin-1').partition(':')
+        name = name.lower()
+        if name == 'content-length':
+            length = int(value)
+        elif name == 'connection' and value.strip().lower() == 'close':
+            keep_alive = False
+
+    await reader.readexactly(length)
+    return status, keep_alive
+
+
+async def open_stream(host, port, url, cookie):
+    """Open a timeline stream and leave it idle; return its writer."""
+
+    reader, writer = await asyncio.open_connection(host, port)
+    writer.write(request_bytes(url, cookie))
+    status = int((await reader.readline()).split()[1])
+    if status != 200:
+        writer.close()
+        raise ConnectionError(f"stream refused: {status}")
+    return writer
+
+
+async def client(host, port, request, deadline, timeout, latencies, errors):
+    writer = None
+
+    try:
+        while time.perf_counter() < deadline:
+            start = time.perf_counter()
+
+            # Servers may close the connection after a response, so
+            # reconnecting is part of the cost.
+            if writer is None:
+                reader, writer = await asyncio.open_connection(host, port)
+
+            writer.write(request)
+            try:
+                status, keep_alive = await asyncio.wait_for(
+                    read_response(reader), timeout=timeout)
+            except asyncio.TimeoutError:
+                errors.append('timeout')
+                break
+
+            latencies.append(time.perf_counter() - start)
+
+            if status >= 400:
+                errors.append(status)
+            if not keep_alive:
+                writer.close()
+                writer = None
+    finally:
+        if writer is not None:
+            writer.close()
+
+
+async def run(args):
+    parts = urlsplit(args.url)
+    host, port = parts.hostname, parts.port or 80
+    cookie = session_cookie(args.user_id) if args.user_id else None
+
+    streams = []
+    if args.streams:
+        stream_url = f"{parts.scheme}://{parts.netloc}/messages/stream"
+        opened = await asyncio.gather(
+            *(asyncio.wait_for(open_stream(host, port, stream_url, cookie),
+                               timeout=args.duration)
+              for _ in range(args.streams)),
+            return_exceptions=True)
+        streams = [writer for writer in opened
+                   if not isinstance(writer, BaseException)]
+
+    latencies = []
+    errors = []
+    deadline = time.perf_counter() + args.duration
+    request = request_bytes(args.url, cookie)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(
+        client(host, port, request, deadline, args.duration, latencies, errors)
+        for _ in range(args.connections)))
+    elapsed = time.perf_counter() - started
+
+    for writer in streams:
+        writer.close()
+
+    latencies.sort()
+    print(f"streams held:  {len(streams)}")
+    print(f"requests:      {len(latencies)} ({len(errors)} errors)")
+    print(f"throughput:    {len(latencies) / elapsed:.1f} req/s")
+    if latencies:
+        print(f"latency p50:   {statistics.median(latencies) * 1000:.1f} ms")
+        print(f"latency p99:   "
+              f"{latencies[int(len(latencies) * 0.99)] * 1000:.1f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('url')
+    parser.add_argument('--user-id', type=int,
+                        help="log in as this user (needs SECRET_KEY)")
+    parser.add_argument('--connections', type=int, default=50)
+    parser.add_argument('--streams', type=int, default=0)
+    parser.add_argument('--duration', type=float, default=10)
+
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == '__main__':
+    main()
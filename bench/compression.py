@@ -0,0 +1,85 @@
+"""Compare CPU cost and bytes saved by compressing a 100-message feed.
+
+Renders the homepage of the user whose feed has the most messages (capped
+at 100, as the page is), with and without MinifyWhitespace, then
+compresses each page REPEAT times at several settings and reports the
+time per page and the bytes sent.
+
+Run from the project root, against a seeded database, like:
+
+    python bench/compression.py
+"""
+
+import gzip
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import brotli  # noqa: E402
+
+from app import app, CURR_USER_KEY  # noqa: E402
+from compression import (  # noqa: E402
+    BROTLI_QUALITY, GZIP_LEVEL, MinifyWhitespace)
+from models import db, Follow, Message  # noqa: E402
+
+REPEAT = 200
+
+
+def busiest_user():
+    """Return the id of the user following the most messages' authors."""
+
+    return db.session.scalar(
+        db.select(Follow.user_following_id)
+        .join(Message, Message.user_id == Follow.user_being_followed_id)
+        .group_by(Follow.user_following_id)
+        .order_by(db.func.count().desc())
+        .limit(1))
+
+
+def render_feed(user_id):
+    with app.test_client() as client:
+        with client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = user_id
+        return client.get('/').data
+
+
+def main():
+    app.config['DEBUG_TB_ENABLED'] = False
+
+    with app.app_context():
+        user_id = busiest_user()
+
+    page = render_feed(user_id)
+    app.jinja_env.add_extension(MinifyWhitespace)
+    app.jinja_env.cache.clear()
+    minified = render_feed(user_id)
+
+    print(f"feed of user {user_id}: {len(page)} bytes")
+    print(f"{'':>24} {'ms/page':>8} {'bytes':>8} {'saved':>7} "
+          f"{'µs/KiB saved':>13}")
+
+    encoders = (
+        ("none", lambda data: data),
+        (f"gzip {GZIP_LEVEL}", lambda data: gzip.compress(data, GZIP_LEVEL)),
+        ("gzip 9", lambda data: gzip.compress(data, 9)),
+        (f"brotli {BROTLI_QUALITY}",
+         lambda data: brotli.compress(data, quality=BROTLI_QUALITY)),
+        ("brotli 11", lambda data: brotli.compress(data, quality=11)),
+    )
+
+    for label, body in (("", page), ("minified", minified)):
+        for name, encode in encoders:
+            seconds = timeit.timeit(lambda: encode(body), number=REPEAT)
+            ms = seconds / REPEAT * 1000
+            size = len(encode(body))
+            saved = len(page) - size
+            cost = ms * 1000 / (saved / 1024) if saved else 0
+
+            print(f"{name + ' ' + label:>24} {ms:>8.3f} {size:>8} "
+                  f"{saved / len(page):>7.1%} {cost:>13.1f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,157 @@
+"""Compare pull, push and hybrid home feeds on skewed follower counts.
+
+Builds a database in which users follow others with Zipf-like
+popularity, so a handful of accounts have most of the followers, then for
+several celebrity thresholds reports:
+
+    post      ms to fan out one message of the most followed account, and
+              of a median one
+    read      ms per homepage feed, averaged over random readers
+    entries   feed entries stored
+
+"pull" reads every followed user's messages on each visit (FEED_FANOUT
+off); "push" copies every message to every follower (no celebrities).
+
+Run from the project root like:
+
+    python bench/feed.py [database url]
+
+By default it builds a throwaway SQLite database in /tmp.
+"""
+
+import os
+import random
+import sys
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+os.environ['DATABASE_URL'] = (sys.argv[1] if len(sys.argv) > 1
+                              else "sqlite:////tmp/bench-feed.db")
+os.environ.setdefault('SECRET_KEY', 'bench')
+
+import feed  # noqa: E402
+from app import app  # noqa: E402
+from models import db, User, Message, Follow, FeedEntry  # noqa: E402
+from partitions import newest  # noqa: E402
+from readmodels import feed_items  # noqa: E402
+
+USERS = 2000
+FOLLOWS_PER_USER = 30
+MESSAGES_PER_USER = 10
+READS = 200
+PAGE_SIZE = 100
+
+THRESHOLDS = (("push", None), ("1000", 1000), ("200", 200), ("50", 50))
+
+
+def build():
+    """Fill the database with users, skewed follows and messages."""
+
+    random.seed(0)
+    db.drop_all()
+    db.create_all()
+
+    db.session.execute(db.insert(User), [
+        {'id': id, 'username': f"user{id}", 'email': f"user{id}@test.com",
+         'password': 'x'}
+        for id in range(1, USERS + 1)])
+
+    # Popularity ~ 1 / rank: user 1 is followed by nearly everyone
+    ids = list(range(1, USERS + 1))
+    weights = [1 / rank for rank in ids]
+    follows = set()
+    for follower in ids:
+        chosen = set()
+        while len(chosen) < FOLLOWS_PER_USER:
+            followed, = random.choices(ids, weights)
+            if followed != follower:
+                chosen.add(followed)
+        follows.update((follower, followed) for followed in chosen)
+
+    db.session.execute(db.insert(Follow), [
+        {'user_following_id': follower, 'user_being_followed_id': followed}
+        for follower, followed in follows])
+
+    now = datetime.utcnow()
+    db.session.execute(db.insert(Message), [
+        {'text': f"message {n} of {id}", 'user_id': id,
+         'timestamp': now - timedelta(minutes=random.randrange(60 * 24 * 7))}
+        for id in ids for n in range(MESSAGES_PER_USER)])
+    db.session.commit()
+
+    return follows
+
+
+def read_ms(readers, following):
+    start = time.perf_counter()
+    for reader in readers:
+        feed_items(newest(
+            feed.home_query(reader, following[reader], PAGE_SIZE),
+            PAGE_SIZE))
+    return (time.perf_counter() - start) / len(readers) * 1000
+
+
+def post_ms(author_id):
+    """Time fanning out a message of `author_id`, without keeping it."""
+
+    message = Message(text="benchmark", user_id=author_id)
+    db.session.add(message)
+    db.session.flush()
+
+    start = time.perf_counter()
+    feed.fan_out(message)
+    elapsed = time.perf_counter() - start
+
+    db.session.rollback()
+    return elapsed * 1000
+
+
+def main():
+    app.config['DEBUG_TB_ENABLED'] = False
+
+    with app.app_context():
+        follows = build()
+
+        following = {}
+        for follower, followed in follows:
+            following.setdefault(follower, []).append(followed)
+
+        counts = {}
+        for _, followed in follows:
+            counts[followed] = counts.get(followed, 0) + 1
+        by_followers = sorted(counts, key=counts.get, reverse=True)
+        top, median = by_followers[0], by_followers[len(by_followers) // 2]
+
+        random.seed(1)
+        readers = random.sample(sorted(following), READS)
+
+        print(f"{USERS} users, {len(follows)} follows; most followed has "
+              f"{counts[top]}, median {counts[median]}")
+        print(f"{'':>8} {'post top':>9} {'post med':>9} {'read':>7} "
+              f"{'entries':>9} {'celebs':>7}")
+
+        feed.FEED_FANOUT = False
+        print(f"{'pull':>8} {0:>9.2f} {0:>9.2f} "
+              f"{read_ms(readers, following):>7.2f} {0:>9} {'-':>7}")
+
+        feed.FEED_FANOUT = True
+        for name, threshold in THRESHOLDS:
+            threshold = threshold or USERS + 1
+            feed.FEED_CELEBRITY_THRESHOLD = threshold
+            app.test_cli_runner().invoke(
+                args=['feed', 'rebuild', '--threshold', str(threshold)])
+
+            entries = db.session.scalar(
+                db.select(db.func.count()).select_from(FeedEntry))
+            celebrities = db.session.scalar(
+                db.select(db.func.count()).where(User.celebrity))
+
+            print(f"{name:>8} {post_ms(top):>9.2f} {post_ms(median):>9.2f} "
+                  f"{read_ms(readers, following):>7.2f} {entries:>9} "
+                  f"{celebrities:>7}")
+
+
+if __name__ == '__main__':
+    main()
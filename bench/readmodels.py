@@ -0,0 +1,65 @@
+"""Compare loading a 100-message feed as ORM entities and as read models.
+
+Loads the newest 100 messages with their authors, the way the homepage
+does, REPEAT times each way, and reports the time per page and the peak
+memory allocated while building one page.
+
+Run from the project root, against a seeded database, like:
+
+    python bench/readmodels.py
+"""
+
+import os
+import sys
+import timeit
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy.orm import joinedload  # noqa: E402
+
+from app import app  # noqa: E402, F401 (connects the database)
+from models import db, Message  # noqa: E402
+from readmodels import feed_items, feed_query  # noqa: E402
+
+PAGE_SIZE = 100
+REPEAT = 200
+
+
+def load_entities():
+    messages = (Message.query
+                .options(joinedload(Message.user))
+                .order_by(Message.timestamp.desc())
+                .limit(PAGE_SIZE)
+                .all())
+    db.session.expunge_all()
+    return messages
+
+
+def load_read_models():
+    return feed_items(feed_query()
+                      .order_by(Message.timestamp.desc())
+                      .limit(PAGE_SIZE))
+
+
+def peak_memory(load):
+    tracemalloc.start()
+    load()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return peak
+
+
+def main():
+    print(f"{'':>12} {'ms/page':>10} {'peak KiB':>10}")
+
+    for name, load in (("entities", load_entities),
+                       ("read models", load_read_models)):
+        load()
+        seconds = timeit.timeit(load, number=REPEAT)
+        print(f"{name:>12} {seconds / REPEAT * 1000:>10.2f} "
+              f"{peak_memory(load) / 1024:>10.1f}")
+
+
+if __name__ == '__main__':
+    main()
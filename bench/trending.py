@@ -0,0 +1,70 @@
+"""Benchmark trending reads as the number of likes grows.
+
+Reads should cost the same whether the index has seen a thousand likes or
+a million, since they only scan the top K entries of the log_score index.
+
+Run from the project root like:
+
+    python bench/trending.py [database url]
+
+By default it uses a throwaway SQLite database in /tmp. Likes are summed
+into scores here and written in bulk, as TrendingIndex.like would have
+left them.
+"""
+
+import os
+import random
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+os.environ['DATABASE_URL'] = (sys.argv[1] if len(sys.argv) > 1
+                              else "sqlite:////tmp/bench-trending.db")
+os.environ.setdefault('SECRET_KEY', 'bench')
+
+from app import app  # noqa: E402, F401
+from models import db, TrendingScore  # noqa: E402
+from trending import TrendingIndex, log2_add  # noqa: E402
+
+READS = 1_000
+
+
+def main():
+    random.seed(0)
+    TrendingScore.__table__.drop(db.engine, checkfirst=True)
+    TrendingScore.__table__.create(db.engine)
+
+    index = TrendingIndex()
+    scores = {}
+    total = 0
+    now = 0
+
+    print(f"{'likes':>10} {'messages':>10} {'read (us)':>10}")
+
+    for target in (1_000, 10_000, 100_000, 1_000_000):
+        while total < target:
+            # Skewed popularity: a few messages get most of the likes.
+            message_id = int(random.paretovariate(0.3)) % 500_000
+            likes, log_score = scores.get(message_id, (0, None))
+            log_weight = now / index.half_life
+            scores[message_id] = (
+                likes + 1,
+                log_weight if log_score is None
+                else log2_add(log_score, log_weight))
+            total += 1
+            now += 0.01
+
+        db.session.execute(db.delete(TrendingScore))
+        db.session.execute(db.insert(TrendingScore), [
+            {'message_id': message_id, 'likes': likes,
+             'log_score': log_score}
+            for message_id, (likes, log_score) in scores.items()])
+        db.session.commit()
+
+        seconds = timeit.timeit(index.top, number=READS)
+        print(f"{total:>10} {len(index):>10} {seconds / READS * 1e6:>10.2f}")
+
+
+if __name__ == '__main__':
+    main()
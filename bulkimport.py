@@ -0,0 +1,573 @@
+"""Bulk import of users, messages and follows into a live database.
+
+    flask imports run DIRECTORY      import DIRECTORY/users.csv etc.
+    flask imports status             show an unfinished import's progress
+    flask imports abort              drop an unfinished import
+
+The CSVs are in the format of generator/*.csv, which seed.py loads into an
+empty database: messages' `user_id` and follows' ids are row numbers in
+users.csv (the ids those users get in a fresh database). messages.csv and
+follows.csv are optional.
+
+Here, rows are validated as they're copied into staging tables
+(`import_*`); rejected rows stay there with the reason. Then, all in SQL:
+
+    dedupe      reject rows repeating an earlier row's username, email or
+                message, and match users to existing ones with the same
+                username and email (rejecting those whose username or
+                email another user has)
+    users       insert the new users, and look up their ids
+    messages    insert messages not already in the database
+    follows     insert follows not already in the database
+
+Each step runs in batches of --batch-size rows, one transaction per
+batch, each recording how far its step got in `import_checkpoints`, so an
+import that's interrupted carries on from its last batch when run again,
+and importing the same files twice adds nothing. Users whose messages or
+follows change have their state_version bumped (see viewer.py).
+
+Once done, the staging tables are dropped. New messages are copied to
+the shards, if any, batch by batch (see shards.py). With FEED_FANOUT on,
+run `flask feed rebuild` afterwards to copy them into feeds. On a
+partitioned `messages` (see partitions.py), messages need partitions for
+their months.
+"""
+
+import csv
+import itertools
+import os
+from datetime import datetime
+
+import click
+from email_validator import EmailNotValidError, validate_email
+from flask import current_app
+from flask.cli import AppGroup
+
+import feed
+from models import (
+    db, insert_ignore, User, Message, Follow, DEFAULT_IMAGE_URL,
+    DEFAULT_HEADER_IMAGE_URL)
+from shards import update_after_commit
+
+IMPORT_BATCH_SIZE = 5000
+
+# Rejected rows shown per file at the end of an import
+SHOW_REJECTED = 10
+
+cli = AppGroup('imports', help="Bulk-import CSVs into the database.")
+
+# Not in db.metadata: created by an import, and dropped when it's done
+staging = db.MetaData()
+
+staged_users = db.Table(
+    'import_users', staging,
+    db.Column('row', db.Integer, primary_key=True),
+    db.Column('email', db.Text),
+    db.Column('username', db.Text, index=True),
+    db.Column('image_url', db.Text),
+    db.Column('password', db.Text),
+    db.Column('bio', db.Text),
+    db.Column('header_image_url', db.Text),
+    db.Column('location', db.Text),
+    db.Column('user_id', db.Integer),
+    db.Column('error', db.Text),
+    db.Index('ix_import_users_email', 'email'),
+)
+
+staged_messages = db.Table(
+    'import_messages', staging,
+    db.Column('row', db.Integer, primary_key=True),
+    db.Column('text', db.Text),
+    db.Column('timestamp', db.DateTime),
+    db.Column('user_row', db.Integer),
+    db.Column('error', db.Text),
+    db.Index('ix_import_messages_user_row', 'user_row', 'timestamp'),
+)
+
+staged_follows = db.Table(
+    'import_follows', staging,
+    db.Column('row', db.Integer, primary_key=True),
+    db.Column('followed_row', db.Integer),
+    db.Column('following_row', db.Integer),
+    db.Column('error', db.Text),
+)
+
+checkpoints = db.Table(
+    'import_checkpoints', staging,
+    db.Column('step', db.String(20), primary_key=True),
+    db.Column('position', db.Integer, nullable=False),
+    db.Column('source', db.Text, nullable=False),
+)
+
+
+def column_length(model, name):
+    return model.__table__.c[name].type.length
+
+
+def parse_int(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def stage_user(row):
+    """Staged row of a users.csv row."""
+
+    staged = {
+        'email': row.get('email') or '',
+        'username': row.get('username') or '',
+        'image_url': row.get('image_url') or DEFAULT_IMAGE_URL,
+        'password': row.get('password') or '',
+        'bio': row.get('bio') or '',
+        'header_image_url': (row.get('header_image_url')
+                             or DEFAULT_HEADER_IMAGE_URL),
+        'location': row.get('location') or '',
+        'error': None,
+    }
+
+    for field in ('email', 'username', 'password'):
+        if not staged[field]:
+            staged['error'] = f"missing {field}"
+            return staged
+
+    for field, value in staged.items():
+        length = (field in User.__table__.c
+                  and column_length(User, field))
+        if length and len(value) > length:
+            staged['error'] = f"{field} too long"
+            return staged
+
+    try:
+        validate_email(staged['email'], check_deliverability=False)
+    except EmailNotValidError:
+        staged['error'] = "invalid email"
+        return staged
+
+    # Imported as they are: the app only ever checks hashes
+    if not staged['password'].startswith('$2'):
+        staged['error'] = "password not a bcrypt hash"
+
+    return staged
+
+
+def stage_message(row):
+    """Staged row of a messages.csv row."""
+
+    staged = {
+        'text': row.get('text') or '',
+        'timestamp': None,
+        'user_row': parse_int(row.get('user_id')),
+        'error': None,
+    }
+
+    try:
+        staged['timestamp'] = datetime.fromisoformat(row.get('timestamp'))
+    except (TypeError, ValueError):
+        staged['error'] = "invalid timestamp"
+
+    if staged['user_row'] is None:
+        staged['error'] = "invalid user_id"
+    elif not staged['text']:
+        staged['error'] = "missing text"
+    elif len(staged['text']) > column_length(Message, 'text'):
+        staged['error'] = "text too long"
+
+    return staged
+
+
+def stage_follow(row):
+    """Staged row of a follows.csv row."""
+
+    staged = {
+        'followed_row': parse_int(row.get('user_being_followed_id')),
+        'following_row': parse_int(row.get('user_following_id')),
+        'error': None,
+    }
+
+    if None in (staged['followed_row'], staged['following_row']):
+        staged['error'] = "invalid user id"
+    elif staged['followed_row'] == staged['following_row']:
+        staged['error'] = "follows themselves"
+
+    return staged
+
+
+# File -> its staging table, and how to stage a row of it
+FILES = {
+    'users.csv': (staged_users, stage_user),
+    'messages.csv': (staged_messages, stage_message),
+    'follows.csv': (staged_follows, stage_follow),
+}
+
+
+##############################################################################
+# Checkpoints
+
+
+def get_position(step):
+    return db.session.scalar(
+        db.select(checkpoints.c.position).where(checkpoints.c.step == step))
+
+
+def set_position(step, position):
+    db.session.execute(
+        db.update(checkpoints)
+        .where(checkpoints.c.step == step)
+        .values(position=position))
+
+
+def report(step, done, total):
+    click.echo(f"{step}: {done}/{total}")
+
+
+##############################################################################
+# Steps
+
+
+def load(directory, name, batch_size):
+    """Copy the rows of CSV `name` not yet staged into its staging table."""
+
+    table, stage = FILES[name]
+    step = f"load {name}"
+    path = os.path.join(directory, name)
+    if not os.path.exists(path):
+        return
+
+    with open(path, newline='') as f:
+        total = sum(1 for _ in csv.DictReader(f))
+        f.seek(0)
+
+        done = get_position(step)
+        rows = itertools.islice(csv.DictReader(f), done, None)
+
+        while batch := list(itertools.islice(rows, batch_size)):
+            db.session.execute(
+                db.insert(table),
+                [{'row': done + n, **stage(row)}
+                 for n, row in enumerate(batch, start=1)])
+            done += len(batch)
+
+            set_position(step, done)
+            db.session.commit()
+            report(step, done, total)
+
+
+def reject(table, error, condition):
+    """Set `error` on rows of `table` matching `condition` and not rejected
+    yet."""
+
+    db.session.execute(
+        db.update(table)
+        .where(table.c.error.is_(None), condition)
+        .values(error=error))
+
+
+def matching_user_id(users):
+    """Id of the user with a staged row's username and email."""
+
+    return (db.select(User.id)
+            .where(User.username == users.c.username,
+                   User.email == users.c.email)
+            .scalar_subquery())
+
+
+def reject_taken(users, condition):
+    """Reject staged rows matching `condition` whose username or email
+    another user has."""
+
+    reject(users, "username taken", condition & db.exists().where(
+        User.username == users.c.username))
+    reject(users, "email taken", condition & db.exists().where(
+        User.email == users.c.email))
+
+
+def dedupe():
+    """Reject rows duplicating earlier ones, or referring to rejected users,
+    and match users to existing ones."""
+
+    if get_position('dedupe'):
+        return
+
+    users = staged_users
+    earlier = staged_users.alias('earlier')
+
+    # The first valid row of each username or email is kept
+    for field in ('username', 'email'):
+        reject(users, f"duplicate {field}", db.exists().where(
+            earlier.c[field] == users.c[field],
+            earlier.c.row < users.c.row,
+            earlier.c.error.is_(None)))
+
+    db.session.execute(
+        db.update(users)
+        .where(users.c.error.is_(None))
+        .values(user_id=matching_user_id(users)))
+
+    reject_taken(users, users.c.user_id.is_(None))
+
+    valid_rows = db.select(users.c.row).where(users.c.error.is_(None))
+
+    messages = staged_messages
+    earlier = staged_messages.alias('earlier')
+
+    reject(messages, "unknown user", messages.c.user_row.not_in(valid_rows))
+    reject(messages, "duplicate message", db.exists().where(
+        earlier.c.user_row == messages.c.user_row,
+        earlier.c.timestamp == messages.c.timestamp,
+        earlier.c.text == messages.c.text,
+        earlier.c.row < messages.c.row,
+        earlier.c.error.is_(None)))
+
+    follows = staged_follows
+    reject(follows, "unknown user",
+           follows.c.followed_row.not_in(valid_rows)
+           | follows.c.following_row.not_in(valid_rows))
+
+    set_position('dedupe', 1)
+    db.session.commit()
+    click.echo("dedupe: done")
+
+
+def insert_users(after, upto):
+    """Insert new users of staged rows `after` < row <= `upto`."""
+
+    users = staged_users
+    in_batch = (users.c.row > after) & (users.c.row <= upto)
+    columns = ['email', 'username', 'image_url', 'password', 'bio',
+               'header_image_url', 'location']
+
+    # Skipping users who signed up with the same email since `dedupe`
+    db.session.execute(
+        insert_ignore(User).from_select(
+            columns,
+            db.select(*(users.c[column] for column in columns))
+            .where(in_batch,
+                   users.c.error.is_(None),
+                   users.c.user_id.is_(None))))
+
+    db.session.execute(
+        db.update(users)
+        .where(in_batch, users.c.error.is_(None), users.c.user_id.is_(None))
+        .values(user_id=matching_user_id(users)))
+
+    reject_taken(users, in_batch & users.c.user_id.is_(None))
+
+
+def insert_messages(after, upto):
+    """Insert new messages of staged rows `after` < row <= `upto`.
+
+    Returns them, for the shards."""
+
+    messages = staged_messages
+    users = staged_users
+
+    new = (db.select(messages.c.text, messages.c.timestamp,
+                     users.c.user_id)
+           .join(users, users.c.row == messages.c.user_row)
+           .where(messages.c.row > after,
+                  messages.c.row <= upto,
+                  messages.c.error.is_(None),
+                  users.c.user_id.is_not(None),
+                  ~db.exists().where(
+                      Message.user_id == users.c.user_id,
+                      Message.timestamp == messages.c.timestamp,
+                      Message.text == messages.c.text)))
+
+    author_ids = db.session.scalars(
+        db.select(new.subquery().c.user_id).distinct()).all()
+
+    inserted = db.session.execute(
+        db.insert(Message)
+        .from_select(['text', 'timestamp', 'user_id'], new)
+        .returning(Message.id, Message.user_id, Message.text,
+                   Message.timestamp)).all()
+    bump_versions(author_ids)
+
+    return inserted
+
+
+def insert_follows(after, upto):
+    """Insert new follows of staged rows `after` < row <= `upto`."""
+
+    follows = staged_follows
+    followed = staged_users.alias('followed')
+    following = staged_users.alias('following')
+
+    new = (db.select(followed.c.user_id, following.c.user_id)
+           .select_from(follows)
+           .join(followed, followed.c.row == follows.c.followed_row)
+           .join(following, following.c.row == follows.c.following_row)
+           .where(follows.c.row > after,
+                  follows.c.row <= upto,
+                  follows.c.error.is_(None),
+                  followed.c.user_id != following.c.user_id,
+                  ~db.exists().where(
+                      Follow.user_being_followed_id == followed.c.user_id,
+                      Follow.user_following_id == following.c.user_id)))
+
+    pairs = db.session.execute(new).all()
+
+    db.session.execute(
+        insert_ignore(Follow).from_select(
+            ['user_being_followed_id', 'user_following_id'], new))
+    bump_versions({id for pair in pairs for id in pair})
+
+
+def bump_versions(user_ids):
+    # Not viewer.bump_versions: this needn't return the new versions
+    if user_ids:
+        db.session.execute(
+            db.update(User)
+            .where(User.id.in_(user_ids))
+            .values(state_version=User.state_version + 1))
+
+
+# Step -> staging table it goes through, and what it does for a range of
+# its rows (returning new messages, if any)
+INSERTS = {
+    'users': (staged_users, insert_users),
+    'messages': (staged_messages, insert_messages),
+    'follows': (staged_follows, insert_follows),
+}
+
+
+def insert(step, batch_size):
+    """Run insert step `step` on the staged rows it hasn't done yet."""
+
+    table, insert_batch = INSERTS[step]
+    total = db.session.scalar(db.select(db.func.count()).select_from(table))
+
+    done = get_position(step)
+    while done < total:
+        upto = min(done + batch_size, total)
+        messages = insert_batch(done, upto)
+
+        set_position(step, upto)
+        db.session.commit()
+
+        shards = current_app.extensions.get('shards')
+        if shards and messages:
+            update_after_commit(shards.add_messages, messages)
+        report(step, upto, total)
+        done = upto
+
+
+def summarize():
+    """Echo how many rows of each file were rejected, and why."""
+
+    for name, (table, _) in FILES.items():
+        total = db.session.scalar(
+            db.select(db.func.count()).select_from(table))
+        errors = db.session.execute(
+            db.select(table.c.error, db.func.count())
+            .where(table.c.error.is_not(None))
+            .group_by(table.c.error)
+            .order_by(table.c.error)).all()
+
+        rejected = sum(count for _, count in errors)
+        click.echo(f"{name}: {total - rejected} imported or already present, "
+                   f"{rejected} rejected")
+
+        for error, count in errors:
+            click.echo(f"    {error}: {count}")
+
+        examples = db.session.scalars(
+            db.select(table.c.row)
+            .where(table.c.error.is_not(None))
+            .order_by(table.c.row)
+            .limit(SHOW_REJECTED)).all()
+        if examples:
+            click.echo(f"    rows {', '.join(map(str, examples))}"
+                       f"{'...' if rejected > len(examples) else ''}")
+
+
+STEPS = ([f"load {name}" for name in FILES]
+         + ['dedupe']
+         + list(INSERTS))
+
+
+##############################################################################
+# Commands
+
+
+def get_source():
+    """Directory of the unfinished import, if any."""
+
+    if not db.inspect(db.engine).has_table(checkpoints.name):
+        return None
+
+    return db.session.scalar(db.select(checkpoints.c.source).limit(1))
+
+
+@cli.command('run')
+@click.argument('directory', type=click.Path(exists=True, file_okay=False))
+@click.option('--batch-size', default=IMPORT_BATCH_SIZE, show_default=True,
+              help="Rows per transaction.")
+def run_command(directory, batch_size):
+    """Import users.csv, messages.csv and follows.csv from DIRECTORY.
+
+    Carries on with an unfinished import of DIRECTORY."""
+
+    directory = os.path.abspath(directory)
+    if not os.path.exists(os.path.join(directory, 'users.csv')):
+        raise click.ClickException(f"No users.csv in {directory}.")
+
+    source = get_source()
+    if source and source != directory:
+        raise click.ClickException(
+            f"An import of {source} is unfinished: run it again to finish "
+            "it, or `flask imports abort`.")
+
+    # Not holding a transaction open across the DDL below (SQLite)
+    db.session.commit()
+
+    if source:
+        click.echo(f"Resuming import of {directory}.")
+    else:
+        staging.drop_all(db.engine)
+        staging.create_all(db.engine)
+        db.session.execute(
+            db.insert(checkpoints),
+            [{'step': step, 'position': 0, 'source': directory}
+             for step in STEPS])
+        db.session.commit()
+
+    for name in FILES:
+        load(directory, name, batch_size)
+    dedupe()
+    for step in INSERTS:
+        insert(step, batch_size)
+
+    summarize()
+    db.session.commit()
+    staging.drop_all(db.engine)
+
+    if feed.FEED_FANOUT:
+        click.echo("Run `flask feed rebuild` to add new messages to feeds.")
+
+
+@cli.command('status')
+def status_command():
+    """Show how far an unfinished import got."""
+
+    source = get_source()
+    if not source:
+        click.echo("No import in progress.")
+        return
+
+    positions = dict(db.session.execute(
+        db.select(checkpoints.c.step, checkpoints.c.position)).all())
+
+    click.echo(f"Importing {source}:")
+    for step in STEPS:
+        click.echo(f"    {step}: {positions[step]}")
+
+
+@cli.command('abort')
+def abort_command():
+    """Drop an unfinished import; rows it inserted stay."""
+
+    db.session.commit()
+    staging.drop_all(db.engine)
+    click.echo("Import dropped.")
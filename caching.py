@@ -0,0 +1,87 @@
+"""Per-route HTTP caching of pages anyone can see.
+
+Dynamic pages are sent `Cache-Control: no-store` (see `add_header` in
+app.py). A view decorated with `cache_policy` is instead cacheable by
+browsers and by shared caches (CDNs, reverse proxies) when it's rendered
+for an anonymous visitor:
+
+    Cache-Control: public, max-age=<max_age>, s-maxage=<s_maxage>,
+                   stale-while-revalidate=<stale_while_revalidate>
+    Vary: Cookie
+    ETag: <hash of the page>
+
+A page counts as anonymous when the request brought no session and the
+response doesn't start one, so pages for logged-in users, pages showing a
+flashed message and pages with a CSRF token stay `no-store`. `Vary: Cookie`
+keeps caches from answering requests with a session cookie from the
+anonymous copy; caches that ignore Vary must be told to bypass requests
+carrying the session cookie. Conditional requests get a 304 while the page
+is unchanged, so revalidating a stale copy costs rendering it, but not
+sending it.
+"""
+
+from typing import NamedTuple
+
+from flask import current_app, request, session
+
+
+class CachePolicy(NamedTuple):
+    """How long caches may keep a page, in seconds."""
+
+    max_age: int
+    s_maxage: int
+    stale_while_revalidate: int
+
+
+def cache_policy(max_age, s_maxage=None, stale_while_revalidate=0):
+    """Let a view's anonymous responses be cached: by browsers for
+    `max_age` seconds, by shared caches for `s_maxage` (default `max_age`),
+    and served stale for up to `stale_while_revalidate` more while they're
+    refetched.
+
+    Goes below the route decorator."""
+
+    policy = CachePolicy(
+        max_age,
+        max_age if s_maxage is None else s_maxage,
+        stale_while_revalidate)
+
+    def decorator(view):
+        view.cache_policy = policy
+        return view
+
+    return decorator
+
+
+def is_anonymous():
+    """Does the response depend on no session?"""
+
+    return getattr(session, 'new', False) and not session
+
+
+def apply_cache_policy(response):
+    """Make `response` cacheable if its view has a policy and the page is
+    anonymous; return whether it was."""
+
+    view = current_app.view_functions.get(request.endpoint)
+    policy = getattr(view, 'cache_policy', None)
+
+    if (policy is None
+            or request.method not in ('GET', 'HEAD')
+            or response.status_code != 200
+            or not is_anonymous()):
+        return False
+
+    response.cache_control.public = True
+    response.cache_control.max_age = policy.max_age
+    response.cache_control.s_maxage = policy.s_maxage
+    if policy.stale_while_revalidate:
+        response.cache_control['stale-while-revalidate'] = str(
+            policy.stale_while_revalidate)
+    response.vary.add('Cookie')
+
+    if not response.is_streamed:
+        response.add_etag()
+        response.make_conditional(request)
+
+    return True
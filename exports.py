@@ -0,0 +1,272 @@
+"""Archives of a user's data, built in the background.
+
+Asking for an export adds a row to `exports` and queues building it on a
+pool of EXPORT_WORKERS threads in this process; the user's exports page
+shows its status, and links to the zip once it's built:
+
+    profile.<format>      the user's profile fields
+    messages.<format>     their messages
+    likes.<format>        messages they liked, with their authors
+    following.<format>    users they follow
+    followers.<format>    users following them
+
+in NDJSON (one JSON object per line) or CSV (with a header row). Rows are
+read through a server-side cursor, EXPORT_BATCH_SIZE at a time, and
+written straight into the compressed zip entry, so building an export
+takes the same memory whatever the size of the account. Zips are written
+to EXPORT_DIR as `<id>.zip.part`, renamed to `<id>.zip` when complete, and
+served with `send_file`, which answers Range requests, so an interrupted
+download can be resumed.
+
+Exports are kept for EXPORT_TTL_HOURS; one that's still queued or being
+built after EXPORT_TIMEOUT_MINUTES was lost with its process and counts as
+failed. `flask exports purge` deletes both kinds, with their files.
+
+Databases created before exports existed need:
+
+    CREATE TABLE exports (
+        id SERIAL PRIMARY KEY,
+        user_id INTEGER NOT NULL REFERENCES users ON DELETE CASCADE,
+        format VARCHAR(10) NOT NULL,
+        status VARCHAR(10) NOT NULL,
+        size BIGINT,
+        created TIMESTAMP NOT NULL,
+        finished TIMESTAMP);
+    CREATE INDEX ix_exports_user_id ON exports (user_id);
+"""
+
+import csv
+import io
+import json
+import os
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+import click
+from flask import current_app
+from flask.cli import AppGroup
+
+from models import db, User, Message, Like, Follow, Export
+
+EXPORT_DIR = os.environ.get('EXPORT_DIR', 'exports')
+EXPORT_WORKERS = int(os.environ.get('EXPORT_WORKERS', 2))
+EXPORT_TTL = timedelta(hours=int(os.environ.get('EXPORT_TTL_HOURS', 48)))
+EXPORT_TIMEOUT = timedelta(
+    minutes=int(os.environ.get('EXPORT_TIMEOUT_MINUTES', 60)))
+EXPORT_BATCH_SIZE = 1000
+
+FORMATS = {'ndjson': "NDJSON", 'csv': "CSV"}
+
+cli = AppGroup('exports', help="Manage users' data exports.")
+
+
+def profile_select(user_id):
+    return (db.select(User.id, User.username, User.email, User.bio,
+                      User.location, User.image_url, User.header_image_url)
+            .where(User.id == user_id))
+
+
+def messages_select(user_id):
+    return (db.select(Message.id, Message.text, Message.timestamp)
+            .where(Message.user_id == user_id)
+            .order_by(Message.timestamp, Message.id))
+
+
+def likes_select(user_id):
+    return (db.select(Message.id.label('message_id'),
+                      User.username.label('author'),
+                      Message.text, Message.timestamp)
+            .join(Like, Like.message_id == Message.id)
+            .join(User, User.id == Message.user_id)
+            .where(Like.user_id == user_id)
+            .order_by(Message.timestamp, Message.id))
+
+
+def following_select(user_id):
+    return (db.select(User.id, User.username)
+            .join(Follow, Follow.user_being_followed_id == User.id)
+            .where(Follow.user_following_id == user_id)
+            .order_by(User.id))
+
+
+def followers_select(user_id):
+    return (db.select(User.id, User.username)
+            .join(Follow, Follow.user_following_id == User.id)
+            .where(Follow.user_being_followed_id == user_id)
+            .order_by(User.id))
+
+
+# Name -> select of the rows of that file, for a user id
+FILES = {
+    'profile': profile_select,
+    'messages': messages_select,
+    'likes': likes_select,
+    'following': following_select,
+    'followers': followers_select,
+}
+
+
+def plain(value):
+    return value.isoformat() if isinstance(value, datetime) else value
+
+
+def write_ndjson(out, columns, rows):
+    for row in rows:
+        out.write(json.dumps(
+            {column: plain(value) for column, value in zip(columns, row)}))
+        out.write('\n')
+
+
+def write_csv(out, columns, rows):
+    writer = csv.writer(out)
+    writer.writerow(columns)
+    for row in rows:
+        writer.writerow(plain(value) for value in row)
+
+
+WRITERS = {'ndjson': write_ndjson, 'csv': write_csv}
+
+
+def write_archive(path, user_id, format, batch_size=EXPORT_BATCH_SIZE):
+    """Write user `user_id`'s data to a zip at `path`."""
+
+    write = WRITERS[format]
+
+    with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as archive:
+        for name, select in FILES.items():
+            result = db.session.execute(
+                select(user_id),
+                execution_options={'yield_per': batch_size})
+
+            with archive.open(f"{name}.{format}", 'w',
+                              force_zip64=True) as entry:
+                out = io.TextIOWrapper(entry, encoding='utf-8', newline='')
+                write(out, list(result.keys()), result)
+                out.flush()
+                out.detach()
+
+
+def export_status(export):
+    """`export`'s status, 'failed' if it was queued or being built by a
+    process that's gone."""
+
+    if (export.status in ('pending', 'running')
+            and export.created < datetime.utcnow() - EXPORT_TIMEOUT):
+        return 'failed'
+
+    return export.status
+
+
+class Exporter:
+    """Builds exports on a pool of background threads."""
+
+    def __init__(self, directory=EXPORT_DIR, workers=EXPORT_WORKERS):
+        self.directory = directory
+        self.workers = workers
+        self.app = None
+        self._executor = None
+
+    def init_app(self, app):
+        self.app = app
+        app.extensions['exporter'] = self
+
+    def path(self, export):
+        return os.path.join(self.directory, f"{export.id}.zip")
+
+    def start(self, user_id, format):
+        """Queue an export of user `user_id`'s data; return a future of its
+        final status."""
+
+        export = Export(user_id=user_id, format=format, status='pending')
+        db.session.add(export)
+        db.session.commit()
+
+        # Started lazily, so processes that never export have no threads
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(
+                self.workers, thread_name_prefix='export')
+
+        return self._executor.submit(self.build, export.id)
+
+    def build(self, export_id):
+        """Build export `export_id`, in an app context of its own."""
+
+        with self.app.app_context():
+            export = db.session.get(Export, export_id)
+            user_id, format = export.user_id, export.format
+            path = self.path(export)
+            tmp = f"{path}.part"
+
+            export.status = 'running'
+            db.session.commit()
+
+            try:
+                # One snapshot for every file of the archive
+                if db.engine.dialect.name == 'postgresql':
+                    db.session.connection(execution_options={
+                        'isolation_level': 'REPEATABLE READ'})
+
+                os.makedirs(self.directory, exist_ok=True)
+                write_archive(tmp, user_id, format)
+                db.session.rollback()
+                os.replace(tmp, path)
+
+            except Exception:
+                self.app.logger.exception("Export %s failed", export_id)
+                db.session.rollback()
+                export.status = 'failed'
+                if os.path.exists(tmp):
+                    os.remove(tmp)
+
+            else:
+                export.status = 'done'
+                export.size = os.path.getsize(path)
+
+            export.finished = datetime.utcnow()
+            db.session.commit()
+
+            return export.status
+
+    def remove(self, exports):
+        """Delete `exports` and their files, before committing."""
+
+        for export in exports:
+            for path in (self.path(export), f"{self.path(export)}.part"):
+                if os.path.exists(path):
+                    os.remove(path)
+            db.session.delete(export)
+
+    def purge(self):
+        """Delete expired and lost exports; return how many."""
+
+        now = datetime.utcnow()
+        exports = db.session.scalars(
+            db.select(Export).where(
+                ((Export.status.in_(['done', 'failed']))
+                 & (Export.finished < now - EXPORT_TTL))
+                | ((Export.status.in_(['pending', 'running']))
+                   & (Export.created < now - EXPORT_TIMEOUT)))).all()
+
+        self.remove(exports)
+        db.session.commit()
+        return len(exports)
+
+
+def user_exports(user_id):
+    """User `user_id`'s exports that haven't expired, newest first."""
+
+    return db.session.scalars(
+        db.select(Export)
+        .where(Export.user_id == user_id,
+               db.or_(Export.finished.is_(None),
+                      Export.finished >= datetime.utcnow() - EXPORT_TTL))
+        .order_by(Export.created.desc(), Export.id.desc())).all()
+
+
+@cli.command('purge')
+def purge_command():
+    """Delete expired exports and their files."""
+
+    count = current_app.extensions['exporter'].purge()
+    click.echo(f"Deleted {count} exports.")
@@ -0,0 +1,237 @@
+"""Hybrid home feeds: fan-out on write, and on read for celebrities.
+
+With FEED_FANOUT=1, a new message is copied into the feed (`feed_entries`)
+of each of its author's followers as it's posted, so reading a feed is a
+range scan of the reader's own entries rather than a sort of every
+followed user's messages. Copying a message to a million followers would
+make posting it slow, though, so a user found, as they post, to have
+FEED_CELEBRITY_THRESHOLD followers or more becomes a `celebrity` (counting
+stops at the threshold, on the follows primary key, before anything is
+copied): their
+messages are no longer copied, and feeds merge them in at read time from
+the messages index on (user_id, timestamp), along with the reader's own.
+
+    post      count followers up to the threshold, then one
+              INSERT ... SELECT from follows, unless a celebrity
+    follow    copy the followed user's newest FEED_BACKFILL messages
+    unfollow  delete their entries from the follower's feed
+    read      newest entries, plus followed celebrities' and own messages
+
+Feeds only need their newest entries; `flask feed trim` keeps
+FEED_INBOX_SIZE per user. Users stay celebrities once they are;
+`flask feed rebuild` recomputes who is from follower counts, and refills
+every feed. Run it before turning FEED_FANOUT on: messages and follows
+written while it's off aren't copied.
+
+Databases created before feeds existed need:
+
+    ALTER TABLE users ADD COLUMN celebrity BOOLEAN NOT NULL DEFAULT false;
+    CREATE TABLE feed_entries (
+        user_id INTEGER REFERENCES users ON DELETE CASCADE,
+        message_id INTEGER,
+        author_id INTEGER NOT NULL REFERENCES users ON DELETE CASCADE,
+        timestamp TIMESTAMP NOT NULL,
+        PRIMARY KEY (user_id, message_id));
+    CREATE INDEX ix_feed_entries_user_id_timestamp
+        ON feed_entries (user_id, timestamp DESC);
+    CREATE INDEX ix_feed_entries_message_id ON feed_entries (message_id);
+"""
+
+import os
+
+import click
+from flask.cli import AppGroup
+
+from models import db, insert_ignore, User, Message, Follow, FeedEntry
+from readmodels import feed_query
+
+FEED_FANOUT = os.environ.get('FEED_FANOUT') == '1'
+FEED_CELEBRITY_THRESHOLD = int(
+    os.environ.get('FEED_CELEBRITY_THRESHOLD', 10_000))
+FEED_BACKFILL = 100
+FEED_INBOX_SIZE = 1000
+
+cli = AppGroup('feed', help="Manage home feeds.")
+
+ENTRY_COLUMNS = ['user_id', 'message_id', 'author_id', 'timestamp']
+
+
+def fan_out(message):
+    """Copy `message` into its author's followers' feeds, before committing
+    it; returns how many.
+
+    Nothing is copied for celebrities; an author found to have
+    FEED_CELEBRITY_THRESHOLD followers becomes one."""
+
+    if not FEED_FANOUT:
+        return 0
+
+    db.session.flush()
+    if db.session.scalar(
+            db.select(User.celebrity).where(User.id == message.user_id)):
+        return 0
+
+    if count_followers(message.user_id,
+                       FEED_CELEBRITY_THRESHOLD) >= FEED_CELEBRITY_THRESHOLD:
+        db.session.execute(
+            db.update(User)
+            .where(User.id == message.user_id)
+            .values(celebrity=True))
+        return 0
+
+    return db.session.execute(
+        db.insert(FeedEntry).from_select(
+            ENTRY_COLUMNS,
+            db.select(Follow.user_following_id,
+                      db.literal(message.id),
+                      db.literal(message.user_id),
+                      db.literal(message.timestamp, db.DateTime))
+            .where(Follow.user_being_followed_id == message.user_id),
+        )).rowcount
+
+
+def count_followers(user_id, limit):
+    """Count user `user_id`'s followers, up to `limit`."""
+
+    followers = (db.select(db.literal(1))
+                 .where(Follow.user_being_followed_id == user_id)
+                 .limit(limit)
+                 .subquery())
+
+    return db.session.scalar(
+        db.select(db.func.count()).select_from(followers))
+
+
+def backfill_select(followers):
+    """Select feed entries for the newest FEED_BACKFILL messages of each
+    non-celebrity followed by `followers` (a select of follower, followed
+    id pairs)."""
+
+    followers = followers.subquery()
+    follower_id, followed_id = followers.c
+
+    ranked = (db.select(
+        follower_id.label('follower_id'),
+        Message.id, Message.user_id, Message.timestamp,
+        db.func.row_number().over(
+            partition_by=(follower_id, Message.user_id),
+            order_by=Message.timestamp.desc()).label('rank'))
+        .join(Message, Message.user_id == followed_id)
+        .join(User, User.id == Message.user_id)
+        .where(User.celebrity.is_(False))
+        .subquery())
+
+    return (db.select(ranked.c.follower_id, ranked.c.id, ranked.c.user_id,
+                      ranked.c.timestamp)
+            .where(ranked.c.rank <= FEED_BACKFILL))
+
+
+def add_follows(follower_id, followed_ids):
+    """Copy the newest messages of users `follower_id` just followed into
+    their feed."""
+
+    if not FEED_FANOUT or not followed_ids:
+        return
+
+    db.session.execute(
+        insert_ignore(FeedEntry).from_select(
+            ENTRY_COLUMNS,
+            backfill_select(
+                db.select(db.literal(follower_id), User.id)
+                .where(User.id.in_(followed_ids)))))
+
+
+def remove_follows(follower_id, followed_ids):
+    """Remove messages of users `follower_id` unfollowed from their feed."""
+
+    if not FEED_FANOUT or not followed_ids:
+        return
+
+    db.session.execute(
+        db.delete(FeedEntry)
+        .where(FeedEntry.user_id == follower_id,
+               FeedEntry.author_id.in_(followed_ids)))
+
+
+def remove_messages(message_ids):
+    """Remove deleted messages from every feed."""
+
+    db.session.execute(
+        db.delete(FeedEntry).where(FeedEntry.message_id.in_(message_ids)))
+
+
+def home_query(user_id, following_ids, limit, since=None, shards=None):
+    """Feed query of the messages in user `user_id`'s home feed (newer
+    than `since`, if given), for the newest `limit` to be taken from.
+
+    `following_ids` are the ids of the users they follow. Without
+    FEED_FANOUT, the newest messages are found on `shards` (a
+    shards.ShardSet), if given."""
+
+    if not FEED_FANOUT:
+        if shards:
+            return feed_query().filter(Message.id.in_(
+                shards.newest_ids([user_id, *following_ids], limit, since)))
+        return feed_query().filter(
+            Message.user_id.in_([user_id, *following_ids]))
+
+    entries = (db.select(FeedEntry.message_id)
+               .where(FeedEntry.user_id == user_id)
+               .order_by(FeedEntry.timestamp.desc())
+               .limit(limit))
+    if since is not None:
+        entries = entries.where(FeedEntry.timestamp > since)
+
+    celebrity_ids = db.session.scalars(
+        db.select(User.id)
+        .where(User.id.in_(following_ids), User.celebrity)).all()
+
+    return feed_query().filter(
+        Message.id.in_(db.session.scalars(entries).all())
+        | Message.user_id.in_([user_id, *celebrity_ids]))
+
+
+@cli.command('rebuild')
+@click.option('--threshold', default=FEED_CELEBRITY_THRESHOLD,
+              show_default=True,
+              help="Followers making a user a celebrity.")
+def rebuild_command(threshold):
+    """Recompute celebrities, and refill every feed."""
+
+    followers = (db.select(db.func.count())
+                 .where(Follow.user_being_followed_id == User.id)
+                 .scalar_subquery())
+    db.session.execute(db.update(User).values(
+        celebrity=followers >= threshold))
+
+    db.session.execute(db.delete(FeedEntry))
+    db.session.execute(
+        insert_ignore(FeedEntry).from_select(
+            ENTRY_COLUMNS,
+            backfill_select(db.select(Follow.user_following_id,
+                                      Follow.user_being_followed_id))))
+    db.session.commit()
+
+    celebrities = db.session.scalar(
+        db.select(db.func.count()).where(User.celebrity))
+    click.echo(f"Rebuilt feeds; {celebrities} celebrities.")
+
+
+@cli.command('trim')
+def trim_command():
+    """Keep only the newest FEED_INBOX_SIZE entries of each feed."""
+
+    ranked = db.select(
+        FeedEntry.user_id, FeedEntry.message_id,
+        db.func.row_number().over(
+            partition_by=FeedEntry.user_id,
+            order_by=FeedEntry.timestamp.desc()).label('rank')).subquery()
+
+    deleted = db.session.execute(
+        db.delete(FeedEntry).where(
+            db.tuple_(FeedEntry.user_id, FeedEntry.message_id).in_(
+                db.select(ranked.c.user_id, ranked.c.message_id)
+                .where(ranked.c.rank > FEED_INBOX_SIZE)))).rowcount
+    db.session.commit()
+
+    click.echo(f"Deleted {deleted} feed entries.")
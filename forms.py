@@ -1,5 +1,5 @@
 from flask_wtf import FlaskForm
-from wtforms import StringField, PasswordField, TextAreaField
+from wtforms import StringField, PasswordField, TextAreaField, SelectField
 from wtforms.validators import InputRequired, Email, Length, URL, Optional
 
 
@@ -91,3 +91,12 @@ class EditProfileForm(FlaskForm):
         'Password',
         validators=[InputRequired(), Length(min=6, max=50)],
     )
+
+
+class ExportForm(FlaskForm):
+    """Form for exporting a user's data."""
+
+    format = SelectField(
+        'Format',
+        choices=[('ndjson', "NDJSON"), ('csv', "CSV")],
+    )
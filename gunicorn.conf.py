@@ -0,0 +1,38 @@
+"""Gunicorn settings: workers share metrics through files (see metrics.py).
+
+    gunicorn --workers 4 app:app
+
+Each worker serves requests on GUNICORN_THREADS threads, and lets half of
+them hold timeline streams (MAX_WSGI_STREAMS, see `stream_messages` in
+app.py), so open homepages can't take every thread.
+"""
+
+import os
+import shutil
+import tempfile
+
+worker_class = 'gthread'
+threads = int(os.environ.get('GUNICORN_THREADS', 16))
+
+# Set before workers import app
+os.environ.setdefault('MAX_WSGI_STREAMS', str(threads // 2))
+
+# Set before workers import prometheus_client
+metrics_dir = os.environ.setdefault(
+    'PROMETHEUS_MULTIPROC_DIR',
+    os.path.join(tempfile.gettempdir(), 'warbler-metrics'))
+
+
+def on_starting(server):
+    """Start with no metrics left by an earlier run."""
+
+    shutil.rmtree(metrics_dir, ignore_errors=True)
+    os.makedirs(metrics_dir)
+
+
+def child_exit(server, worker):
+    """Stop counting an exited worker's live gauges."""
+
+    from prometheus_client import multiprocess
+
+    multiprocess.mark_process_dead(worker.pid)
@@ -0,0 +1,340 @@
+"""Image proxy: resized, locally cached copies of users' images.
+
+Users' `image_url` and `header_image_url` point anywhere on the web, often
+at images many times the size they're shown at. Pages instead link to
+`thumbnail_url(url, size)`, served by the `show_image` route: the first
+request for a URL fetches it once and resizes it into every size in SIZES;
+those thumbnails are kept on disk and served with long-lived cache headers.
+
+Cache layout, under IMAGE_CACHE_DIR:
+
+    urls/<sha256 of URL>                  sha256 of the image at that URL
+    thumbs/<ab>/<sha256>-<size>.webp      thumbnails, by source image
+
+so URLs pointing at the same image share thumbnails. Once the cache holds
+more than IMAGE_CACHE_MAX_BYTES, the least recently served files are
+evicted (hits refresh a file's mtime).
+
+Thumbnail URLs are signed with SECRET_KEY, so the proxy only fetches URLs
+that the app itself put in a page; fetches of hosts resolving to private
+addresses are refused regardless. Each hop's host is resolved once, and
+the connection made to the address that was checked, so a name that
+resolves somewhere else by the time urllib connects (DNS rebinding) can't
+get around that.
+"""
+
+import hashlib
+import hmac
+import http.client
+import io
+import ipaddress
+import os
+import socket
+import threading
+import urllib.request
+from urllib.parse import quote, urlsplit
+
+from PIL import Image, ImageOps
+
+from metrics import record_lookup
+
+IMAGE_CACHE_DIR = os.environ.get('IMAGE_CACHE_DIR', 'image_cache')
+IMAGE_CACHE_MAX_BYTES = int(
+    os.environ.get('IMAGE_CACHE_MAX_BYTES', 512 * 1024 * 1024))
+
+# Width, height in pixels: twice the CSS size, for high-density screens
+SIZES = {
+    'avatar': (96, 96),         # .timeline-image
+    'card': (140, 140),         # .card-image
+    'profile': (400, 400),      # #profile-avatar
+    'card-header': (640, 320),  # .card-hero
+    'header': (1920, 720),      # #warbler-hero
+}
+
+MAX_SOURCE_BYTES = 10 * 1024 * 1024
+MAX_SOURCE_PIXELS = 40_000_000
+FETCH_TIMEOUT = 5
+THUMBNAIL_QUALITY = 80
+
+# A proxy URL's thumbnail is made once and kept, so browsers can keep it too
+CACHE_MAX_AGE = 365 * 24 * 60 * 60
+
+# Evict down to this fraction of the limit, so eviction doesn't run on
+# every new image once the cache is full.
+EVICT_TO = 0.9
+
+
+class ImageFetchError(Exception):
+    """The source image couldn't be fetched or decoded."""
+
+
+def sign(secret_key, url, size):
+    return hmac.new(
+        secret_key.encode(), f"{size}:{url}".encode(), hashlib.sha256,
+    ).hexdigest()[:32]
+
+
+def thumbnail_url(secret_key, url, size):
+    """Return the proxy URL for `url` resized to `size`.
+
+    URLs that aren't http(s) (e.g. our own static files) are returned as
+    they are."""
+
+    if urlsplit(url or '').scheme not in ('http', 'https'):
+        return url
+
+    return f"/images/{size}/{sign(secret_key, url, size)}?url={quote(url)}"
+
+
+def check_host(url):
+    """Return an address of `url`'s host to connect to.
+
+    Raises ImageFetchError unless the host has only public addresses."""
+
+    host = urlsplit(url).hostname
+    try:
+        addresses = [info[4][0] for info in socket.getaddrinfo(
+            host, None, type=socket.SOCK_STREAM)]
+    except (socket.gaierror, UnicodeError) as e:
+        raise ImageFetchError(f"Can't resolve {host}") from e
+
+    for address in addresses:
+        if not ipaddress.ip_address(address.split('%')[0]).is_global:
+            raise ImageFetchError(f"{host} isn't a public address")
+
+    return addresses[0]
+
+
+def pinned(connection_class, address):
+    """`connection_class` (HTTPConnection or HTTPSConnection), connecting to
+    `address` rather than resolving its host again.
+
+    The host is still what the Host header, and TLS's SNI and certificate
+    check, are for."""
+
+    class PinnedConnection(connection_class):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            self._create_connection = (
+                lambda host_port, *args: socket.create_connection(
+                    (address, host_port[1]), *args))
+
+    return PinnedConnection
+
+
+class PinnedHTTPHandler(urllib.request.HTTPHandler):
+    def http_open(self, req):
+        return self.do_open(
+            pinned(http.client.HTTPConnection, check_host(req.full_url)),
+            req)
+
+
+class PinnedHTTPSHandler(urllib.request.HTTPSHandler):
+    def https_open(self, req):
+        return self.do_open(
+            pinned(http.client.HTTPSConnection, check_host(req.full_url)),
+            req, context=self._context)
+
+
+class CheckedRedirectHandler(urllib.request.HTTPRedirectHandler):
+    """Follows redirects to http(s) URLs only, which are opened by the
+    same handlers, so each hop is checked and pinned."""
+
+    def redirect_request(self, req, fp, code, msg, headers, newurl):
+        if urlsplit(newurl).scheme not in ('http', 'https'):
+            raise ImageFetchError(f"Not an http(s) URL: {newurl}")
+        return super().redirect_request(req, fp, code, msg, headers, newurl)
+
+
+def fetch(url, allow_private=False):
+    """Return the bytes of the image at `url`."""
+
+    if urlsplit(url).scheme not in ('http', 'https'):
+        raise ImageFetchError(f"Not an http(s) URL: {url}")
+
+    if allow_private:
+        opener = urllib.request.build_opener(CheckedRedirectHandler())
+    else:
+        # No proxies: the connection must go to the checked address
+        opener = urllib.request.build_opener(
+            urllib.request.ProxyHandler({}), PinnedHTTPHandler(),
+            PinnedHTTPSHandler(), CheckedRedirectHandler())
+    request = urllib.request.Request(
+        url, headers={'User-Agent': 'Warbler image proxy'})
+
+    try:
+        with opener.open(request, timeout=FETCH_TIMEOUT) as response:
+            data = response.read(MAX_SOURCE_BYTES + 1)
+    except (OSError, ValueError) as e:
+        raise ImageFetchError(f"Can't fetch {url}: {e}") from e
+
+    if len(data) > MAX_SOURCE_BYTES:
+        raise ImageFetchError(f"{url} is too large")
+
+    return data
+
+
+def make_thumbnails(data):
+    """Return {size: WebP bytes} for the image in `data`, one per size."""
+
+    try:
+        with Image.open(io.BytesIO(data)) as image:
+            if image.width * image.height > MAX_SOURCE_PIXELS:
+                raise ImageFetchError("Image has too many pixels")
+
+            image = ImageOps.exif_transpose(image)
+            image = image.convert('RGBA' if 'A' in image.getbands() else 'RGB')
+
+    except (OSError, Image.DecompressionBombError) as e:
+        raise ImageFetchError(f"Not a usable image: {e}") from e
+
+    thumbnails = {}
+    for size, dimensions in SIZES.items():
+        thumbnail = ImageOps.fit(image, dimensions, Image.LANCZOS)
+        out = io.BytesIO()
+        thumbnail.save(out, 'WEBP', quality=THUMBNAIL_QUALITY)
+        thumbnails[size] = out.getvalue()
+
+    return thumbnails
+
+
+def _write(path, data):
+    """Write `data` to `path` atomically."""
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp, 'wb') as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+
+class ImageCache:
+    """Content-addressed, size-bounded on-disk cache of thumbnails."""
+
+    def __init__(self, directory=IMAGE_CACHE_DIR,
+                 max_bytes=IMAGE_CACHE_MAX_BYTES, allow_private=False):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.allow_private = allow_private
+        self._lock = threading.Lock()
+        self._fetching = {}
+        self._size = None
+
+    def _url_path(self, url):
+        key = hashlib.sha256(url.encode()).hexdigest()
+        return os.path.join(self.directory, 'urls', key)
+
+    def _thumb_path(self, digest, size):
+        return os.path.join(
+            self.directory, 'thumbs', digest[:2], f"{digest}-{size}.webp")
+
+    def _cached(self, url, size):
+        """Return (path, digest) of a cached thumbnail, or None."""
+
+        url_path = self._url_path(url)
+        try:
+            with open(url_path) as f:
+                digest = f.read()
+        except FileNotFoundError:
+            return None
+
+        path = self._thumb_path(digest, size)
+        try:
+            os.utime(path)
+            os.utime(url_path)
+        except FileNotFoundError:
+            return None
+
+        return path, digest
+
+    def get(self, url, size):
+        """Return (path, digest) of `url`'s thumbnail at `size`.
+
+        Fetches and resizes the image if it isn't cached; raises
+        ImageFetchError if that fails."""
+
+        cached = self._cached(url, size)
+        record_lookup('images', hit=bool(cached))
+        if cached:
+            return cached
+
+        # One fetch per URL at a time; other requests wait for it.
+        with self._lock:
+            lock = self._fetching.setdefault(url, threading.Lock())
+
+        with lock:
+            try:
+                cached = self._cached(url, size)
+                if cached:
+                    return cached
+
+                data = fetch(url, allow_private=self.allow_private)
+                digest = hashlib.sha256(data).hexdigest()
+
+                # Another URL may have had the same image.
+                if os.path.exists(self._thumb_path(digest, size)):
+                    thumbnails = {}
+                else:
+                    thumbnails = make_thumbnails(data)
+
+                return self._store(url, digest, thumbnails, size)
+
+            finally:
+                with self._lock:
+                    self._fetching.pop(url, None)
+
+    def _store(self, url, digest, thumbnails, size):
+        """Store `url`'s `thumbnails`; return `get`'s result for `size`."""
+
+        files = {self._thumb_path(digest, name): thumbnail
+                 for name, thumbnail in thumbnails.items()}
+        files[self._url_path(url)] = digest.encode()
+
+        for path, data in files.items():
+            _write(path, data)
+
+        with self._lock:
+            if self._size is None:
+                self._size = self._disk_usage()
+            else:
+                self._size += sum(len(data) for data in files.values())
+
+            if self._size > self.max_bytes:
+                self._size = self._evict(keep=files.keys())
+
+        return self._thumb_path(digest, size), digest
+
+    def _files(self):
+        for root, dirs, files in os.walk(self.directory):
+            for name in files:
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                yield path, stat
+
+    def _disk_usage(self):
+        return sum(stat.st_size for path, stat in self._files())
+
+    def _evict(self, keep=()):
+        """Delete least recently used files, except those in `keep`.
+
+        Returns the remaining size."""
+
+        files = sorted(self._files(), key=lambda file: file[1].st_mtime)
+        size = sum(stat.st_size for path, stat in files)
+        target = self.max_bytes * EVICT_TO
+
+        for path, stat in files:
+            if size <= target:
+                break
+            if path in keep:
+                continue
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            size -= stat.st_size
+
+        return size
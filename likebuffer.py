@@ -0,0 +1,341 @@
+"""Write-behind buffering of likes and unlikes.
+
+With LIKE_BUFFER_DIR set, liking or unliking a message doesn't write the
+`likes` table: the event is appended to a log file in that directory
+(flushed and fsync'd, so it survives a crash) and kept in memory, and a
+background thread writes the events buffered so far every
+LIKE_FLUSH_MS milliseconds, or as soon as LIKE_FLUSH_SIZE are waiting, in
+one transaction of a few multi-row statements. That transaction also bumps
+the likers' `state_version` (see viewer.py).
+
+Until their events are written, `overlay(user_id)` gives a user's pending
+likes and unlikes, which the pages listing or counting likes, and their
+`ViewerState`, apply on top of what the database says. Only the process
+that buffered an event knows of it, so the acting user's session also
+keeps their own for PENDING_SECONDS (`remember_pending`), and `overlay`
+applies those too: whichever worker serves their next request, they see
+their like. The session key is merged, not overwritten, when saved (see
+`merge_pending`), so another of their requests saving the session
+meanwhile doesn't lose it.
+
+Each process logs to its own files,
+
+    likes.<pid>.lock        held (flock) while the process runs
+    likes.<pid>.<n>.log     events since the nth flush began
+
+and deletes a log once its events are committed. On start, logs of
+processes that are gone (their lock is free) are replayed, oldest first,
+and deleted. Replaying is idempotent: a like adds the row if it's missing,
+an unlike deletes it if it's there. Events are acknowledged once logged,
+so a crash loses none, but one process's events can be written after
+later events of another's.
+"""
+
+import atexit
+import fcntl
+import glob
+import json
+import os
+import re
+import threading
+import time
+from typing import NamedTuple
+
+from models import db, insert_ignore, User, Message, Like
+
+LIKE_BUFFER_DIR = os.environ.get('LIKE_BUFFER_DIR')
+LIKE_FLUSH_MS = int(os.environ.get('LIKE_FLUSH_MS', 200))
+LIKE_FLUSH_SIZE = int(os.environ.get('LIKE_FLUSH_SIZE', 500))
+
+# How long a session keeps its user's buffered likes: long after every
+# process has flushed them
+PENDING_SECONDS = max(5, 10 * LIKE_FLUSH_MS / 1000)
+PENDING_KEY = "pending_likes"
+
+LOG_NAME = re.compile(r'likes\.(\d+)\.(\d+)\.log$')
+
+
+class Overlay(NamedTuple):
+    """A user's likes and unlikes not yet in the database."""
+
+    liked: frozenset
+    unliked: frozenset
+
+
+def read_log(path):
+    """Return the (user_id, message_id, liked) events logged in `path`.
+
+    A last line cut short by a crash is skipped: it was never
+    acknowledged."""
+
+    events = []
+
+    with open(path) as f:
+        for line in f:
+            try:
+                user_id, message_id, liked = json.loads(line)
+            except ValueError:
+                break
+            events.append((user_id, message_id, liked))
+
+    return events
+
+
+def remember_pending(session, message_id, liked, now=None):
+    """Keep a like (or unlike) the user just buffered in their `session`."""
+
+    now = time.time() if now is None else now
+
+    pending = [entry for entry in session.get(PENDING_KEY, [])
+               if entry[0] != message_id and entry[2] > now]
+    pending.append([message_id, liked, now + PENDING_SECONDS])
+    session[PENDING_KEY] = pending
+
+
+def pending_changes(session, now=None):
+    """{message id: liked} of the likes kept in `session`, oldest first."""
+
+    now = time.time() if now is None else now
+
+    return {message_id: liked
+            for message_id, liked, expires in session.get(PENDING_KEY, [])
+            if expires > now}
+
+
+def merge_pending(ours, stored, now=None):
+    """Merge the likes a request kept in its session with those stored
+    since (e.g. by a concurrent like); the latest per message wins."""
+
+    now = time.time() if now is None else now
+
+    latest = {}
+    for entry in [*(ours or []), *(stored or [])]:
+        message_id, _, expires = entry
+        if expires > now and (message_id not in latest
+                              or expires > latest[message_id][2]):
+            latest[message_id] = entry
+
+    return sorted(latest.values(), key=lambda entry: entry[2])
+
+
+def write_events(conn, events):
+    """Apply `events`, in order, on `conn`; the last per like wins.
+
+    Returns the ids of the users whose likes were written."""
+
+    latest = {}
+    for user_id, message_id, liked in events:
+        latest[user_id, message_id] = liked
+
+    likes = [pair for pair, liked in latest.items() if liked]
+    unlikes = [pair for pair, liked in latest.items() if not liked]
+
+    if likes:
+        # Selected from the tables, so likes of deleted messages are skipped
+        conn.execute(
+            insert_ignore(Like).from_select(
+                ['user_id', 'message_id'],
+                db.select(User.id, Message.id)
+                .join(Message, db.tuple_(User.id, Message.id).in_(likes))
+                .where(User.id.in_({user_id for user_id, _ in likes}),
+                       Message.id.in_({message_id
+                                       for _, message_id in likes}))))
+
+    if unlikes:
+        conn.execute(
+            db.delete(Like)
+            .where(db.tuple_(Like.user_id, Like.message_id).in_(unlikes)))
+
+    user_ids = {user_id for user_id, _ in latest}
+    if user_ids:
+        conn.execute(
+            db.update(User)
+            .where(User.id.in_(user_ids))
+            .values(state_version=User.state_version + 1))
+
+    return user_ids
+
+
+class LikeBuffer:
+    """Buffers likes and unlikes, writing them in batches."""
+
+    def __init__(self, directory=LIKE_BUFFER_DIR,
+                 flush_interval=LIKE_FLUSH_MS / 1000,
+                 flush_size=LIKE_FLUSH_SIZE):
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self.flush_size = flush_size
+        self.app = None
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wake = threading.Event()
+        # user id -> {message id: liked}, logged but not yet being written
+        self._pending = {}
+        self._count = 0
+        # Same, for the events the current flush is writing
+        self._flushing = {}
+        self._sequence = 0
+        self._log = None
+        self._lock_file = None
+
+    def _log_path(self, pid, sequence):
+        return os.path.join(self.directory, f"likes.{pid}.{sequence}.log")
+
+    def init_app(self, app):
+        """Replay logs left by crashed processes, and start buffering."""
+
+        self.app = app
+        os.makedirs(self.directory, exist_ok=True)
+
+        self.recover()
+
+        self._lock_file = open(
+            os.path.join(self.directory, f"likes.{os.getpid()}.lock"), 'w')
+        fcntl.flock(self._lock_file, fcntl.LOCK_EX)
+        self._log = open(self._log_path(os.getpid(), self._sequence), 'a')
+
+        threading.Thread(
+            target=self._run, name='like-buffer', daemon=True).start()
+        atexit.register(self.close)
+
+    def recover(self):
+        """Write, then delete, the logs of processes no longer running."""
+
+        for lock_path in glob.glob(os.path.join(self.directory,
+                                                'likes.*.lock')):
+            with open(lock_path, 'a') as lock_file:
+                try:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    continue
+
+                pid = lock_path.rsplit('.', 2)[1]
+                logs = sorted(
+                    glob.glob(os.path.join(self.directory,
+                                           f"likes.{pid}.*.log")),
+                    key=lambda path: int(LOG_NAME.search(path)[2]))
+
+                events = [event for path in logs for event in read_log(path)]
+                if events:
+                    with self.app.app_context(), db.engine.begin() as conn:
+                        write_events(conn, events)
+
+                for path in logs:
+                    os.remove(path)
+                os.remove(lock_path)
+
+    def _record(self, user_id, message_id, liked):
+        with self._lock:
+            self._log.write(json.dumps([user_id, message_id, liked]) + '\n')
+            self._log.flush()
+            os.fsync(self._log.fileno())
+
+            self._pending.setdefault(user_id, {})[message_id] = liked
+            self._count += 1
+            if self._count >= self.flush_size:
+                self._wake.set()
+
+    def like(self, user_id, message_id):
+        self._record(user_id, message_id, True)
+
+    def unlike(self, user_id, message_id):
+        self._record(user_id, message_id, False)
+
+    def overlay(self, user_id, session_changes=None):
+        """Return user `user_id`'s unwritten likes as an Overlay, or None.
+
+        `session_changes` ({message id: liked}, from `pending_changes`) are
+        the user's own, buffered by any process; they win."""
+
+        with self._lock:
+            changes = {**self._flushing.get(user_id, {}),
+                       **self._pending.get(user_id, {}),
+                       **(session_changes or {})}
+
+        if not changes:
+            return None
+
+        return Overlay(
+            frozenset(id for id, liked in changes.items() if liked),
+            frozenset(id for id, liked in changes.items() if not liked))
+
+    def flush(self):
+        """Write the events buffered so far."""
+
+        with self._flush_lock:
+            with self._lock:
+                if not self._pending or self._log is None:
+                    return
+
+                self._flushing = self._pending
+                self._pending = {}
+                self._count = 0
+
+                # Later events go to a new log; this one goes once written
+                self._log.close()
+                flushed_log = self._log_path(os.getpid(), self._sequence)
+                self._sequence += 1
+                self._log = open(
+                    self._log_path(os.getpid(), self._sequence), 'a')
+
+            events = [(user_id, message_id, liked)
+                      for user_id, changes in self._flushing.items()
+                      for message_id, liked in changes.items()]
+
+            try:
+                with self.app.app_context(), db.engine.begin() as conn:
+                    write_events(conn, events)
+            except Exception:
+                # Kept in the log and the overlay; tried again next flush
+                with self._lock:
+                    for user_id, changes in self._flushing.items():
+                        self._pending[user_id] = {
+                            **changes, **self._pending.get(user_id, {})}
+                    self._count += len(events)
+                    self._flushing = {}
+                    self._reuse_log(flushed_log)
+                raise
+
+            with self._lock:
+                self._flushing = {}
+            os.remove(flushed_log)
+
+    def _reuse_log(self, path):
+        """Move the events of unwritten log `path` ahead of the current log."""
+
+        current = self._log_path(os.getpid(), self._sequence)
+        self._log.close()
+
+        with open(path, 'a') as f, open(current) as later:
+            f.write(later.read())
+            f.flush()
+            os.fsync(f.fileno())
+
+        os.replace(path, current)
+        self._log = open(current, 'a')
+
+    def _run(self):
+        while True:
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            try:
+                self.flush()
+            except Exception:
+                self.app.logger.exception("Writing buffered likes failed")
+
+    def close(self):
+        """Write what's buffered, and stop logging (on shutdown)."""
+
+        if self._log is None:
+            return
+
+        self.flush()
+
+        with self._lock:
+            self._log.close()
+            self._log = None
+
+            if not self._pending:
+                os.remove(self._log_path(os.getpid(), self._sequence))
+                os.remove(self._lock_file.name)
+            self._lock_file.close()
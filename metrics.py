@@ -0,0 +1,159 @@
+"""Prometheus metrics, served at /metrics.
+
+    warbler_request_duration_seconds    histogram by method, route
+    warbler_requests_total              counter by method, route, status
+    warbler_db_queries_per_request      histogram by route
+    warbler_db_connections              open connections in all pools
+    warbler_db_connections_checked_out  connections in use
+    warbler_bcrypt_duration_seconds     histogram by operation (hash, check)
+    warbler_cache_lookups_total         counter by cache, result (hit, miss)
+
+Routes are labelled by their URL rule (/users/<int:user_id>), so labels
+stay few. A request's duration runs from before the first before_request
+function until the response is closed, so it covers streamed bodies.
+
+Under gunicorn, each worker has its own metrics. To serve their sum, set
+PROMETHEUS_MULTIPROC_DIR to an empty directory (wiped at every start), as
+gunicorn.conf.py does; workers then keep their metrics in files there.
+If METRICS_TOKEN is set, /metrics requires it as a bearer token.
+"""
+
+import hmac
+import os
+import time
+
+from flask import Response, g, has_request_context, request
+from prometheus_client import (
+    CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Gauge,
+    Histogram, generate_latest, multiprocess)
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.pool import Pool
+
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+
+REQUEST_DURATION = Histogram(
+    'warbler_request_duration_seconds', "Time to serve requests.",
+    ['method', 'route'],
+    buckets=(.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30))
+
+REQUESTS = Counter(
+    'warbler_requests', "Requests served.", ['method', 'route', 'status'])
+
+QUERIES_PER_REQUEST = Histogram(
+    'warbler_db_queries_per_request', "Database queries run per request.",
+    ['route'], buckets=(0, 1, 2, 3, 5, 8, 13, 21, 34, 55, 89))
+
+DB_CONNECTIONS = Gauge(
+    'warbler_db_connections', "Open database connections.",
+    multiprocess_mode='livesum')
+
+DB_CONNECTIONS_CHECKED_OUT = Gauge(
+    'warbler_db_connections_checked_out',
+    "Database connections checked out of their pool.",
+    multiprocess_mode='livesum')
+
+BCRYPT_DURATION = Histogram(
+    'warbler_bcrypt_duration_seconds', "Time spent hashing passwords.",
+    ['operation'], buckets=(.05, .1, .2, .3, .5, .75, 1, 2))
+
+CACHE_LOOKUPS = Counter(
+    'warbler_cache_lookups', "Cache lookups.", ['cache', 'result'])
+
+
+def bcrypt_timer(operation):
+    """Context manager timing a bcrypt `operation` ('hash' or 'check')."""
+
+    return BCRYPT_DURATION.labels(operation).time()
+
+
+def record_lookup(cache, hit):
+    """Count a lookup in `cache`, a hit if `hit`."""
+
+    CACHE_LOOKUPS.labels(cache, 'hit' if hit else 'miss').inc()
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def count_query(conn, cursor, statement, parameters, context, executemany):
+    if has_request_context() and 'query_count' in g:
+        g.query_count += 1
+
+
+@event.listens_for(Pool, 'connect')
+def count_connect(dbapi_connection, connection_record):
+    DB_CONNECTIONS.inc()
+
+
+@event.listens_for(Pool, 'close')
+def count_close(dbapi_connection, connection_record):
+    DB_CONNECTIONS.dec()
+
+
+@event.listens_for(Pool, 'checkout')
+def count_checkout(dbapi_connection, connection_record, connection_proxy):
+    DB_CONNECTIONS_CHECKED_OUT.inc()
+
+
+@event.listens_for(Pool, 'checkin')
+def count_checkin(dbapi_connection, connection_record):
+    DB_CONNECTIONS_CHECKED_OUT.dec()
+
+
+def registry():
+    """Registry to collect: every worker's metrics, in multiprocess mode."""
+
+    if 'PROMETHEUS_MULTIPROC_DIR' not in os.environ:
+        return REGISTRY
+
+    collector = CollectorRegistry()
+    multiprocess.MultiProcessCollector(collector)
+    return collector
+
+
+def start_request():
+    """Start timing the current request and counting its queries."""
+
+    g.request_started = time.perf_counter()
+    g.query_count = 0
+
+
+def init_app(app):
+    """Record `app`'s requests, and serve metrics at /metrics.
+
+    Call this before registering other request hooks, so their time is
+    counted."""
+
+    app.before_request(start_request)
+
+    @app.after_request
+    def record_request(response):
+        started = g.pop('request_started', None)
+        if started is None:
+            return response
+
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        method = request.method
+        # Streamed bodies run more queries after this, counted in the same g
+        request_g = g._get_current_object()
+
+        def record():
+            REQUEST_DURATION.labels(method, route).observe(
+                time.perf_counter() - started)
+            QUERIES_PER_REQUEST.labels(route).observe(request_g.query_count)
+
+        REQUESTS.labels(method, route, response.status_code).inc()
+        response.call_on_close(record)
+        return response
+
+    @app.get('/metrics')
+    def show_metrics():
+        """Serve metrics in Prometheus' text format."""
+
+        if METRICS_TOKEN and not hmac.compare_digest(
+                request.headers.get('Authorization', ''),
+                f"Bearer {METRICS_TOKEN}"):
+            return Response("Unauthorized", 401,
+                            {'WWW-Authenticate': 'Bearer'})
+
+        return Response(generate_latest(registry()),
+                        mimetype=CONTENT_TYPE_LATEST)
@@ -4,6 +4,9 @@ from datetime import datetime
 
 from flask_bcrypt import Bcrypt
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy.dialects import postgresql, sqlite
+
+from metrics import bcrypt_timer
 
 bcrypt = Bcrypt()
 db = SQLAlchemy()
@@ -17,6 +20,29 @@ DEFAULT_HEADER_IMAGE_URL = (
     "rb-4.0.3&ixid=MnwxMjA3fDB8MHxwaG90by1wYWdlfHx8fGVufDB8fHx8&auto=for" +
     "mat&fit=crop&w=2070&q=80")
 
+TEXT_SEARCH_CONFIG = "english"
+
+
+def _text_search_vector(column):
+    """Postgres full-text search document for `column`."""
+
+    # The config is inlined (not a bound parameter) so queries use exactly
+    # the same expression as the index.
+    return db.func.to_tsvector(
+        db.literal_column(f"'{TEXT_SEARCH_CONFIG}'"), column)
+
+
+def insert_ignore(model, bind=None):
+    """INSERT into `model`'s table that skips rows which already exist.
+
+    (INSERT ... ON CONFLICT DO NOTHING, on Postgres and SQLite.) `bind` is
+    the engine or connection it's for, if not the session's."""
+
+    dialect = (bind or db.session.get_bind(model)).dialect.name
+    insert = postgresql.insert if dialect == 'postgresql' else sqlite.insert
+
+    return insert(model).on_conflict_do_nothing()
+
 
 class Follow(db.Model):
     """Connection of a follower <-> followed_user."""
@@ -35,6 +61,53 @@ class Follow(db.Model):
         primary_key=True,
     )
 
+    @classmethod
+    def add_many(cls, follower_id, followed_ids):
+        """Have user `follower_id` follow every user in `followed_ids`.
+
+        One INSERT, whatever the follower already follows; users that don't
+        exist are skipped. Returns the set of ids of users newly followed."""
+
+        rows = db.session.execute(
+            insert_ignore(cls).from_select(
+                ['user_being_followed_id', 'user_following_id'],
+                db.select(User.id, db.literal(follower_id))
+                .where(User.id.in_(followed_ids)))
+            .returning(cls.user_being_followed_id))
+
+        return set(rows.scalars())
+
+    @classmethod
+    def remove_many(cls, follower_id, followed_ids):
+        """Have user `follower_id` stop following users in `followed_ids`.
+
+        Returns the set of ids of users no longer followed."""
+
+        rows = db.session.execute(
+            db.delete(cls).where(
+                cls.user_being_followed_id.in_(followed_ids),
+                cls.user_following_id == follower_id)
+            .returning(cls.user_being_followed_id))
+
+        return set(rows.scalars())
+
+    @classmethod
+    def add(cls, follower_id, followed_id):
+        """Have user `follower_id` follow user `followed_id`.
+
+        Returns whether a follow was added: False if they were already
+        following, or if user `followed_id` doesn't exist."""
+
+        return bool(cls.add_many(follower_id, [followed_id]))
+
+    @classmethod
+    def remove(cls, follower_id, followed_id):
+        """Have user `follower_id` stop following user `followed_id`.
+
+        Returns whether a follow was removed."""
+
+        return bool(cls.remove_many(follower_id, [followed_id]))
+
 
 class User(db.Model):
     """User in the system."""
@@ -87,6 +160,23 @@ class User(db.Model):
         nullable=False,
     )
 
+    # Bumped when cached per-viewer state goes stale (see viewer.py)
+    state_version = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    # Followers read their messages at request time, rather than getting
+    # copies in their feeds (see feed.py)
+    celebrity = db.Column(
+        db.Boolean,
+        nullable=False,
+        default=False,
+        server_default=db.false(),
+    )
+
     messages = db.relationship("Message", backref="user")
 
     liked_messages = db.relationship(
@@ -109,7 +199,8 @@ class User(db.Model):
 
         Hash password and add user to session."""
 
-        hashed_pwd = bcrypt.generate_password_hash(password).decode('UTF-8')
+        with bcrypt_timer('hash'):
+            hashed_pwd = bcrypt.generate_password_hash(password).decode('UTF-8')
 
         user = User(
             username=username,
@@ -133,26 +224,62 @@ class User(db.Model):
 
         user = cls.query.filter_by(username=username).one_or_none()
 
-        if user:
-            is_auth = bcrypt.check_password_hash(user.password, password)
-            if is_auth:
-                return user
+        if user and user.check_password(password):
+            return user
 
         return False
 
+    @classmethod
+    def taken(cls, username=None, email=None, exclude_id=None):
+        """Return which of `username` and `email` another user already has.
+
+        Checks both in one query; returns a set of field names ('username',
+        'email'). Users with id `exclude_id` don't count."""
+
+        conditions = []
+        if username:
+            conditions.append(cls.username == username)
+        if email:
+            conditions.append(cls.email == email)
+        if not conditions:
+            return set()
+
+        rows = db.session.execute(
+            db.select(cls.username, cls.email)
+            .where(db.or_(*conditions), cls.id != exclude_id))
+
+        taken = set()
+        for other_username, other_email in rows:
+            if username and other_username == username:
+                taken.add('username')
+            if email and other_email == email:
+                taken.add('email')
+
+        return taken
+
+    def check_password(self, password):
+        """Does `password` match this user's password?"""
+
+        with bcrypt_timer('check'):
+            return bcrypt.check_password_hash(self.password, password)
+
+    # These compare ids rather than instances, so they also work with users
+    # and messages loaded by another session (see asgi.py).
+
     def is_followed_by(self, other_user):
         """Is this user followed by `other_user`?"""
 
-        found_user_list = [
-            user for user in self.followers if user == other_user]
-        return len(found_user_list) == 1
+        return any(user.id == other_user.id for user in self.followers)
 
     def is_following(self, other_user):
         """Is this user following `other_user`?"""
 
-        found_user_list = [
-            user for user in self.following if user == other_user]
-        return len(found_user_list) == 1
+        return any(user.id == other_user.id for user in self.following)
+
+    def has_liked(self, message):
+        """Has this user liked `message`?"""
+
+        return any(liked.id == message.id for liked in self.liked_messages)
 
 
 class Message(db.Model):
@@ -182,6 +309,28 @@ class Message(db.Model):
         nullable=False,
     )
 
+    __table_args__ = (
+        db.Index(
+            'ix_messages_text_search',
+            _text_search_vector(text),
+            postgresql_using='gin',
+        ).ddl_if(dialect='postgresql'),
+        # A user's recent messages: their profile, and feeds (see feed.py)
+        db.Index(
+            'ix_messages_user_id_timestamp',
+            user_id,
+            timestamp.desc(),
+        ),
+        # The first message of a time window (see viewer.py)
+        db.Index('ix_messages_timestamp', timestamp),
+    )
+
+    @classmethod
+    def text_search_vector(cls):
+        """Full-text search document for messages (Postgres only)."""
+
+        return _text_search_vector(cls.text)
+
 
 class Like(db.Model):
     """A like."""
@@ -200,6 +349,186 @@ class Like(db.Model):
         primary_key=True
     )
 
+    @classmethod
+    def add_many(cls, user_id, message_ids):
+        """Have user `user_id` like every message in `message_ids`.
+
+        One INSERT, whatever the user already likes; messages that don't
+        exist are skipped. (Selecting the messages, rather than relying on a
+        foreign key, also covers partitioned messages; see partitions.py.)
+        Returns the set of ids of messages newly liked."""
+
+        rows = db.session.execute(
+            insert_ignore(cls).from_select(
+                ['user_id', 'message_id'],
+                db.select(db.literal(user_id), Message.id)
+                .where(Message.id.in_(message_ids)))
+            .returning(cls.message_id))
+
+        return set(rows.scalars())
+
+    @classmethod
+    def remove_many(cls, user_id, message_ids):
+        """Have user `user_id` unlike messages in `message_ids`.
+
+        Returns the set of ids of messages no longer liked."""
+
+        rows = db.session.execute(
+            db.delete(cls).where(
+                cls.user_id == user_id,
+                cls.message_id.in_(message_ids))
+            .returning(cls.message_id))
+
+        return set(rows.scalars())
+
+    @classmethod
+    def add(cls, user_id, message_id):
+        """Have user `user_id` like message `message_id`.
+
+        Returns whether a like was added: False if it was already liked, or
+        if message `message_id` doesn't exist."""
+
+        return bool(cls.add_many(user_id, [message_id]))
+
+    @classmethod
+    def remove(cls, user_id, message_id):
+        """Have user `user_id` unlike message `message_id`.
+
+        Returns whether a like was removed."""
+
+        return bool(cls.remove_many(user_id, [message_id]))
+
+
+class FeedEntry(db.Model):
+    """A message, copied into a follower's home feed (see feed.py)."""
+
+    __tablename__ = 'feed_entries'
+
+    user_id = db.Column(  # whose feed
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='CASCADE'),
+        primary_key=True,
+    )
+
+    # Not a foreign key: messages may be partitioned (see partitions.py)
+    message_id = db.Column(
+        db.Integer,
+        primary_key=True,
+    )
+
+    author_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='CASCADE'),
+        nullable=False,
+    )
+
+    timestamp = db.Column(
+        db.DateTime,
+        nullable=False,
+    )
+
+    __table_args__ = (
+        db.Index('ix_feed_entries_user_id_timestamp',
+                 user_id, timestamp.desc()),
+        db.Index('ix_feed_entries_message_id', message_id),
+    )
+
+
+class TrendingScore(db.Model):
+    """A message's decayed like count (see trending.py)."""
+
+    __tablename__ = 'trending_scores'
+
+    # Not a foreign key: messages may be partitioned (see partitions.py)
+    message_id = db.Column(
+        db.Integer,
+        primary_key=True,
+    )
+
+    likes = db.Column(
+        db.Integer,
+        nullable=False,
+    )
+
+    # log2 of the sum of its likes' weights
+    log_score = db.Column(
+        db.Float,
+        nullable=False,
+        index=True,
+    )
+
+
+class StoredSession(db.Model):
+    """A server-side session (see sessions.py)."""
+
+    __tablename__ = 'sessions'
+
+    id = db.Column(
+        db.String(64),
+        primary_key=True,
+    )
+
+    # Logged-in user, if any, so that all their sessions can be ended
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='CASCADE'),
+        index=True,
+    )
+
+    data = db.Column(
+        db.Text,
+        nullable=False,
+    )
+
+    expires = db.Column(
+        db.DateTime,
+        nullable=False,
+        index=True,
+    )
+
+
+class Export(db.Model):
+    """An archive of a user's data (see exports.py)."""
+
+    __tablename__ = 'exports'
+
+    id = db.Column(
+        db.Integer,
+        primary_key=True,
+    )
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='CASCADE'),
+        nullable=False,
+        index=True,
+    )
+
+    format = db.Column(  # 'ndjson' or 'csv'
+        db.String(10),
+        nullable=False,
+    )
+
+    # 'pending', 'running', 'done' or 'failed'
+    status = db.Column(
+        db.String(10),
+        nullable=False,
+    )
+
+    size = db.Column(  # bytes, once done
+        db.BigInteger,
+    )
+
+    created = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+    )
+
+    finished = db.Column(
+        db.DateTime,
+    )
+
 
 def connect_db(app):
     """Connect this database to provided Flask app.
@@ -0,0 +1,239 @@
+"""Monthly range partitioning and archival of the messages table (Postgres).
+
+Feeds only ever show recent messages, so on Postgres `messages` can be
+partitioned by month on `timestamp`: queries bounded by timestamp (see
+`newest`) only touch the partitions in range, and cold months can be moved
+out of the database entirely, keeping the hot working set small.
+
+Commands (run with `flask messages <command>`):
+
+    partition        one-off migration of `messages` to a partitioned table
+    add-partitions   create partitions for the coming months (run from cron)
+    archive          export old months to gzipped CSV and drop them, with
+                     their likes, trending scores, feed entries and copies
+                     on the shards (see shards.py)
+
+Postgres requires every unique constraint on a partitioned table to include
+the partition key, so the primary key becomes (id, timestamp) and `likes`
+can no longer have a foreign key to `messages`. Messages are deleted
+through the ORM, which also deletes their rows in `likes` (the secondary
+table of `Message.users_liked_by`), so nothing relies on the cascade.
+"""
+
+import gzip
+import os
+from datetime import datetime, timedelta
+
+import click
+from flask import current_app
+from flask.cli import AppGroup
+
+from models import db, Message
+from shards import update_after_commit
+
+ARCHIVE_DIR = os.environ.get('MESSAGE_ARCHIVE_DIR', 'archive')
+
+# Windows tried, in order, by `newest`; None means "everything".
+NEWEST_WINDOWS = (timedelta(days=31), timedelta(days=366), None)
+
+cli = AppGroup('messages', help="Manage message partitions.")
+
+
+def month_start(when):
+    """Return midnight on the first of `when`'s month."""
+
+    return datetime(when.year, when.month, 1)
+
+
+def add_months(month, n):
+    """Return the first of the month `n` months after `month`."""
+
+    index = month.year * 12 + month.month - 1 + n
+    return datetime(index // 12, index % 12 + 1, 1)
+
+
+def partition_name(month):
+    return f"messages_{month:%Y_%m}"
+
+
+def newest(query, limit, now=None):
+    """Return the `limit` newest messages from `query`.
+
+    Tries progressively wider timestamp windows, so that the usual case
+    (enough recent messages) only scans the latest partitions."""
+
+    now = datetime.utcnow() if now is None else now
+    query = query.order_by(Message.timestamp.desc())
+
+    for window in NEWEST_WINDOWS:
+        if window is None:
+            return query.limit(limit).all()
+
+        messages = (query
+                    .filter(Message.timestamp >= now - window)
+                    .limit(limit)
+                    .all())
+
+        if len(messages) == limit:
+            return messages
+
+
+def _require_postgres():
+    if db.engine.dialect.name != 'postgresql':
+        raise click.ClickException("Partitioning requires Postgres.")
+
+
+def _execute(sql, **params):
+    return db.session.execute(db.text(sql), params)
+
+
+def _is_partitioned():
+    return _execute(
+        "SELECT EXISTS (SELECT 1 FROM pg_partitioned_table p "
+        "JOIN pg_class c ON c.oid = p.partrelid "
+        "WHERE c.relname = 'messages')").scalar()
+
+
+def _partitions():
+    """Return {name: month} for the monthly partitions of messages."""
+
+    rows = _execute(
+        "SELECT c.relname FROM pg_inherits i "
+        "JOIN pg_class c ON c.oid = i.inhrelid "
+        "JOIN pg_class p ON p.oid = i.inhparent "
+        "WHERE p.relname = 'messages'")
+
+    return {name: datetime.strptime(name, "messages_%Y_%m")
+            for (name,) in rows if name != 'messages_default'}
+
+
+def _add_partition(month):
+    _execute(
+        f"CREATE TABLE IF NOT EXISTS {partition_name(month)} "
+        f"PARTITION OF messages "
+        f"FOR VALUES FROM ('{month:%Y-%m-%d}') "
+        f"TO ('{add_months(month, 1):%Y-%m-%d}')")
+
+
+def add_partitions(ahead):
+    """Create partitions from the current month through `ahead` months on."""
+
+    month = month_start(datetime.utcnow())
+    for n in range(ahead + 1):
+        _add_partition(add_months(month, n))
+
+
+@cli.command('partition')
+@click.option('--ahead', default=3, show_default=True,
+              help="Months of empty partitions to create ahead of time.")
+def partition_command(ahead):
+    """Convert the messages table into monthly partitions."""
+
+    _require_postgres()
+
+    if _is_partitioned():
+        raise click.ClickException("messages is already partitioned.")
+
+    oldest = _execute("SELECT min(timestamp) FROM messages").scalar()
+
+    _execute("LOCK TABLE messages IN ACCESS EXCLUSIVE MODE")
+    _execute("ALTER TABLE messages RENAME TO messages_unpartitioned")
+    _execute("ALTER TABLE likes DROP CONSTRAINT IF EXISTS "
+             "likes_message_id_fkey")
+    _execute("CREATE TABLE messages "
+             "(LIKE messages_unpartitioned INCLUDING DEFAULTS) "
+             "PARTITION BY RANGE (timestamp)")
+    _execute("ALTER SEQUENCE messages_id_seq OWNED BY messages.id")
+    _execute("ALTER TABLE messages ADD PRIMARY KEY (id, timestamp)")
+    _execute("ALTER TABLE messages ADD FOREIGN KEY (user_id) "
+             "REFERENCES users (id) ON DELETE CASCADE")
+    _execute("CREATE TABLE messages_default PARTITION OF messages DEFAULT")
+
+    month = month_start(oldest or datetime.utcnow())
+    last = add_months(month_start(datetime.utcnow()), ahead)
+    while month <= last:
+        _add_partition(month)
+        month = add_months(month, 1)
+
+    _execute("INSERT INTO messages SELECT * FROM messages_unpartitioned")
+    _execute("DROP TABLE messages_unpartitioned")
+
+    # Indexes created on the parent cascade to every partition.
+    for index in Message.__table__.indexes:
+        index.create(db.session.connection())
+
+    db.session.commit()
+    click.echo("messages is now partitioned by month.")
+
+
+@cli.command('add-partitions')
+@click.option('--ahead', default=3, show_default=True,
+              help="Months of partitions to create ahead of time.")
+def add_partitions_command(ahead):
+    """Create partitions for the coming months."""
+
+    _require_postgres()
+    add_partitions(ahead)
+    db.session.commit()
+
+
+def _copy_out(sql, path):
+    """Write the rows of `sql` to `path`, as gzipped CSV."""
+
+    cursor = db.session.connection().connection.cursor()
+    with gzip.open(path, 'wb') as f:
+        cursor.copy_expert(f"COPY ({sql}) TO STDOUT WITH CSV HEADER", f)
+
+
+@cli.command('archive')
+@click.option('--keep', default=12, show_default=True,
+              help="Number of recent months to keep in the database.")
+@click.option('--to', 'archive_dir', default=ARCHIVE_DIR, show_default=True,
+              type=click.Path(file_okay=False),
+              help="Directory to write the archived months to.")
+def archive_command(keep, archive_dir):
+    """Move months older than --keep to gzipped CSV files."""
+
+    _require_postgres()
+    os.makedirs(archive_dir, exist_ok=True)
+
+    cutoff = add_months(month_start(datetime.utcnow()), -keep)
+    cold = sorted((month, name) for name, month in _partitions().items()
+                  if month < cutoff)
+    db.session.commit()
+    shards = current_app.extensions.get('shards')
+
+    for month, name in cold:
+        path = os.path.join(archive_dir, f"{name}.csv.gz")
+
+        # Copied while attached: this only reads the partition, so
+        # `messages` stays usable. The count is of the same snapshot.
+        db.session.connection(
+            execution_options={'isolation_level': 'REPEATABLE READ'})
+        copied = _execute(f"SELECT count(*) FROM {name}").scalar()
+        _copy_out(f"SELECT * FROM {name}", path)
+        db.session.commit()
+
+        # Locks `messages`, so in a transaction of its own
+        _execute(f"ALTER TABLE messages DETACH PARTITION {name}")
+        db.session.commit()
+
+        # Written to since (e.g. by an import): copied again, as it's final
+        if _execute(f"SELECT count(*) FROM {name}").scalar() != copied:
+            _copy_out(f"SELECT * FROM {name}", path)
+
+        _copy_out(f"SELECT l.* FROM likes l JOIN {name} m "
+                  f"ON m.id = l.message_id",
+                  os.path.join(archive_dir, f"likes_{name}.csv.gz"))
+
+        for table in ('likes', 'trending_scores', 'feed_entries'):
+            _execute(f"DELETE FROM {table} WHERE message_id IN "
+                     f"(SELECT id FROM {name})")
+        _execute(f"DROP TABLE {name}")
+        db.session.commit()
+
+        if shards:
+            update_after_commit(shards.remove_between,
+                                month, add_months(month, 1))
+
+        click.echo(f"Archived {name}.")
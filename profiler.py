@@ -0,0 +1,222 @@
+"""Opt-in sampling profiler, writing flamegraph input per route.
+
+Profiled requests have their thread's stack sampled every PROFILE_INTERVAL
+seconds by a background thread; samples are added up per route (endpoint)
+in-process and written every PROFILE_DUMP_SECONDS to
+
+    PROFILE_DIR/<endpoint>.<pid>.folded
+
+in the collapsed-stack format ("outer;inner;innermost count" lines) read
+by flamegraph.pl, speedscope and the like. Workers write their own files;
+concatenating them adds them up:
+
+    cat profiles/homepage.*.folded | flamegraph.pl > homepage.svg
+
+Which requests are profiled:
+
+    PROFILE_ROUTES        comma-separated endpoints, e.g. homepage,show_user
+    PROFILE_SAMPLE_RATE   fraction of requests (of those routes, if set);
+                          defaults to all requests of PROFILE_ROUTES, none
+                          without
+    X-Profile header      any request carrying a token from
+                          `flask profiler token`, signed with SECRET_KEY
+
+Requests that aren't profiled cost a random number; the sampling thread
+sleeps while no request is being profiled. A request is sampled from its
+first before_request hook until its response is done, so streamed pages
+are covered; native ASGI views aren't profiled.
+"""
+
+import atexit
+import collections
+import hashlib
+import hmac
+import os
+import random
+import sys
+import threading
+import time
+
+import click
+from flask import current_app, g, request
+from flask.cli import AppGroup
+
+PROFILE_DIR = os.environ.get('PROFILE_DIR', 'profiles')
+PROFILE_ROUTES = {route.strip()
+                  for route in os.environ.get('PROFILE_ROUTES', '').split(',')
+                  if route.strip()}
+PROFILE_SAMPLE_RATE = float(
+    os.environ.get('PROFILE_SAMPLE_RATE', 1 if PROFILE_ROUTES else 0))
+PROFILE_INTERVAL = float(os.environ.get('PROFILE_INTERVAL', 0.005))
+PROFILE_DUMP_SECONDS = int(os.environ.get('PROFILE_DUMP_SECONDS', 60))
+
+PROFILE_HEADER = 'X-Profile'
+
+cli = AppGroup('profiler', help="Profile requests.")
+
+
+def sign_token(secret_key, expires):
+    """Return an X-Profile token valid until `expires` (a Unix time)."""
+
+    signature = hmac.new(
+        secret_key.encode(), f"profile:{expires}".encode(), hashlib.sha256,
+    ).hexdigest()
+    return f"{expires}:{signature}"
+
+
+def check_token(secret_key, token):
+    """Is `token` an unexpired X-Profile token?"""
+
+    expires, _, _ = token.partition(':')
+    if not expires.isdigit() or int(expires) < time.time():
+        return False
+
+    return hmac.compare_digest(token, sign_token(secret_key, int(expires)))
+
+
+def collapse(frame):
+    """Return `frame`'s stack as "outermost;...;innermost" frame names."""
+
+    names = []
+    while frame is not None:
+        names.append(f"{frame.f_globals.get('__name__', '?')}:"
+                     f"{frame.f_code.co_qualname}")
+        frame = frame.f_back
+
+    return ';'.join(reversed(names))
+
+
+class Sampler:
+    """Background thread sampling the stacks of registered threads.
+
+    Hold `lock` to read the Counters it updates."""
+
+    def __init__(self, interval=PROFILE_INTERVAL):
+        self.interval = interval
+        self.lock = threading.Lock()
+        self._targets = {}
+        self._active = threading.Event()
+        self._thread = None
+
+    def start(self, stacks):
+        """Start counting the calling thread's stacks in Counter `stacks`."""
+
+        with self.lock:
+            self._targets[threading.get_ident()] = stacks
+            self._active.set()
+
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(
+                    target=self._run, name='profiler', daemon=True)
+                self._thread.start()
+
+    def stop(self):
+        """Stop sampling the calling thread."""
+
+        with self.lock:
+            self._targets.pop(threading.get_ident(), None)
+            if not self._targets:
+                self._active.clear()
+
+    def _run(self):
+        while True:
+            self._active.wait()
+            time.sleep(self.interval)
+
+            frames = sys._current_frames()
+
+            with self.lock:
+                for ident, stacks in self._targets.items():
+                    frame = frames.get(ident)
+                    if frame is not None:
+                        stacks[collapse(frame)] += 1
+
+
+class Profiler:
+    """Chooses requests to profile, and keeps their samples by route."""
+
+    def __init__(self, directory=PROFILE_DIR, routes=PROFILE_ROUTES,
+                 sample_rate=PROFILE_SAMPLE_RATE, interval=PROFILE_INTERVAL,
+                 dump_seconds=PROFILE_DUMP_SECONDS):
+        self.directory = directory
+        self.routes = set(routes)
+        self.sample_rate = sample_rate
+        self.dump_seconds = dump_seconds
+        self.sampler = Sampler(interval)
+        self.stacks = collections.defaultdict(collections.Counter)
+        self._dumped = time.monotonic()
+
+    def wanted(self, endpoint, token=None, secret_key=None):
+        """Profile a request to `endpoint` carrying X-Profile `token`?"""
+
+        if token and secret_key and check_token(secret_key, token):
+            return True
+
+        if self.routes and endpoint not in self.routes:
+            return False
+
+        return self.sample_rate > 0 and random.random() < self.sample_rate
+
+    def start(self, endpoint):
+        self.sampler.start(self.stacks[endpoint])
+
+    def stop(self):
+        self.sampler.stop()
+
+        if time.monotonic() - self._dumped >= self.dump_seconds:
+            self.dump()
+
+    def dump(self):
+        """Write every route's samples so far to its .folded file."""
+
+        with self.sampler.lock:
+            self._dumped = time.monotonic()
+            routes = {endpoint: dict(stacks)
+                      for endpoint, stacks in self.stacks.items() if stacks}
+
+        if not routes:
+            return
+
+        os.makedirs(self.directory, exist_ok=True)
+
+        for endpoint, stacks in routes.items():
+            path = os.path.join(self.directory,
+                                f"{endpoint}.{os.getpid()}.folded")
+            tmp = f"{path}.tmp"
+            with open(tmp, 'w') as f:
+                for stack, count in sorted(stacks.items()):
+                    f.write(f"{stack} {count}\n")
+            os.replace(tmp, path)
+
+    def init_app(self, app):
+        """Profile `app`'s requests as configured.
+
+        Call this before registering other request hooks, so they're
+        profiled too."""
+
+        @app.before_request
+        def start_profiling():
+            if request.endpoint and self.wanted(
+                    request.endpoint,
+                    request.headers.get(PROFILE_HEADER),
+                    app.config['SECRET_KEY']):
+                self.start(request.endpoint)
+                g.profiling = True
+
+        @app.teardown_request
+        def stop_profiling(error=None):
+            # Streamed responses tear down once they're sent
+            if g.pop('profiling', False):
+                self.stop()
+
+        atexit.register(self.dump)
+
+
+@cli.command('token')
+@click.option('--minutes', default=10, help="How long it's valid for.")
+def token_command(minutes):
+    """Print an X-Profile header to profile requests with."""
+
+    expires = int(time.time()) + minutes * 60
+    token = sign_token(current_app.config['SECRET_KEY'], expires)
+    click.echo(f"{PROFILE_HEADER}: {token}")
@@ -0,0 +1,317 @@
+"""Publish/subscribe of new messages, for live timeline updates.
+
+`Hub` fans new-message events out to the subscribers (open event streams)
+in this process that follow the message's author. Events reach every
+worker process through a broadcast backend, chosen by `PUBSUB_URL`:
+
+    (unset)                     in-process only; fine for a single worker
+    postgresql://...            Postgres LISTEN/NOTIFY
+    unix:///path/to/directory   Unix datagram sockets, one per worker, in
+                                the given directory (single box, no DB)
+
+Each backend's `publish` sends an event to every worker, this one
+included; a listener thread hands incoming events to `Hub.dispatch`.
+"""
+
+import asyncio
+import json
+import logging
+import os
+import queue
+import select
+import socket
+import threading
+import time
+from urllib.parse import urlparse
+
+CHANNEL = 'warbler_messages'
+SUBSCRIBER_QUEUE_SIZE = 100
+
+# Seconds before reconnecting a dropped listener, doubling up to the max
+RECONNECT_DELAY = 1
+RECONNECT_MAX_DELAY = 30
+
+logger = logging.getLogger(__name__)
+
+
+def message_event(message, avatar_url):
+    """Return the event published for a new `message`.
+
+    `avatar_url` is the author's image as timelines show it: through the
+    image proxy (see imageproxy.py), so viewers never fetch it from its
+    host."""
+
+    return {
+        'id': message.id,
+        'text': message.text,
+        'timestamp': message.timestamp.isoformat(),
+        'user': {
+            'id': message.user.id,
+            'username': message.user.username,
+            'avatar_url': avatar_url,
+        },
+    }
+
+
+def format_event(event):
+    """Return `event` as a Server-Sent Events message."""
+
+    return f"id: {event['id']}\ndata: {json.dumps(event)}\n\n"
+
+
+class Subscription:
+    """A subscriber's queue of events from the users in `user_ids`."""
+
+    def __init__(self, user_ids):
+        self.user_ids = frozenset(user_ids)
+        self._queue = queue.Queue(maxsize=SUBSCRIBER_QUEUE_SIZE)
+
+    def put(self, event):
+        try:
+            self._queue.put_nowait(event)
+        except queue.Full:
+            # A subscriber this far behind has stopped reading; it will
+            # catch up on its next page load.
+            pass
+
+    def get(self, timeout=None):
+        """Return the next event, or None if none arrived within `timeout`."""
+
+        try:
+            return self._queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+
+class AsyncSubscription(Subscription):
+    """A subscription read from an asyncio event loop.
+
+    Events are handed to the loop's thread as they're dispatched, so waiting
+    for one ties up no thread."""
+
+    def __init__(self, user_ids):
+        self.user_ids = frozenset(user_ids)
+        self._loop = asyncio.get_running_loop()
+        self._queue = asyncio.Queue(maxsize=SUBSCRIBER_QUEUE_SIZE)
+
+    def _put(self, event):
+        try:
+            self._queue.put_nowait(event)
+        except asyncio.QueueFull:
+            pass
+
+    def put(self, event):
+        self._loop.call_soon_threadsafe(self._put, event)
+
+    async def get(self, timeout=None):
+        """Return the next event, or None if none arrived within `timeout`."""
+
+        try:
+            return await asyncio.wait_for(self._queue.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+
+class Hub:
+    """Routes published events to subscriptions interested in their author."""
+
+    def __init__(self, backend=None):
+        self._subscribers = {}
+        self._lock = threading.Lock()
+        self._started_pid = None
+        self.backend = backend or LocalBackend()
+
+    def _ensure_started(self):
+        # Started lazily, in the worker itself: listener threads don't
+        # survive gunicorn forking workers from a preloaded app.
+        with self._lock:
+            if self._started_pid != os.getpid():
+                self.backend.start(self.dispatch)
+                self._started_pid = os.getpid()
+
+    def subscribe(self, user_ids, subscription_class=Subscription):
+        """Return a new subscription to messages by users in `user_ids`."""
+
+        self._ensure_started()
+        subscription = subscription_class(user_ids)
+
+        with self._lock:
+            for user_id in subscription.user_ids:
+                self._subscribers.setdefault(user_id, set()).add(subscription)
+
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            for user_id in subscription.user_ids:
+                subscribers = self._subscribers.get(user_id)
+                if subscribers is not None:
+                    subscribers.discard(subscription)
+                    if not subscribers:
+                        del self._subscribers[user_id]
+
+    def publish(self, event):
+        """Send `event` to subscribers in every worker."""
+
+        self._ensure_started()
+        self.backend.publish(event)
+
+    def dispatch(self, event):
+        """Deliver `event` to this process's subscribers."""
+
+        with self._lock:
+            subscribers = list(self._subscribers.get(event['user']['id'], ()))
+
+        for subscription in subscribers:
+            subscription.put(event)
+
+
+class LocalBackend:
+    """Delivers events within this process only."""
+
+    def start(self, deliver):
+        self._deliver = deliver
+
+    def publish(self, event):
+        self._deliver(event)
+
+
+class PostgresBackend:
+    """Broadcasts events with Postgres LISTEN/NOTIFY.
+
+    If the listening connection drops, the listener logs it and reconnects,
+    with backoff; events sent while it's down aren't delivered here. A
+    publish on a dropped connection reconnects and retries once."""
+
+    def __init__(self, dsn, channel=CHANNEL):
+        self.dsn = dsn
+        self.channel = channel
+        self._lock = threading.Lock()
+        self._publisher = None
+
+    def _connect(self):
+        import psycopg2
+
+        conn = psycopg2.connect(self.dsn)
+        conn.autocommit = True
+        return conn
+
+    def start(self, deliver):
+        self._deliver = deliver
+        threading.Thread(target=self._listen, daemon=True).start()
+
+    def _listen(self):
+        delay = RECONNECT_DELAY
+
+        while True:
+            try:
+                conn = self._connect()
+                try:
+                    conn.cursor().execute(f"LISTEN {self.channel}")
+                    delay = RECONNECT_DELAY
+                    self._receive(conn)
+                finally:
+                    conn.close()
+            except Exception:
+                logger.exception("Listening on %s failed; reconnecting in %ss",
+                                 self.channel, delay)
+
+            time.sleep(delay)
+            delay = min(delay * 2, RECONNECT_MAX_DELAY)
+
+    def _receive(self, conn):
+        while True:
+            select.select([conn], [], [])
+            conn.poll()
+            while conn.notifies:
+                notify = conn.notifies.pop(0)
+                self._deliver(json.loads(notify.payload))
+
+    def publish(self, event):
+        """NOTIFY `event`; if the connection has dropped, reconnect and try
+        once more, then log that it's lost."""
+
+        import psycopg2
+
+        with self._lock:
+            for retry in (False, True):
+                try:
+                    if self._publisher is None or self._publisher.closed:
+                        self._publisher = self._connect()
+
+                    self._publisher.cursor().execute(
+                        "SELECT pg_notify(%s, %s)",
+                        (self.channel, json.dumps(event)))
+                    return
+                except psycopg2.Error:
+                    if self._publisher is not None:
+                        self._publisher.close()
+                    self._publisher = None
+                    if retry:
+                        logger.exception("Publishing on %s failed; event %s "
+                                         "lost", self.channel, event['id'])
+
+
+class SocketBackend:
+    """Broadcasts events over Unix datagram sockets in a shared directory.
+
+    Each worker binds `<directory>/<name>.sock` (`name` defaults to the
+    pid); publishing sends the event to every socket there. Sockets of
+    workers that have gone away are removed on the first failed send."""
+
+    def __init__(self, directory, name=None):
+        self.directory = directory
+        self.name = name
+
+    def start(self, deliver):
+        self._deliver = deliver
+        os.makedirs(self.directory, exist_ok=True)
+
+        name = self.name or os.getpid()
+        self.path = os.path.join(self.directory, f"{name}.sock")
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self._sock.bind(self.path)
+        threading.Thread(target=self._listen, daemon=True).start()
+
+    def _listen(self):
+        while True:
+            data = self._sock.recv(65536)
+            self._deliver(json.loads(data))
+
+    def publish(self, event):
+        data = json.dumps(event).encode()
+
+        with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as sock:
+            for name in os.listdir(self.directory):
+                if not name.endswith('.sock'):
+                    continue
+
+                path = os.path.join(self.directory, name)
+                try:
+                    sock.sendto(data, path)
+                except (ConnectionRefusedError, FileNotFoundError):
+                    if path != self.path:
+                        try:
+                            os.unlink(path)
+                        except FileNotFoundError:
+                            pass
+
+
+def backend_from_url(url):
+    """Return the broadcast backend configured by `url` (see module doc)."""
+
+    if not url:
+        return LocalBackend()
+
+    parsed = urlparse(url)
+
+    if parsed.scheme.startswith('postgres'):
+        return PostgresBackend(url)
+
+    if parsed.scheme == 'unix':
+        return SocketBackend(parsed.path)
+
+    raise ValueError(f"Unknown PUBSUB_URL scheme: {parsed.scheme}")
@@ -0,0 +1,186 @@
+"""Read models: compact, immutable rows for listing pages.
+
+Feed and list pages show a handful of columns from each of up to a hundred
+messages or users. Rather than full ORM entities (identity-mapped, change-
+tracked, with every column loaded, long bios and header image URLs
+included) they get these tuples, built straight from queries that select
+just the columns shown.
+
+Each comes with the columns to select and a function turning result rows
+into instances; `*_query()` give legacy `Query` objects for the Flask app,
+`*_select()` 2.0-style statements for async sessions (see asgi.py).
+Pages listing arbitrarily many rows read them in batches with `streamed`.
+"""
+
+import itertools
+from datetime import datetime
+from typing import NamedTuple
+
+from models import db, User, Message, Like, Follow
+
+
+class Author(NamedTuple):
+    """The author of a `FeedItem`."""
+
+    id: int
+    username: str
+    image_url: str
+
+
+class FeedItem(NamedTuple):
+    """A message as shown in a feed."""
+
+    id: int
+    text: str
+    timestamp: datetime
+    user: Author
+
+    @property
+    def user_id(self):
+        return self.user.id
+
+
+class UserCard(NamedTuple):
+    """A user as shown in a list of users."""
+
+    id: int
+    username: str
+    image_url: str
+    header_image_url: str
+    bio: str
+
+
+class ProfileCounts(NamedTuple):
+    """The numbers shown at the top of a user's profile."""
+
+    messages: int
+    following: int
+    followers: int
+    likes: int
+
+
+FEED_ITEM_COLUMNS = (
+    Message.id, Message.text, Message.timestamp,
+    User.id, User.username, User.image_url,
+)
+
+USER_CARD_COLUMNS = (
+    User.id, User.username, User.image_url, User.header_image_url, User.bio,
+)
+
+# Rows fetched from the cursor at a time by `streamed`
+STREAM_BATCH_SIZE = 100
+
+
+def feed_query():
+    """Query of `FeedItem` columns, for filtering and ordering on Message."""
+
+    return (db.session
+            .query(*FEED_ITEM_COLUMNS)
+            .join(User, Message.user_id == User.id))
+
+
+def feed_select():
+    """`feed_query` as a select statement."""
+
+    return db.select(*FEED_ITEM_COLUMNS).join(User, Message.user_id == User.id)
+
+
+def feed_items(rows):
+    """Return result rows of `FeedItem` columns as FeedItems."""
+
+    return [FeedItem(id, text, timestamp, Author(user_id, username, image_url))
+            for id, text, timestamp, user_id, username, image_url in rows]
+
+
+def user_card_query():
+    """Query of `UserCard` columns."""
+
+    return db.session.query(*USER_CARD_COLUMNS)
+
+
+def user_card_select():
+    """`user_card_query` as a select statement."""
+
+    return db.select(*USER_CARD_COLUMNS)
+
+
+def user_cards(rows):
+    """Return result rows of `UserCard` columns as UserCards."""
+
+    return [UserCard(*row) for row in rows]
+
+
+def streamed(query, make, batch_size=STREAM_BATCH_SIZE):
+    """Yield lists of up to `batch_size` read models made by `make`.
+
+    Rows are fetched as they're needed, through a server-side cursor where
+    the database has them, so memory use doesn't grow with the result."""
+
+    rows = iter(query.yield_per(batch_size))
+
+    while batch := make(itertools.islice(rows, batch_size)):
+        yield batch
+
+
+def liked_by(query, user_id, overlay=None):
+    """Restrict a feed query or select to messages liked by `user_id`.
+
+    `overlay` is the user's unwritten likes, if any (see likebuffer.py)."""
+
+    if overlay:
+        return query.where(liked_by_clause(user_id, overlay))
+
+    return (query
+            .join(Like, Like.message_id == Message.id)
+            .where(Like.user_id == user_id))
+
+
+def liked_by_clause(user_id, overlay):
+    """Is the message liked by `user_id`, with `overlay` applied?"""
+
+    liked = (Message.id.in_(db.select(Like.message_id)
+                            .where(Like.user_id == user_id))
+             | Message.id.in_(overlay.liked))
+
+    return liked & Message.id.not_in(overlay.unliked)
+
+
+def following_of(query, user_id):
+    """Restrict a user card query or select to users `user_id` follows."""
+
+    return (query
+            .join(Follow, Follow.user_being_followed_id == User.id)
+            .where(Follow.user_following_id == user_id))
+
+
+def followers_of(query, user_id):
+    """Restrict a user card query or select to users following `user_id`."""
+
+    return (query
+            .join(Follow, Follow.user_following_id == User.id)
+            .where(Follow.user_being_followed_id == user_id))
+
+
+def profile_counts_select(user_id, overlay=None):
+    """Select the `ProfileCounts` of user `user_id`, in one query.
+
+    `overlay` is the user's unwritten likes, if any (see likebuffer.py)."""
+
+    def count(*where):
+        return db.select(db.func.count()).where(*where).scalar_subquery()
+
+    return db.select(
+        count(Message.user_id == user_id),
+        count(Follow.user_following_id == user_id),
+        count(Follow.user_being_followed_id == user_id),
+        count(liked_by_clause(user_id, overlay)) if overlay
+        else count(Like.user_id == user_id),
+    )
+
+
+def profile_counts(user_id, overlay=None):
+    """Return the `ProfileCounts` of user `user_id`."""
+
+    return ProfileCounts(*db.session.execute(
+        profile_counts_select(user_id, overlay)).one())
@@ -0,0 +1,231 @@
+"""Full-text search over messages.
+
+On Postgres, searches run against the GIN index on the messages' text
+search vector (see `Message.__table_args__`). The GIN index finds matches
+but doesn't order them, so sorting every match of a common word by id would
+cost as much as the word is common; instead, searches try the newest
+`SEARCH_ID_WINDOWS` ids first and only widen when a window has too few
+matches. Rare words still end up scanning all their (few) matches.
+
+Other databases (SQLite in development) fall back to an in-process inverted
+index, built on the first search. Each search first adds messages newer
+than the index, so posts from other workers show up at once, and the index
+is rebuilt every `SEARCH_REBUILD_INTERVAL` seconds to drop messages deleted
+elsewhere. (Such messages are never shown in the meantime, since results
+are loaded from the DB; they just leave a page short.)
+
+Results are newest first and paginated with a keyset cursor: pass the id of
+the last message shown as `before` to get the next page.
+"""
+
+import os
+import re
+import time
+from array import array
+from bisect import bisect_left
+from threading import Lock
+
+from models import db, Message, TEXT_SEARCH_CONFIG
+
+DEFAULT_PAGE_SIZE = 20
+BUILD_BATCH_SIZE = 10_000
+
+# Id ranges tried, in order, by Postgres searches; None means "everything".
+SEARCH_ID_WINDOWS = (10_000, 1_000_000, None)
+
+SEARCH_REBUILD_INTERVAL = int(os.environ.get('SEARCH_REBUILD_INTERVAL', 300))
+
+# Matches the spirit of Postgres's 'english' config, which ignores these
+# words in both documents and queries.
+STOP_WORDS = frozenset("""
+    a an and are as at be but by for if in into is it no not of on or such
+    that the their then there these they this to was will with
+""".split())
+
+WORD_RE = re.compile(r"[a-z0-9]+")
+
+
+def tokenize(text):
+    """Return the set of searchable words in `text`."""
+
+    return {word for word in WORD_RE.findall(text.lower())
+            if word not in STOP_WORDS}
+
+
+def _contains(postings, message_id):
+    i = bisect_left(postings, message_id)
+    return i < len(postings) and postings[i] == message_id
+
+
+class InvertedIndex:
+    """Map of word -> sorted array of ids of messages containing that word."""
+
+    def __init__(self):
+        self._postings = {}
+        self._lock = Lock()
+
+    def __len__(self):
+        return len(self._postings)
+
+    def add(self, message_id, text):
+        """Index message `message_id`."""
+
+        with self._lock:
+            for word in tokenize(text):
+                postings = self._postings.setdefault(word, array('q'))
+
+                # Ids are almost always increasing, so this is an append.
+                if not postings or postings[-1] < message_id:
+                    postings.append(message_id)
+                elif not _contains(postings, message_id):
+                    postings.insert(bisect_left(postings, message_id),
+                                    message_id)
+
+    def remove(self, message_id, text):
+        """Remove message `message_id`, which had text `text`."""
+
+        with self._lock:
+            for word in tokenize(text):
+                postings = self._postings.get(word)
+                if postings is None:
+                    continue
+
+                i = bisect_left(postings, message_id)
+                if i < len(postings) and postings[i] == message_id:
+                    del postings[i]
+                if not postings:
+                    del self._postings[word]
+
+    def search(self, query, before=None, limit=DEFAULT_PAGE_SIZE):
+        """Return ids of messages containing every word of `query`.
+
+        Ids are newest first; only ids below `before` are considered."""
+
+        words = tokenize(query)
+        if not words:
+            return []
+
+        with self._lock:
+            postings = [self._postings.get(word) for word in words]
+            if not all(postings):
+                return []
+
+            # Walk the rarest word's postings backwards, probing the others.
+            postings.sort(key=len)
+            shortest, rest = postings[0], postings[1:]
+            end = (len(shortest) if before is None
+                   else bisect_left(shortest, before))
+
+            found = []
+            for i in range(end - 1, -1, -1):
+                message_id = shortest[i]
+                if all(_contains(other, message_id) for other in rest):
+                    found.append(message_id)
+                    if len(found) == limit:
+                        break
+
+            return found
+
+
+class MessageSearch:
+    """Search messages with Postgres full-text search or an inverted index."""
+
+    def __init__(self, rebuild_interval=SEARCH_REBUILD_INTERVAL):
+        self.rebuild_interval = rebuild_interval
+        self._index = None
+        self._built_at = None
+        self._indexed_to = 0
+        self._lock = Lock()
+
+    @property
+    def uses_postgres(self):
+        return db.engine.dialect.name == 'postgresql'
+
+    def _fallback_index(self):
+        """Return the inverted index, brought up to date with the DB.
+
+        Rebuilds it if it's missing or stale, and otherwise adds messages
+        posted (by any worker) since it was last updated."""
+
+        with self._lock:
+            now = time.monotonic()
+            if (self._index is None
+                    or now - self._built_at >= self.rebuild_interval):
+                self._index = InvertedIndex()
+                self._built_at = now
+                self._indexed_to = 0
+
+            rows = db.session.execute(
+                db.select(Message.id, Message.text)
+                .where(Message.id > self._indexed_to)
+                .order_by(Message.id)
+                .execution_options(yield_per=BUILD_BATCH_SIZE))
+
+            for message_id, text in rows:
+                self._index.add(message_id, text)
+                self._indexed_to = message_id
+
+            return self._index
+
+    def add(self, message):
+        """Keep the fallback index in step with a newly committed message."""
+
+        if self._index is not None:
+            self._index.add(message.id, message.text)
+
+    def remove(self, message):
+        """Keep the fallback index in step with a deleted message."""
+
+        if self._index is not None:
+            self._index.remove(message.id, message.text)
+
+    def _search_postgres(self, query, before, limit):
+        """Return the `limit` newest messages matching `query`.
+
+        Tries progressively wider id windows below `before`, so that common
+        words only fetch and sort their matches among the newest messages."""
+
+        q = (Message.query
+             .filter(Message.text_search_vector().op('@@')(
+                 db.func.plainto_tsquery(TEXT_SEARCH_CONFIG, query)))
+             .order_by(Message.id.desc()))
+
+        if before is None:
+            newest = db.session.scalar(db.select(db.func.max(Message.id)))
+            if newest is None:
+                return []
+            before = newest + 1
+
+        q = q.filter(Message.id < before)
+
+        for window in SEARCH_ID_WINDOWS:
+            if window is None or before - window <= 1:
+                return q.limit(limit).all()
+
+            messages = (q
+                        .filter(Message.id >= before - window)
+                        .limit(limit)
+                        .all())
+
+            if len(messages) == limit:
+                return messages
+
+    def search(self, query, before=None, limit=DEFAULT_PAGE_SIZE):
+        """Search messages for `query`.
+
+        Returns (messages, cursor), where `cursor` is the `before` value for
+        the next page, or None if this is the last page."""
+
+        if self.uses_postgres:
+            messages = self._search_postgres(query, before, limit + 1)
+
+        else:
+            ids = self._fallback_index().search(query, before, limit + 1)
+            by_id = {msg.id: msg
+                     for msg in Message.query.filter(Message.id.in_(ids))}
+            messages = [by_id[id] for id in ids if id in by_id]
+
+        if len(messages) > limit:
+            return messages[:limit], messages[limit - 1].id
+
+        return messages, None
@@ -0,0 +1,301 @@
+"""Server-side sessions.
+
+The session cookie holds only a random session id; the session's data is
+kept in a store, so requests don't verify a signed cookie, sessions can be
+ended from the server (see `delete_user`), and the session can hold more
+than fits in a cookie. Stores, chosen by SESSION_STORE:
+
+    database    the `sessions` table, shared by every worker (the default)
+    memory      a dict in this process: for tests and single-process runs
+
+The database store loads a session together with its user's current
+`state_version`, as `session.user_version`, so the app can tell whether
+what the session caches about the user (see viewer.py) is current without
+reading the user.
+
+A request saving a session writes all of it, so of two requests of one
+session, the last to save wins; keys both may write (e.g. likes kept by
+likebuffer.py) can be given a merge function instead, and are merged with
+what's stored when saving.
+
+Sessions last PERMANENT_SESSION_LIFETIME from their last save, and are
+saved again once half of that has gone by. Expired sessions are removed by
+`flask sessions purge`.
+
+Databases created before the sessions table existed need:
+
+    CREATE TABLE sessions (
+        id VARCHAR(64) PRIMARY KEY,
+        user_id INTEGER REFERENCES users ON DELETE CASCADE,
+        data TEXT NOT NULL,
+        expires TIMESTAMP NOT NULL);
+    CREATE INDEX ix_sessions_user_id ON sessions (user_id);
+    CREATE INDEX ix_sessions_expires ON sessions (expires);
+"""
+
+import secrets
+import threading
+from collections import namedtuple
+from datetime import datetime
+
+import click
+from flask import current_app
+from flask.cli import AppGroup
+from flask.json.tag import TaggedJSONSerializer
+from flask.sessions import SecureCookieSession, SessionInterface
+
+from models import db, StoredSession, User
+
+cli = AppGroup('sessions', help="Manage server-side sessions.")
+
+# Tags bytes, tuples etc. the way cookie sessions do
+serializer = TaggedJSONSerializer()
+
+# A stored session: its data, its user's state_version (None if unknown or
+# logged out) and when it expires
+Record = namedtuple('Record', ['data', 'user_version', 'expires'])
+
+
+def new_session_id():
+    return secrets.token_urlsafe(32)
+
+
+class MemoryStore:
+    """Sessions in a dict, private to this process."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._sessions = {}
+
+    def load(self, sid):
+        """Return session `sid`'s Record, or None if absent or expired."""
+
+        with self._lock:
+            stored = self._sessions.get(sid)
+
+        if stored is None or stored[2] <= datetime.utcnow():
+            return None
+
+        data, _, expires = stored
+        return Record(serializer.loads(data), None, expires)
+
+    def save(self, sid, data, user_id, expires):
+        with self._lock:
+            self._sessions[sid] = (serializer.dumps(data), user_id, expires)
+
+    def delete(self, sid):
+        with self._lock:
+            self._sessions.pop(sid, None)
+
+    def delete_user(self, user_id):
+        """Delete every session of user `user_id`."""
+
+        with self._lock:
+            for sid in [sid for sid, (_, owner, _) in self._sessions.items()
+                        if owner == user_id]:
+                del self._sessions[sid]
+
+    def purge(self):
+        """Delete expired sessions; return how many there were."""
+
+        now = datetime.utcnow()
+        with self._lock:
+            expired = [sid for sid, (_, _, expires) in self._sessions.items()
+                       if expires <= now]
+            for sid in expired:
+                del self._sessions[sid]
+
+        return len(expired)
+
+
+class DatabaseStore:
+    """Sessions in the `sessions` table.
+
+    Uses connections of its own, so saving a session never commits, or
+    rolls back, the request's db.session."""
+
+    def load(self, sid):
+        """Return session `sid`'s Record, or None if absent or expired."""
+
+        with db.engine.connect() as conn:
+            row = conn.execute(
+                db.select(StoredSession.data, StoredSession.expires,
+                          User.state_version)
+                .select_from(StoredSession)
+                .outerjoin(User, User.id == StoredSession.user_id)
+                .where(StoredSession.id == sid,
+                       StoredSession.expires > datetime.utcnow())).first()
+
+        if row is None:
+            return None
+
+        return Record(serializer.loads(row.data), row.state_version,
+                      row.expires)
+
+    def save(self, sid, data, user_id, expires):
+        values = {
+            'data': serializer.dumps(data),
+            'user_id': user_id,
+            'expires': expires,
+        }
+
+        with db.engine.begin() as conn:
+            updated = conn.execute(
+                db.update(StoredSession)
+                .where(StoredSession.id == sid)
+                .values(**values)).rowcount
+
+            if not updated:
+                conn.execute(db.insert(StoredSession).values(id=sid, **values))
+
+    def delete(self, sid):
+        with db.engine.begin() as conn:
+            conn.execute(db.delete(StoredSession)
+                         .where(StoredSession.id == sid))
+
+    def delete_user(self, user_id):
+        """Delete every session of user `user_id`."""
+
+        with db.engine.begin() as conn:
+            conn.execute(db.delete(StoredSession)
+                         .where(StoredSession.user_id == user_id))
+
+    def purge(self):
+        """Delete expired sessions; return how many there were."""
+
+        with db.engine.begin() as conn:
+            return conn.execute(
+                db.delete(StoredSession)
+                .where(StoredSession.expires <= datetime.utcnow())).rowcount
+
+
+STORES = {
+    'database': DatabaseStore,
+    'memory': MemoryStore,
+}
+
+
+def store_from_name(name):
+    """Return the session store called `name` (see module doc)."""
+
+    if name not in STORES:
+        raise ValueError(f"Unknown SESSION_STORE: {name}")
+
+    return STORES[name]()
+
+
+class ServerSession(SecureCookieSession):
+    """Session kept in a store under `sid`."""
+
+    def __init__(self, initial=None, sid=None, new=False, user_version=None,
+                 stale=False):
+        super().__init__(initial)
+        self.sid = sid or new_session_id()
+        self.new = new
+        self.user_version = user_version
+        # Due to be saved again, to push back its expiry
+        self.stale = stale
+        # Id this session was moved from by `rotate`
+        self.replaced = None
+
+    def rotate(self):
+        """Move the session to a new id, e.g. when logging in, so that an
+        id planted before then is of no use."""
+
+        if not self.new and self.replaced is None:
+            self.replaced = self.sid
+
+        self.sid = new_session_id()
+        self.new = True
+        self.modified = True
+
+
+class ServerSessionInterface(SessionInterface):
+    """Flask sessions kept in `store`; `user_key` is the session key of the
+    logged-in user's id.
+
+    `mergers` maps session keys to `merge(ours, stored)` functions: on
+    saving, those keys get what `merge` makes of the request's value and
+    the stored one, if the same user is logged in to both."""
+
+    def __init__(self, store, user_key, mergers=None):
+        self.store = store
+        self.user_key = user_key
+        self.mergers = mergers or {}
+
+    def open_session(self, app, request):
+        sid = request.cookies.get(self.get_cookie_name(app))
+        record = self.store.load(sid) if sid else None
+
+        # Unknown ids aren't reused: a new session gets a new id
+        if record is None:
+            return ServerSession(new=True)
+
+        remaining = record.expires - datetime.utcnow()
+        return ServerSession(
+            record.data, sid,
+            user_version=record.user_version,
+            stale=remaining < app.permanent_session_lifetime / 2)
+
+    def save_session(self, app, session, response):
+        name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+        secure = self.get_cookie_secure(app)
+        samesite = self.get_cookie_samesite(app)
+        httponly = self.get_cookie_httponly(app)
+
+        if session.accessed:
+            response.vary.add('Cookie')
+
+        if session.replaced:
+            self.store.delete(session.replaced)
+
+        if not session:
+            if not session.new or session.replaced:
+                self.store.delete(session.sid)
+                response.delete_cookie(
+                    name, domain=domain, path=path, secure=secure,
+                    samesite=samesite, httponly=httponly)
+            return
+
+        if not (session.modified or session.stale):
+            return
+
+        if self.mergers and not session.new:
+            self._merge(session)
+
+        self.store.save(
+            session.sid,
+            dict(session),
+            # Not session.get(), which would count as accessing the session
+            dict.get(session, self.user_key),
+            datetime.utcnow() + app.permanent_session_lifetime)
+
+        response.set_cookie(
+            name, session.sid, expires=self.get_expiration_time(app, session),
+            httponly=httponly, domain=domain, path=path, secure=secure,
+            samesite=samesite)
+
+
+    def _merge(self, session):
+        record = self.store.load(session.sid)
+        if (record is None
+                or record.data.get(self.user_key)
+                != dict.get(session, self.user_key)):
+            return
+
+        for key, merge in self.mergers.items():
+            value = merge(dict.get(session, key), record.data.get(key))
+            if value:
+                session[key] = value
+            else:
+                session.pop(key, None)
+
+
+@cli.command('purge')
+def purge_command():
+    """Delete expired sessions."""
+
+    count = current_app.session_interface.store.purge()
+    click.echo(f"Deleted {count} expired sessions.")
@@ -0,0 +1,414 @@
+"""Consistent-hash sharding of users' messages, for home timelines.
+
+With SHARD_URLS set ("name=url" pairs, separated by spaces or commas),
+each user is mapped to one of those databases, their shard, by a
+consistent-hash ring: every shard owns SHARD_VNODES points on a ring of
+64-bit hashes, and a user belongs to the shard owning the first point at
+or after the hash of their id. Adding a shard only moves the users whose
+ids hash next to its points (about 1/N of them), and removing one only
+moves its own.
+
+The shards are a best-effort read index: they hold copies
+(`shard_messages`) of users' messages, and serve one read, with
+FEED_FANOUT off: finding the newest messages of the users someone follows
+(see `feed.home_query`). The authors are grouped by shard, every shard is
+asked in parallel for its newest `limit` messages by them, and those
+sorted lists are merged (a k-way merge on timestamp) down to the newest
+`limit`. What's spread over the shards is that scan of the followed
+users' messages; the main database stays the source of truth for
+everything (writes, likes, every other read) and only loads those `limit`
+messages by primary key.
+
+Messages are copied to their author's shard after they're committed to
+the main database, not in the same transaction: views, `flask imports
+run` and `flask messages archive` call `add_messages`,
+`remove_messages`... through `update_after_commit`, which logs a failure
+rather than raising it, since the change itself is done. Until the shard
+catches up, a message whose copy failed is missing from home timelines
+(and one whose removal failed is skipped when loaded). Each process
+catches up in the background (`start_reconciler`): every
+SHARD_RECONCILE_INTERVAL seconds it makes the shards' messages since its
+last successful pass (at first, the last SHARD_RECONCILE_WINDOW seconds)
+match the main database's, so a shard that was down is repaired once it's
+back. Imported messages with older timestamps, and removals older than
+that, need `flask shards sync`.
+
+    flask shards sync         copy every message to its shard
+    flask shards reconcile    catch the shards up on recent messages
+    flask shards rebalance    move users whose shard changed
+    flask shards status       rows and misplaced users per shard
+
+After adding a shard to SHARD_URLS, run `rebalance`; users being moved
+miss messages from their followers' homepages until it reaches them. To
+remove a shard, take it out of SHARD_URLS and pass it to `rebalance
+--drain name=url`.
+
+Shards created when likes were copied too can drop them:
+
+    DROP TABLE shard_likes;
+"""
+
+import bisect
+import hashlib
+import heapq
+import itertools
+import logging
+import os
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+import click
+from flask import current_app
+from flask.cli import AppGroup
+from sqlalchemy import create_engine
+
+from models import db, insert_ignore, Message
+
+SHARD_URLS = os.environ.get('SHARD_URLS', '')
+SHARD_VNODES = int(os.environ.get('SHARD_VNODES', 64))
+SHARD_BATCH_SIZE = 1000
+SHARD_RECONCILE_INTERVAL = int(os.environ.get('SHARD_RECONCILE_INTERVAL', 60))
+SHARD_RECONCILE_WINDOW = int(
+    os.environ.get('SHARD_RECONCILE_WINDOW', 60 * 60))
+
+cli = AppGroup('shards', help="Manage message shards.")
+
+logger = logging.getLogger(__name__)
+
+# Tables on every shard, not in the main database
+metadata = db.MetaData()
+
+shard_messages = db.Table(
+    'shard_messages', metadata,
+    db.Column('id', db.Integer, primary_key=True, autoincrement=False),
+    db.Column('user_id', db.Integer, nullable=False),
+    db.Column('text', db.String(140), nullable=False),
+    db.Column('timestamp', db.DateTime, nullable=False),
+    db.Index('ix_shard_messages_user_id_timestamp', 'user_id', 'timestamp'),
+)
+
+
+def parse_shard_urls(spec):
+    """{name: url} of a SHARD_URLS value."""
+
+    urls = {}
+    for pair in re.split(r'[\s,]+', spec.strip()):
+        if pair:
+            name, _, url = pair.partition('=')
+            urls[name] = url
+    return urls
+
+
+def ring_hash(key):
+    return int.from_bytes(
+        hashlib.blake2b(str(key).encode(), digest_size=8).digest(), 'big')
+
+
+class HashRing:
+    """Consistent-hash ring of shard names."""
+
+    def __init__(self, names, vnodes=SHARD_VNODES):
+        self._points = sorted((ring_hash(f"{name}#{n}"), name)
+                              for name in names for n in range(vnodes))
+        self._hashes = [point for point, _ in self._points]
+
+    def owner(self, key):
+        """Name of the shard owning `key`."""
+
+        i = bisect.bisect_left(self._hashes, ring_hash(key))
+        return self._points[i % len(self._points)][1]
+
+
+def message_row(message):
+    return {'id': message.id, 'user_id': message.user_id,
+            'text': message.text, 'timestamp': message.timestamp}
+
+
+def update_after_commit(update, *args):
+    """Run shard update `update(*args)`, e.g. `shards.add_messages`, for a
+    change committed to the main database; log, rather than raise, a
+    failure."""
+
+    try:
+        update(*args)
+    except Exception:
+        logger.exception("Updating the shards failed; they're behind until "
+                         "`flask shards sync`")
+
+
+class ShardSet:
+    """Databases holding users' messages, by hash of user id."""
+
+    def __init__(self, urls, vnodes=SHARD_VNODES):
+        self.engines = {name: create_engine(url)
+                        for name, url in urls.items()}
+        self.ring = HashRing(urls, vnodes)
+        self._executor = ThreadPoolExecutor(
+            len(urls), thread_name_prefix='shard')
+        self._closed = threading.Event()
+
+    def init_app(self, app):
+        app.extensions['shards'] = self
+
+    def create_tables(self):
+        for engine in self.engines.values():
+            metadata.create_all(engine)
+
+    def close(self):
+        self._closed.set()
+        self._executor.shutdown()
+        for engine in self.engines.values():
+            engine.dispose()
+
+    def shard_of(self, user_id):
+        return self.ring.owner(user_id)
+
+    def group(self, items, user_id=lambda item: item):
+        """{shard name: [item, ...]} of `items`, by their `user_id`."""
+
+        groups = {}
+        for item in items:
+            groups.setdefault(self.shard_of(user_id(item)), []).append(item)
+        return groups
+
+    def scatter(self, work, groups):
+        """Run `work(connection, items)` for each shard's items in
+        `groups`, in parallel and each in a transaction; return their
+        results."""
+
+        def run(name, items):
+            with self.engines[name].begin() as conn:
+                return work(conn, items)
+
+        futures = [self._executor.submit(run, name, items)
+                   for name, items in groups.items()]
+        return [future.result() for future in futures]
+
+    def everywhere(self, work, items):
+        """Run `work(connection, items)` on every shard."""
+
+        return self.scatter(work, {name: items for name in self.engines})
+
+    def add_messages(self, messages):
+        """Copy committed `messages` (with id, user_id, text and timestamp)
+        to their authors' shards."""
+
+        def add(conn, rows):
+            conn.execute(insert_ignore(shard_messages, conn), rows)
+
+        self.scatter(add, self.group(
+            map(message_row, messages), lambda row: row['user_id']))
+
+    def remove_messages(self, message_ids):
+        """Remove deleted messages from every shard."""
+
+        def remove(conn, ids):
+            conn.execute(db.delete(shard_messages)
+                         .where(shard_messages.c.id.in_(ids)))
+
+        if message_ids:
+            self.everywhere(remove, list(message_ids))
+
+    def remove_between(self, start, end):
+        """Remove messages from `start` up to `end` (e.g. an archived month)
+        from every shard."""
+
+        def remove(conn, _):
+            conn.execute(db.delete(shard_messages)
+                         .where(shard_messages.c.timestamp >= start,
+                                shard_messages.c.timestamp < end))
+
+        self.everywhere(remove, None)
+
+    def reconcile(self, since):
+        """Make the shards' messages from `since` on match the main
+        database's: copy those missing, remove those deleted.
+
+        Returns how many were (added, removed)."""
+
+        rows = db.session.execute(
+            db.select(Message.id, Message.user_id, Message.text,
+                      Message.timestamp)
+            .where(Message.timestamp >= since)).all()
+        ids = {row.id for row in rows}
+
+        def reconcile(conn, rows):
+            have = set(conn.scalars(
+                db.select(shard_messages.c.id)
+                .where(shard_messages.c.timestamp >= since)))
+
+            missing = [message_row(row) for row in rows if row.id not in have]
+            if missing:
+                conn.execute(insert_ignore(shard_messages, conn), missing)
+
+            deleted = have - ids
+            if deleted:
+                conn.execute(db.delete(shard_messages)
+                             .where(shard_messages.c.id.in_(deleted)))
+
+            return len(missing), len(deleted)
+
+        groups = self.group(rows, lambda row: row.user_id)
+        counts = self.scatter(reconcile, {name: groups.get(name, [])
+                                          for name in self.engines})
+        return tuple(map(sum, zip(*counts)))
+
+    def start_reconciler(self, app, interval=SHARD_RECONCILE_INTERVAL,
+                         window=SHARD_RECONCILE_WINDOW):
+        """Reconcile the shards every `interval` seconds, in a background
+        thread, until closed.
+
+        Each pass goes back to the start of the last successful one (less
+        `interval`, for messages committed a while after they were made),
+        or `window` seconds at first."""
+
+        def run():
+            since = datetime.utcnow() - timedelta(seconds=window)
+
+            while not self._closed.wait(interval):
+                started = datetime.utcnow()
+                try:
+                    with app.app_context():
+                        self.reconcile(since)
+                except Exception:
+                    logger.exception("Reconciling the shards failed")
+                else:
+                    since = started - timedelta(seconds=interval)
+
+        threading.Thread(target=run, name='shard-reconciler',
+                         daemon=True).start()
+
+    def newest_ids(self, user_ids, limit, since=None):
+        """Ids of the newest `limit` messages by `user_ids` (newer than
+        `since`, if given), newest first."""
+
+        def newest(conn, user_ids):
+            select = (db.select(shard_messages.c.id,
+                                shard_messages.c.timestamp)
+                      .where(shard_messages.c.user_id.in_(user_ids))
+                      .order_by(shard_messages.c.timestamp.desc(),
+                                shard_messages.c.id.desc())
+                      .limit(limit))
+            if since is not None:
+                select = select.where(shard_messages.c.timestamp > since)
+            return conn.execute(select).all()
+
+        merged = heapq.merge(*self.scatter(newest, self.group(user_ids)),
+                             key=lambda row: (row.timestamp, row.id),
+                             reverse=True)
+
+        # A message being moved by `rebalance` can be on two shards
+        ids = dict.fromkeys(row.id for row in merged)
+        return list(itertools.islice(ids, limit))
+
+
+def user_ids_on(conn):
+    """Ids of the users with messages on shard `conn`."""
+
+    return conn.scalars(
+        db.select(shard_messages.c.user_id).distinct()).all()
+
+
+def move_users(source, target, user_ids):
+    """Copy users' messages from shard connection `source` to `target`,
+    then delete them from `source`."""
+
+    rows = source.execute(
+        db.select(shard_messages)
+        .where(shard_messages.c.user_id.in_(user_ids))).mappings().all()
+    if rows:
+        target.execute(insert_ignore(shard_messages, target), rows)
+
+    # Only once the copies are committed
+    target.commit()
+
+    source.execute(db.delete(shard_messages)
+                   .where(shard_messages.c.user_id.in_(user_ids)))
+    source.commit()
+
+
+@cli.command('sync')
+def sync_command():
+    """Copy every message in the database to its shard."""
+
+    shards = current_app.extensions['shards']
+    shards.create_tables()
+
+    messages = db.session.execute(
+        db.select(Message.id, Message.user_id, Message.text,
+                  Message.timestamp),
+        execution_options={'yield_per': SHARD_BATCH_SIZE})
+    count = 0
+    for batch in messages.partitions():
+        shards.add_messages(batch)
+        count += len(batch)
+        click.echo(f"messages: {count}")
+
+
+@cli.command('reconcile')
+@click.option('--minutes', default=SHARD_RECONCILE_WINDOW // 60,
+              show_default=True, help="How far back to look.")
+def reconcile_command(minutes):
+    """Catch the shards up on the last --minutes of messages."""
+
+    shards = current_app.extensions['shards']
+    added, removed = shards.reconcile(
+        datetime.utcnow() - timedelta(minutes=minutes))
+    click.echo(f"added {added}, removed {removed}")
+
+
+@cli.command('rebalance')
+@click.option('--drain', multiple=True, metavar='NAME=URL',
+              help="A shard taken out of SHARD_URLS, to move users off.")
+def rebalance_command(drain):
+    """Move users whose shard changed, with their messages."""
+
+    shards = current_app.extensions['shards']
+    shards.create_tables()
+
+    sources = {name: shards.engines[name] for name in shards.engines}
+    for name, url in parse_shard_urls(' '.join(drain)).items():
+        sources[name] = create_engine(url)
+
+    for name, engine in sources.items():
+        moved = 0
+
+        with engine.connect() as source:
+            user_ids = user_ids_on(source)
+            source.rollback()
+
+            misplaced = {}
+            for user_id in user_ids:
+                owner = shards.shard_of(user_id)
+                if owner != name:
+                    misplaced.setdefault(owner, []).append(user_id)
+
+            for owner, owner_user_ids in misplaced.items():
+                with shards.engines[owner].connect() as target:
+                    for start in range(0, len(owner_user_ids),
+                                       SHARD_BATCH_SIZE):
+                        batch = owner_user_ids[start:start + SHARD_BATCH_SIZE]
+                        move_users(source, target, batch)
+                        moved += len(batch)
+
+        click.echo(f"{name}: moved {moved} of {len(user_ids)} users")
+
+
+@cli.command('status')
+def status_command():
+    """Show the rows on each shard, and users on the wrong one."""
+
+    shards = current_app.extensions['shards']
+
+    for name, engine in shards.engines.items():
+        with engine.connect() as conn:
+            messages = conn.scalar(
+                db.select(db.func.count()).select_from(shard_messages))
+            user_ids = user_ids_on(conn)
+
+        misplaced = sum(1 for user_id in user_ids
+                        if shards.shard_of(user_id) != name)
+        click.echo(f"{name}: {len(user_ids)} users ({misplaced} misplaced), "
+                   f"{messages} messages")
@@ -0,0 +1,246 @@
+"""ASGI entry point tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_asgi.py
+
+
+import asyncio
+import os
+import threading
+from unittest import IsolatedAsyncioTestCase
+from unittest.mock import patch
+
+from app import app, CURR_USER_KEY
+from models import db, Follow, Like, Message, User
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+import asgi  # noqa: E402
+from asgi import application, engine  # noqa: E402
+
+db.drop_all()
+db.create_all()
+
+
+def session_cookie(user_id):
+    """Return a Cookie header value logging in as `user_id`."""
+
+    with app.test_client() as client:
+        with client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = user_id
+        cookie = client.get_cookie(app.config['SESSION_COOKIE_NAME'])
+
+    return f"session={cookie.value}"
+
+
+async def request(path, cookie=None, disconnect_after=None):
+    """Send a GET for `path` through the ASGI app.
+
+    Returns (status, headers, body). For streams, the client disconnects
+    `disconnect_after` seconds in."""
+
+    path, _, query = path.partition('?')
+    scope = {
+        'type': 'http',
+        'http_version': '1.1',
+        'method': 'GET',
+        'scheme': 'http',
+        'path': path,
+        'root_path': '',
+        'query_string': query.encode(),
+        'headers': [(b'host', b'localhost')],
+        'server': ('localhost', 80),
+        'client': ('127.0.0.1', 12345),
+    }
+    if cookie:
+        scope['headers'].append((b'cookie', cookie.encode()))
+
+    sent = []
+    requested = False
+
+    async def receive():
+        nonlocal requested
+        if not requested:
+            requested = True
+            return {'type': 'http.request', 'body': b'', 'more_body': False}
+
+        await asyncio.sleep(disconnect_after or 3600)
+        return {'type': 'http.disconnect'}
+
+    async def send(message):
+        sent.append(message)
+
+    await application(scope, receive, send)
+
+    start = sent[0]
+    headers = {name.decode(): value.decode()
+               for name, value in start['headers']}
+    body = b''.join(message.get('body', b'') for message in sent[1:])
+
+    return start['status'], headers, body.decode()
+
+
+class ASGITestCase(IsolatedAsyncioTestCase):
+    def setUp(self):
+        Follow.query.delete()
+        Message.query.delete()
+        User.query.delete()
+
+        u1 = User.signup("u1", "u1@email.com", "password", None)
+        u2 = User.signup("u2", "u2@email.com", "password", None)
+        db.session.flush()
+
+        u1.following.append(u2)
+        db.session.add(Message(text="m2-text", user_id=u2.id))
+        db.session.commit()
+
+        self.u1_id = u1.id
+        self.u2_id = u2.id
+
+    async def asyncTearDown(self):
+        await engine.dispose()
+
+    def tearDown(self):
+        db.session.rollback()
+        Like.query.delete()
+        Follow.query.delete()
+        db.session.commit()
+
+    async def test_homepage_anon(self):
+        """Tests if the anonymous homepage is served natively"""
+        status, _, html = await request('/')
+
+        self.assertEqual(status, 200)
+        self.assertIn("What's Happening?", html)
+
+    async def test_homepage(self):
+        """Tests if the timeline shows followed users' messages"""
+        status, _, html = await request('/', session_cookie(self.u1_id))
+
+        self.assertEqual(status, 200)
+        self.assertIn('<!-- Test for /users route.', html)
+        self.assertIn('m2-text', html)
+
+    async def test_list_users(self):
+        """Tests if users are listed and searched"""
+        cookie = session_cookie(self.u1_id)
+
+        status, _, html = await request('/users?q=u2', cookie)
+
+        self.assertEqual(status, 200)
+        self.assertIn('@u2', html)
+        self.assertNotIn('<p>@u1</p>', html)
+        self.assertIn('Unfollow', html)
+
+    async def test_show_user(self):
+        """Tests if user profiles are shown, and missing users 404"""
+        cookie = session_cookie(self.u1_id)
+
+        status, _, html = await request(f'/users/{self.u2_id}', cookie)
+        self.assertEqual(status, 200)
+        self.assertIn('<!-- tests for user profile', html)
+        self.assertIn('m2-text', html)
+
+        status, _, _ = await request('/users/0', cookie)
+        self.assertEqual(status, 404)
+
+    async def test_show_likes(self):
+        """Tests if the likes page is served natively"""
+        status, _, html = await request(f'/users/{self.u1_id}/likes',
+                                        session_cookie(self.u1_id))
+
+        self.assertEqual(status, 200)
+        self.assertIn('<!-- test for showing likes', html)
+
+    async def test_streamed_pages(self):
+        """Tests if user lists and likes are fetched as they're sent"""
+        Like.add(self.u1_id, Message.query.one().id)
+        db.session.commit()
+        cookie = session_cookie(self.u1_id)
+        events = []
+
+        def recorded(event, function):
+            async def record(*args):
+                events.append(event)
+                return await function(*args)
+            return record
+
+        def recorded_rows(make):
+            def record(rows):
+                events.append('rows')
+                return make(rows)
+            return record
+
+        with patch.object(asgi, 'send_start',
+                          recorded('start', asgi.send_start)), \
+                patch.object(asgi, 'user_cards',
+                             recorded_rows(asgi.user_cards)), \
+                patch.object(asgi, 'feed_items',
+                             recorded_rows(asgi.feed_items)), \
+                patch.object(asgi, 'STREAM_CHUNK_SIZE', 1):
+            status, headers, html = await request('/users', cookie)
+
+            self.assertEqual(status, 200)
+            self.assertNotIn('content-length', headers)
+            self.assertIn('<p>@u2</p>', html)
+            self.assertTrue(html.rstrip().endswith('</html>'))
+            self.assertEqual(events[:2], ['start', 'rows'])
+
+            events.clear()
+            status, _, html = await request(f'/users/{self.u1_id}/likes',
+                                            cookie)
+
+            self.assertEqual(status, 200)
+            self.assertIn('m2-text', html)
+            self.assertIn('bi-heart-fill', html)
+            self.assertEqual(events[:2], ['start', 'rows'])
+
+    async def test_unauthorized(self):
+        """Tests if logged-out users are redirected with a flash message"""
+        status, headers, _ = await request('/users')
+
+        self.assertEqual(status, 302)
+        self.assertEqual(headers['location'], '/')
+        self.assertIn('session=', headers['set-cookie'])
+
+    async def test_session_off_loop(self):
+        """Tests if sessions are loaded and saved off the event loop"""
+        store = app.session_interface.store
+        threads = []
+
+        def recorded(method):
+            def record(*args):
+                threads.append(threading.current_thread())
+                return method(*args)
+            return record
+
+        cookie = session_cookie(self.u1_id)
+
+        with patch.object(store, 'load', recorded(store.load)), \
+                patch.object(store, 'save', recorded(store.save)):
+            # Loads a session, then saves a new one with a flashed message
+            await request(f'/users/{self.u1_id}', cookie)
+            await request('/users')
+
+        self.assertGreaterEqual(len(threads), 3)
+        self.assertNotIn(threading.current_thread(), threads)
+
+    async def test_wsgi_fallback(self):
+        """Tests if other routes are served by the Flask app"""
+        status, _, html = await request('/login')
+
+        self.assertEqual(status, 200)
+        self.assertIn('Welcome back.', html)
+
+    async def test_stream_messages(self):
+        """Tests if the native stream sends the retry header and closes"""
+        status, headers, body = await request(
+            '/messages/stream', session_cookie(self.u1_id),
+            disconnect_after=0.1)
+
+        self.assertEqual(status, 200)
+        self.assertTrue(headers['content-type'].startswith('text/event-stream'))
+        self.assertIn('retry:', body)
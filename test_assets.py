@@ -0,0 +1,151 @@
+"""Static asset pipeline tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_assets.py
+
+
+import gzip
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+import brotli
+
+import assets
+from app import app
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+app.config['WTF_CSRF_ENABLED'] = False
+app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
+
+CSS = b"""body { background: url("/static/images/bg.png"); }
+.other { background: url(/static/images/missing.png); }
+""" * 20
+
+PNG = b"\x89PNG\r\n\x1a\n not really a png"
+
+
+class AssetsTestCase(TestCase):
+    def setUp(self):
+        self.static_dir = tempfile.mkdtemp()
+        os.makedirs(os.path.join(self.static_dir, 'images'))
+        os.makedirs(os.path.join(self.static_dir, 'stylesheets'))
+
+        with open(os.path.join(self.static_dir, 'images', 'bg.png'), 'wb') as f:
+            f.write(PNG)
+        with open(os.path.join(
+                self.static_dir, 'stylesheets', 'style.css'), 'wb') as f:
+            f.write(CSS)
+
+        self.out_dir = os.path.join(self.static_dir, assets.DIST)
+        self.manifest = assets.build(self.static_dir, self.out_dir)
+
+        self.static_folder = app.static_folder
+        app.static_folder = self.static_dir
+        assets._manifests.clear()
+
+        self.client = app.test_client()
+
+    def tearDown(self):
+        app.static_folder = self.static_folder
+        assets._manifests.clear()
+        shutil.rmtree(self.static_dir)
+
+    def read(self, path):
+        with open(os.path.join(self.out_dir, path), 'rb') as f:
+            return f.read()
+
+    def test_build(self):
+        """Tests if assets are copied under fingerprinted names"""
+        self.assertEqual(set(self.manifest),
+                         {'images/bg.png', 'stylesheets/style.css'})
+        self.assertRegex(self.manifest['images/bg.png'],
+                         r'^images/bg\.[0-9a-f]{12}\.png$')
+        self.assertEqual(self.read(self.manifest['images/bg.png']), PNG)
+
+    def test_build_rewrites_css(self):
+        """Tests if stylesheets link to the fingerprinted names"""
+        css = self.read(self.manifest['stylesheets/style.css']).decode()
+
+        self.assertIn(f'url("/assets/{self.manifest["images/bg.png"]}")', css)
+        self.assertNotIn('/static/images/bg.png', css)
+        # Unknown files are left pointing at /static/
+        self.assertIn('url(/assets/images/missing.png)', css)
+
+    def test_build_compresses(self):
+        """Tests if compressible assets get gzip and brotli variants"""
+        css = self.manifest['stylesheets/style.css']
+        data = self.read(css)
+
+        self.assertEqual(gzip.decompress(self.read(css + '.gz')), data)
+        self.assertEqual(brotli.decompress(self.read(css + '.br')), data)
+        self.assertFalse(os.path.exists(os.path.join(
+            self.out_dir, self.manifest['images/bg.png'] + '.gz')))
+
+    def test_build_again(self):
+        """Tests if rebuilding unchanged files gives the same names"""
+        self.assertEqual(assets.build(self.static_dir, self.out_dir),
+                         self.manifest)
+
+    def test_asset_url(self):
+        """Tests if templates link built assets, or /static/ files without"""
+        with app.test_request_context():
+            self.assertEqual(
+                assets.asset_url('stylesheets/style.css'),
+                f"/assets/{self.manifest['stylesheets/style.css']}")
+            self.assertEqual(assets.asset_url('nope.js'), '/static/nope.js')
+
+    def test_serve_brotli(self):
+        """Tests if assets are served brotli-compressed, cached for good"""
+        css = self.manifest['stylesheets/style.css']
+        resp = self.client.get(f'/assets/{css}',
+                               headers={'Accept-Encoding': 'gzip, br'})
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.headers['Content-Encoding'], 'br')
+        self.assertEqual(resp.mimetype, 'text/css')
+        self.assertIn('Accept-Encoding', resp.headers['Vary'])
+        self.assertTrue(resp.cache_control.immutable)
+        self.assertTrue(resp.cache_control.public)
+        self.assertEqual(resp.cache_control.max_age, assets.CACHE_MAX_AGE)
+        self.assertFalse(resp.cache_control.no_store)
+        self.assertEqual(brotli.decompress(resp.data), self.read(css))
+        resp.close()
+
+    def test_serve_gzip(self):
+        """Tests if gzip is served to clients without brotli"""
+        css = self.manifest['stylesheets/style.css']
+        resp = self.client.get(f'/assets/{css}',
+                               headers={'Accept-Encoding': 'gzip, br;q=0'})
+
+        self.assertEqual(resp.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(gzip.decompress(resp.data), self.read(css))
+        resp.close()
+
+    def test_serve_identity(self):
+        """Tests if files are served as they are without Accept-Encoding"""
+        png = self.manifest['images/bg.png']
+        resp = self.client.get(f'/assets/{png}')
+
+        self.assertNotIn('Content-Encoding', resp.headers)
+        self.assertEqual(resp.mimetype, 'image/png')
+        self.assertEqual(resp.data, PNG)
+        resp.close()
+
+    def test_serve_missing(self):
+        """Tests if unknown or escaping paths are 404s"""
+        self.assertEqual(self.client.get('/assets/nope.css').status_code, 404)
+        self.assertEqual(
+            self.client.get('/assets/../images/bg.png').status_code, 404)
+
+    def test_no_store_only_html(self):
+        """Tests if only dynamic HTML is marked no-store"""
+        resp = self.client.get('/signup')
+        self.assertTrue(resp.cache_control.no_store)
+
+        resp = self.client.get('/static/images/bg.png')
+        self.assertFalse(resp.cache_control.no_store)
+        resp.close()
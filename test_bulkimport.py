@@ -0,0 +1,192 @@
+"""Bulk import tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_bulkimport.py
+
+
+import csv
+import os
+import tempfile
+from unittest import TestCase
+from unittest.mock import patch
+
+import bulkimport
+from app import app
+from bulkimport import staging, staged_messages, staged_follows
+from models import db, User, Message, Like, Follow
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+app.config['WTF_CSRF_ENABLED'] = False
+app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
+
+db.drop_all()
+db.create_all()
+
+HASH = "$2b$12$Q1PUFjhN/AWRQ21LbGYvjeLpZZB6lfZ1BPwifHALGO6oIbyC3CmJe"
+
+USERS = [
+    ['email', 'username', 'image_url', 'password', 'bio',
+     'header_image_url', 'location'],
+    ['alice@example.org', 'alice', '', HASH, "Hi", '', "Paris"],
+    ['existing@example.org', 'existing', '', HASH, '', '', ''],
+    ['not-an-email', 'bob', '', HASH, '', '', ''],
+    ['alice2@example.org', 'alice', '', HASH, '', '', ''],
+    ['other@example.org', 'carol', '', HASH, '', '', ''],
+    ['mallory@example.org', 'other', '', HASH, '', '', ''],
+]
+
+MESSAGES = [
+    ['text', 'timestamp', 'user_id'],
+    ["alice-text", '2023-01-01 10:00:00.000001', '1'],
+    ["existing-text", '2023-01-02 10:00:00', '2'],
+    ["bob-text", '2023-01-03 10:00:00', '3'],
+    ["alice-text", '2023-01-01 10:00:00.000001', '1'],
+    ["x" * 141, '2023-01-04 10:00:00', '1'],
+    ["mallory-text", '2023-01-05 10:00:00', '6'],
+]
+
+FOLLOWS = [
+    ['user_being_followed_id', 'user_following_id'],
+    ['2', '1'],
+    ['1', '2'],
+    ['3', '1'],
+    ['1', '1'],
+]
+
+
+def interrupt(after, upto):
+    raise RuntimeError("interrupted")
+
+
+def write_csvs(directory):
+    for name, rows in (('users.csv', USERS), ('messages.csv', MESSAGES),
+                       ('follows.csv', FOLLOWS)):
+        with open(os.path.join(directory, name), 'w', newline='') as f:
+            csv.writer(f).writerows(rows)
+
+
+class BulkImportTestCase(TestCase):
+    def setUp(self):
+        Like.query.delete()
+        Follow.query.delete()
+        Message.query.delete()
+        User.query.delete()
+
+        existing = User.signup("existing", "existing@example.org",
+                               "password", None)
+        User.signup("other", "other@example.org", "password", None)
+        db.session.commit()
+        self.existing_id = existing.id
+
+        self.directory = tempfile.TemporaryDirectory()
+        write_csvs(self.directory.name)
+
+    def tearDown(self):
+        self.directory.cleanup()
+        db.session.rollback()
+        staging.drop_all(db.engine)
+        Like.query.delete()
+        Follow.query.delete()
+        db.session.commit()
+
+    def run_import(self, batch_size=2):
+        return app.test_cli_runner().invoke(args=[
+            'imports', 'run', self.directory.name,
+            '--batch-size', str(batch_size)])
+
+    def user_id(self, username):
+        return db.session.scalar(
+            db.select(User.id).where(User.username == username))
+
+    def assertImported(self):
+        alice_id = self.user_id('alice')
+
+        self.assertEqual(User.query.count(), 3)
+        self.assertEqual(
+            sorted((m.user_id, m.text) for m in Message.query),
+            sorted([(alice_id, "alice-text"),
+                    (self.existing_id, "existing-text")]))
+        self.assertEqual(
+            sorted((f.user_being_followed_id, f.user_following_id)
+                   for f in Follow.query),
+            sorted([(self.existing_id, alice_id),
+                    (alice_id, self.existing_id)]))
+
+    def test_import(self):
+        """Tests if valid, new rows are imported and the rest reported"""
+        result = self.run_import()
+
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertImported()
+
+        alice = db.session.get(User, self.user_id('alice'))
+        self.assertEqual(alice.location, "Paris")
+        self.assertTrue(alice.image_url)
+        self.assertGreater(alice.state_version, 0)
+
+        for line in ("invalid email: 1", "duplicate username: 1",
+                     "email taken: 1", "username taken: 1",
+                     "duplicate message: 1", "unknown user: 2", "text too long: 1",
+                     "follows themselves: 1"):
+            self.assertIn(line, result.output)
+
+        self.assertFalse(
+            db.inspect(db.engine).has_table('import_checkpoints'))
+
+    def test_idempotent(self):
+        """Tests if importing the same files again adds nothing"""
+        self.run_import()
+        result = self.run_import()
+
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertImported()
+
+    def test_resume(self):
+        """Tests if an interrupted import carries on from its checkpoint"""
+        insert_batch = bulkimport.INSERTS['messages'][1]
+
+        def interrupted(after, upto):
+            if after:
+                interrupt(after, upto)
+            insert_batch(after, upto)
+
+        with patch.dict(bulkimport.INSERTS,
+                        {'messages': (staged_messages, interrupted)}):
+            result = self.run_import(batch_size=1)
+        db.session.rollback()
+
+        self.assertIsInstance(result.exception, RuntimeError)
+        self.assertEqual(Message.query.count(), 1)
+
+        status = app.test_cli_runner().invoke(args=['imports', 'status'])
+        self.assertIn("messages: 1", status.output)
+
+        result = self.run_import(batch_size=1)
+
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertIn("Resuming", result.output)
+        self.assertNotIn("load users.csv", result.output)
+        self.assertImported()
+
+    def test_other_source(self):
+        """Tests if another import can't start until one is finished or
+        aborted"""
+        with patch.dict(bulkimport.INSERTS,
+                        {'follows': (staged_follows, interrupt)}):
+            self.run_import()
+        db.session.rollback()
+
+        with tempfile.TemporaryDirectory() as other:
+            write_csvs(other)
+            result = app.test_cli_runner().invoke(
+                args=['imports', 'run', other])
+            self.assertIn("is unfinished", result.output)
+
+            app.test_cli_runner().invoke(args=['imports', 'abort'])
+            result = app.test_cli_runner().invoke(
+                args=['imports', 'run', other])
+            self.assertEqual(result.exit_code, 0, result.output)
+
+        self.assertImported()
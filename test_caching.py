@@ -0,0 +1,100 @@
+"""HTTP cache policy tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_caching.py
+
+
+import os
+from unittest import TestCase
+
+from app import app, CURR_USER_KEY
+from models import db, User, Message, Like, Follow
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+app.config['WTF_CSRF_ENABLED'] = False
+app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
+
+db.drop_all()
+db.create_all()
+
+
+class CachePolicyTestCase(TestCase):
+    def setUp(self):
+        Like.query.delete()
+        Follow.query.delete()
+        Message.query.delete()
+        User.query.delete()
+
+        u1 = User.signup("u1", "u1@email.com", "password", None)
+        db.session.flush()
+        m1 = Message(text="m1-text", user_id=u1.id)
+        db.session.add(m1)
+        db.session.commit()
+
+        self.u1_id = u1.id
+        self.m1_id = m1.id
+        self.client = app.test_client()
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def log_in(self):
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.u1_id
+
+    def test_anonymous_homepage(self):
+        """Tests if the anonymous homepage is cacheable by shared caches"""
+        resp = self.client.get('/')
+
+        cache_control = resp.cache_control
+        self.assertTrue(cache_control.public)
+        self.assertEqual(cache_control.max_age, 300)
+        self.assertEqual(cache_control.s_maxage, 3600)
+        self.assertEqual(cache_control['stale-while-revalidate'], '86400')
+        self.assertIn('Cookie', resp.vary)
+        self.assertIsNone(resp.headers.get('Set-Cookie'))
+
+    def test_revalidate(self):
+        """Tests if unchanged cacheable pages answer with 304"""
+        etag = self.client.get('/').headers['ETag']
+
+        resp = self.client.get('/', headers={'If-None-Match': etag})
+
+        self.assertEqual(resp.status_code, 304)
+
+    def test_login_required(self):
+        """Tests if profiles and messages still need a login"""
+        for path in (f'/users/{self.u1_id}', f'/messages/{self.m1_id}'):
+            resp = self.client.get(path)
+
+            self.assertEqual(resp.status_code, 302)
+            self.assertFalse(resp.cache_control.public)
+
+    def test_logged_in(self):
+        """Tests if pages for logged-in users aren't stored"""
+        self.log_in()
+
+        for path in ('/', f'/users/{self.u1_id}'):
+            resp = self.client.get(path)
+
+            self.assertTrue(resp.cache_control.no_store)
+            self.assertFalse(resp.cache_control.public)
+            self.assertIn('Cookie', resp.vary)
+
+    def test_flashed(self):
+        """Tests if pages showing a flashed message aren't stored"""
+        with self.client.session_transaction() as sess:
+            sess['_flashes'] = [('danger', "Access unauthorized.")]
+
+        resp = self.client.get('/')
+
+        self.assertIn("Access unauthorized.", resp.get_data(as_text=True))
+        self.assertTrue(resp.cache_control.no_store)
+
+    def test_no_policy(self):
+        """Tests if pages without a policy aren't stored"""
+        resp = self.client.get('/login')
+
+        self.assertTrue(resp.cache_control.no_store)
@@ -0,0 +1,167 @@
+"""Response compression and minification tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_compression.py
+
+
+import gzip
+import os
+from unittest import TestCase
+
+import brotli
+from werkzeug.test import Client
+from werkzeug.wrappers import Response
+
+from app import app, CURR_USER_KEY
+from compression import (
+    Compressor, MinifyWhitespace, choose_encoding, minify_whitespace)
+from models import db, User, Message, Like, Follow
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+app.config['WTF_CSRF_ENABLED'] = False
+app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
+
+db.drop_all()
+db.create_all()
+
+BODY = b"<li>hello, world</li>\n" * 200
+
+
+def make_app(body=BODY, mimetype='text/html', **headers):
+    """A WSGI app responding with `body`: bytes, or a list of chunks."""
+
+    closed = []
+
+    def wsgi_app(environ, start_response):
+        response = Response(body, mimetype=mimetype, headers=headers)
+        response.call_on_close(lambda: closed.append(True))
+        return response(environ, start_response)
+
+    return wsgi_app, closed
+
+
+class ChooseEncodingTestCase(TestCase):
+    def test_choose_encoding(self):
+        """Tests if the best accepted encoding is chosen"""
+        self.assertEqual(choose_encoding('gzip, deflate, br'), 'br')
+        self.assertEqual(choose_encoding('gzip, br;q=0'), 'gzip')
+        self.assertEqual(choose_encoding('*'), 'br')
+        self.assertIsNone(choose_encoding('deflate'))
+        self.assertIsNone(choose_encoding(''))
+
+
+class CompressorTestCase(TestCase):
+    def get(self, wsgi_app, accept='gzip, br', method='GET'):
+        client = Client(Compressor(wsgi_app, min_size=1024))
+        return client.open('/', method=method,
+                           headers={'Accept-Encoding': accept})
+
+    def test_brotli(self):
+        """Tests if large responses are brotli-compressed"""
+        wsgi_app, closed = make_app(ETag='"abc"')
+        resp = self.get(wsgi_app)
+
+        self.assertEqual(resp.headers['Content-Encoding'], 'br')
+        self.assertEqual(resp.headers['Vary'], 'Accept-Encoding')
+        self.assertEqual(resp.headers['ETag'], 'W/"abc"')
+        self.assertNotIn('Content-Length', resp.headers)
+        self.assertEqual(brotli.decompress(resp.data), BODY)
+        self.assertLess(len(resp.data), len(BODY) / 10)
+        self.assertEqual(closed, [True])
+
+    def test_gzip(self):
+        """Tests if clients without brotli get gzip"""
+        resp = self.get(make_app()[0], accept='gzip')
+
+        self.assertEqual(resp.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(gzip.decompress(resp.data), BODY)
+
+    def test_streamed(self):
+        """Tests if streamed responses are compressed as they stream"""
+        chunks = [b"<p>%d</p>\n" % i * 500 for i in range(10)]
+        wsgi_app, closed = make_app(chunks)
+        resp = self.get(wsgi_app)
+
+        self.assertEqual(brotli.decompress(resp.data), b''.join(chunks))
+        self.assertEqual(closed, [True])
+
+    def test_not_accepted(self):
+        """Tests if responses are sent as they are without Accept-Encoding"""
+        resp = self.get(make_app()[0], accept='')
+
+        self.assertNotIn('Content-Encoding', resp.headers)
+        self.assertEqual(resp.headers['Vary'], 'Accept-Encoding')
+        self.assertEqual(resp.data, BODY)
+
+    def test_small(self):
+        """Tests if responses under the minimum size aren't compressed"""
+        for body in (b"<p>small</p>", [b"<p>small</p>", b"<p>chunks</p>"]):
+            resp = self.get(make_app(body)[0])
+
+            self.assertNotIn('Content-Encoding', resp.headers)
+            self.assertEqual(resp.data, b''.join(body)
+                             if isinstance(body, list) else body)
+
+    def test_skipped(self):
+        """Tests if uncompressible or already encoded responses pass through"""
+        for wsgi_app in (make_app(mimetype='image/png')[0],
+                         make_app(mimetype='text/event-stream')[0],
+                         make_app(**{'Content-Encoding': 'gzip'})[0]):
+            resp = self.get(wsgi_app)
+
+            self.assertEqual(resp.data, BODY)
+            self.assertNotIn('Vary', resp.headers)
+
+        resp = self.get(make_app()[0], method='HEAD')
+        self.assertNotIn('Content-Encoding', resp.headers)
+
+
+class MinifyWhitespaceTestCase(TestCase):
+    def test_minify(self):
+        """Tests if indentation collapses, except in protected elements"""
+        html = ("<ul>\n    <li>a</li>\n\n    <li>b  c</li>\n</ul>\n"
+                "<pre>\n  keep\n    this</pre>\n  <script>\n  x = 1\n"
+                "</script>")
+
+        self.assertEqual(
+            minify_whitespace(html),
+            "<ul>\n<li>a</li>\n<li>b  c</li>\n</ul>\n"
+            "<pre>\n  keep\n    this</pre>\n<script>\n  x = 1\n</script>")
+
+    def test_templates_minified(self):
+        """Tests if every template still compiles once minified"""
+        env = app.jinja_env.overlay(extensions=[MinifyWhitespace])
+
+        for name in env.list_templates(extensions=['html']):
+            env.get_template(name)
+
+
+class CompressedPageTestCase(TestCase):
+    def setUp(self):
+        Like.query.delete()
+        Follow.query.delete()
+        Message.query.delete()
+        User.query.delete()
+
+        u1 = User.signup("u1", "u1@email.com", "password", None)
+        db.session.flush()
+        db.session.add_all([Message(text=f"message {i}", user_id=u1.id)
+                            for i in range(20)])
+        db.session.commit()
+
+        self.u1_id = u1.id
+        self.client = app.test_client()
+
+    def test_compressed_feed(self):
+        """Tests if the feed is served compressed to browsers"""
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            resp = c.get('/', headers={'Accept-Encoding': 'gzip, br'})
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(resp.headers['Content-Encoding'], 'br')
+            self.assertIn(b'message 19', brotli.decompress(resp.data))
@@ -0,0 +1,205 @@
+"""Data export tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_exports.py
+
+
+import csv
+import io
+import json
+import os
+import tempfile
+import time
+import zipfile
+from datetime import datetime, timedelta
+from unittest import TestCase
+
+import app as app_module
+from app import app, CURR_USER_KEY
+from exports import EXPORT_TIMEOUT, EXPORT_TTL, Exporter, write_archive
+from models import db, User, Message, Like, Follow, Export
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+app.config['WTF_CSRF_ENABLED'] = False
+app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
+
+db.drop_all()
+db.create_all()
+
+
+class ExportTestCase(TestCase):
+    def setUp(self):
+        Export.query.delete()
+        Like.query.delete()
+        Follow.query.delete()
+        Message.query.delete()
+        User.query.delete()
+
+        u1 = User.signup("u1", "u1@email.com", "password", None)
+        u2 = User.signup("u2", "u2@email.com", "password", None)
+        db.session.flush()
+
+        now = datetime.utcnow()
+        for n in range(5):
+            db.session.add(Message(text=f"u1-message-{n}", user_id=u1.id,
+                                   timestamp=now + timedelta(seconds=n)))
+        m2 = Message(text="u2-message, with \"quotes\"", user_id=u2.id)
+        db.session.add(m2)
+        db.session.flush()
+
+        db.session.add(Like(user_id=u1.id, message_id=m2.id))
+        db.session.add(Follow(user_following_id=u1.id,
+                              user_being_followed_id=u2.id))
+        db.session.commit()
+
+        self.u1_id = u1.id
+        self.u2_id = u2.id
+        self.m2_id = m2.id
+
+        self.directory = tempfile.TemporaryDirectory()
+        self.exporter = Exporter(self.directory.name)
+        self.exporter.init_app(app)
+        self.original_exporter = app_module.exporter
+        app_module.exporter = self.exporter
+
+    def tearDown(self):
+        app_module.exporter = self.original_exporter
+        self.original_exporter.init_app(app)
+        self.directory.cleanup()
+
+        db.session.rollback()
+        Export.query.delete()
+        Like.query.delete()
+        Follow.query.delete()
+        db.session.commit()
+        # Ids are reused by the next test's rows
+        db.session.expunge_all()
+
+    def client(self, user_id):
+        client = app.test_client()
+        with client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = user_id
+        return client
+
+    def export(self, format):
+        """Export u1's data through the views; return the Export."""
+
+        self.client(self.u1_id).post('/users/exports',
+                                     data={'format': format})
+
+        deadline = time.monotonic() + 10
+        while True:
+            db.session.commit()
+            export = Export.query.filter_by(user_id=self.u1_id).one()
+            if export.status in ('done', 'failed'):
+                return export
+            self.assertLess(time.monotonic(), deadline)
+            time.sleep(0.01)
+
+    def download(self, export, **kwargs):
+        return self.client(self.u1_id).get(
+            f'/users/exports/{export.id}', **kwargs)
+
+    def test_ndjson(self):
+        """Tests if a background job zips the user's data as NDJSON"""
+        export = self.export('ndjson')
+        self.assertEqual(export.status, 'done')
+
+        resp = self.download(export)
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.mimetype, 'application/zip')
+        self.assertIn('attachment', resp.headers['Content-Disposition'])
+
+        with zipfile.ZipFile(io.BytesIO(resp.data)) as archive:
+            def rows(name):
+                lines = archive.read(name).decode().splitlines()
+                return [json.loads(line) for line in lines]
+
+            self.assertEqual(rows('profile.ndjson')[0]['username'], 'u1')
+            self.assertEqual(
+                [row['text'] for row in rows('messages.ndjson')],
+                [f"u1-message-{n}" for n in range(5)])
+            self.assertEqual(rows('likes.ndjson'), [{
+                'message_id': self.m2_id,
+                'author': 'u2',
+                'text': "u2-message, with \"quotes\"",
+                'timestamp': rows('likes.ndjson')[0]['timestamp'],
+            }])
+            self.assertEqual(rows('following.ndjson'),
+                             [{'id': self.u2_id, 'username': 'u2'}])
+            self.assertEqual(rows('followers.ndjson'), [])
+
+    def test_csv(self):
+        """Tests if rows are written as CSV, batch by batch"""
+        path = os.path.join(self.directory.name, 'export.zip')
+        with app.app_context():
+            write_archive(path, self.u1_id, 'csv', batch_size=2)
+
+        with zipfile.ZipFile(path) as archive:
+            def rows(name):
+                text = archive.read(name).decode()
+                return list(csv.reader(io.StringIO(text)))
+
+            messages = rows('messages.csv')
+            self.assertEqual(messages[0], ['id', 'text', 'timestamp'])
+            self.assertEqual([row[1] for row in messages[1:]],
+                             [f"u1-message-{n}" for n in range(5)])
+            self.assertEqual(rows('likes.csv')[1][2],
+                             "u2-message, with \"quotes\"")
+
+    def test_range(self):
+        """Tests if downloads answer range requests"""
+        export = self.export('csv')
+        full = self.download(export).data
+
+        resp = self.download(export, headers={'Range': 'bytes=10-19'})
+
+        self.assertEqual(resp.status_code, 206)
+        self.assertEqual(resp.data, full[10:20])
+        self.assertEqual(resp.headers['Content-Range'],
+                         f"bytes 10-19/{len(full)}")
+
+    def test_other_user(self):
+        """Tests if users can't download others' exports"""
+        export = self.export('csv')
+
+        resp = self.client(self.u2_id).get(f'/users/exports/{export.id}')
+        self.assertEqual(resp.status_code, 404)
+
+    def test_one_at_a_time(self):
+        """Tests if only one export is prepared at a time"""
+        db.session.add(Export(user_id=self.u1_id, format='csv',
+                              status='running'))
+        db.session.commit()
+
+        resp = self.client(self.u1_id).post(
+            '/users/exports', data={'format': 'csv'}, follow_redirects=True)
+
+        self.assertIn("already being prepared", resp.get_data(as_text=True))
+        self.assertEqual(Export.query.count(), 1)
+
+    def test_purge(self):
+        """Tests if expired and lost exports are deleted with their files"""
+        now = datetime.utcnow()
+        expired = Export(user_id=self.u1_id, format='csv', status='done',
+                         created=now - EXPORT_TTL * 2,
+                         finished=now - EXPORT_TTL * 2)
+        lost = Export(user_id=self.u1_id, format='csv', status='running',
+                      created=now - EXPORT_TIMEOUT * 2)
+        kept = Export(user_id=self.u1_id, format='csv', status='done',
+                      created=now, finished=now)
+        db.session.add_all([expired, lost, kept])
+        db.session.commit()
+
+        for export in (expired, kept):
+            with open(self.exporter.path(export), 'wb') as f:
+                f.write(b"zip")
+
+        result = app.test_cli_runner().invoke(args=['exports', 'purge'])
+
+        self.assertIn("Deleted 2 exports", result.output)
+        self.assertEqual(Export.query.count(), 1)
+        self.assertFalse(os.path.exists(self.exporter.path(expired)))
+        self.assertTrue(os.path.exists(self.exporter.path(kept)))
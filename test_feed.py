@@ -0,0 +1,136 @@
+"""Hybrid home feed tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_feed.py
+
+
+import os
+from unittest import TestCase
+
+import feed
+from app import app, CURR_USER_KEY
+from models import db, User, Message, Like, Follow, FeedEntry
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+app.config['WTF_CSRF_ENABLED'] = False
+app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
+
+db.drop_all()
+db.create_all()
+
+
+class FeedTestCase(TestCase):
+    def setUp(self):
+        FeedEntry.query.delete()
+        Like.query.delete()
+        Follow.query.delete()
+        Message.query.delete()
+        User.query.delete()
+
+        users = [User.signup(f"u{n}", f"u{n}@email.com", "password", None)
+                 for n in range(4)]
+        db.session.flush()
+        self.author_id, *self.follower_ids = [user.id for user in users]
+        db.session.commit()
+
+        feed.FEED_FANOUT = True
+        feed.FEED_CELEBRITY_THRESHOLD = 3
+
+    def tearDown(self):
+        feed.FEED_FANOUT = False
+        feed.FEED_CELEBRITY_THRESHOLD = 10_000
+        db.session.rollback()
+        FeedEntry.query.delete()
+        Like.query.delete()
+        Follow.query.delete()
+        db.session.commit()
+
+    def client(self, user_id):
+        client = app.test_client()
+        with client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = user_id
+        return client
+
+    def follow(self, follower_ids):
+        for follower_id in follower_ids:
+            self.client(follower_id).post(f'/users/follow/{self.author_id}')
+
+    def post(self, text):
+        self.client(self.author_id).post('/messages/new', data={'text': text})
+        return db.session.scalar(
+            db.select(Message.id).where(Message.text == text))
+
+    def entries(self, **where):
+        return FeedEntry.query.filter_by(**where).count()
+
+    def home(self, user_id):
+        return self.client(user_id).get('/').get_data(as_text=True)
+
+    def test_fan_out(self):
+        """Tests if a message is copied into each follower's feed"""
+        self.follow(self.follower_ids[:2])
+        message_id = self.post("fanned-out")
+
+        self.assertEqual(self.entries(message_id=message_id), 2)
+        self.assertIn('fanned-out', self.home(self.follower_ids[0]))
+        self.assertNotIn('fanned-out', self.home(self.follower_ids[2]))
+
+    def test_celebrity(self):
+        """Tests if authors with many followers are merged in on read"""
+        self.follow(self.follower_ids[:2])
+        copied_id = self.post("copied")
+        self.assertEqual(self.entries(message_id=copied_id), 2)
+
+        self.follow(self.follower_ids[2:])
+        first_id = self.post("merged-on-read")
+
+        # Not copied even as the author crosses the threshold
+        self.assertEqual(self.entries(message_id=first_id), 0)
+        self.assertTrue(db.session.get(User, self.author_id).celebrity)
+
+        html = self.home(self.follower_ids[0])
+        self.assertIn('copied', html)
+        self.assertIn('merged-on-read', html)
+
+    def test_follow_backfills(self):
+        """Tests if following copies recent messages, unfollowing drops them"""
+        self.post("before-following")
+        follower_id = self.follower_ids[0]
+
+        self.follow([follower_id])
+        self.assertEqual(self.entries(user_id=follower_id), 1)
+        self.assertIn('before-following', self.home(follower_id))
+
+        self.client(follower_id).post(
+            f'/users/stop-following/{self.author_id}')
+        self.assertEqual(self.entries(user_id=follower_id), 0)
+        self.assertNotIn('before-following', self.home(follower_id))
+
+    def test_delete_message(self):
+        """Tests if deleted messages leave every feed"""
+        self.follow(self.follower_ids[:2])
+        message_id = self.post("deleted")
+
+        self.client(self.author_id).post(f'/messages/{message_id}/delete')
+
+        self.assertEqual(self.entries(message_id=message_id), 0)
+
+    def test_rebuild(self):
+        """Tests if rebuilding marks celebrities and refills feeds"""
+        feed.FEED_FANOUT = False
+        self.follow(self.follower_ids)
+        self.post("written-while-off")
+        feed.FEED_FANOUT = True
+
+        result = app.test_cli_runner().invoke(
+            args=['feed', 'rebuild', '--threshold', '4'])
+        self.assertIn("0 celebrities", result.output)
+        self.assertEqual(self.entries(author_id=self.author_id), 3)
+
+        result = app.test_cli_runner().invoke(
+            args=['feed', 'rebuild', '--threshold', '3'])
+        self.assertIn("1 celebrities", result.output)
+        self.assertEqual(self.entries(author_id=self.author_id), 0)
+        self.assertIn('written-while-off', self.home(self.follower_ids[0]))
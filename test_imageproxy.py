@@ -0,0 +1,217 @@
+"""Image proxy tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_imageproxy.py
+
+
+import io
+import os
+import shutil
+import tempfile
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import TestCase
+from unittest.mock import patch
+
+from PIL import Image
+
+import app as app_module
+import imageproxy
+from app import app
+from imageproxy import (
+    SIZES, ImageCache, ImageFetchError, check_host, fetch, thumbnail_url)
+
+app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
+
+
+def png(width, height, color):
+    out = io.BytesIO()
+    Image.new('RGB', (width, height), color).save(out, 'PNG')
+    return out.getvalue()
+
+
+class FakeOrigin:
+    """A local HTTP server serving `files`, and `redirects` (path: URL),
+    counting requests per path and recording their Host headers."""
+
+    def __init__(self, files, redirects=None):
+        self.files = files
+        self.redirects = redirects or {}
+        self.hits = {}
+        self.hosts = []
+        origin = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                origin.hits[self.path] = origin.hits.get(self.path, 0) + 1
+                origin.hosts.append(self.headers['Host'])
+
+                if self.path in origin.redirects:
+                    self.send_response(302)
+                    self.send_header('Location', origin.redirects[self.path])
+                    self.end_headers()
+                    return
+
+                body = origin.files.get(self.path)
+
+                if body is None:
+                    self.send_response(404)
+                    self.end_headers()
+                    return
+
+                self.send_response(200)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def url(self, path):
+        return f"http://127.0.0.1:{self.server.server_port}{path}"
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class ImageProxyTestCase(TestCase):
+    def setUp(self):
+        self.origin = FakeOrigin({
+            '/big.png': png(2000, 1000, 'red'),
+            '/copy.png': png(2000, 1000, 'red'),
+            '/other.png': png(300, 300, 'blue'),
+            '/not-an-image': b"<html></html>",
+        })
+        self.directory = tempfile.mkdtemp()
+        self.cache = ImageCache(self.directory, allow_private=True)
+
+    def tearDown(self):
+        self.origin.close()
+        shutil.rmtree(self.directory)
+
+    def test_thumbnails(self):
+        """Tests if images are fetched once and resized to every size"""
+        url = self.origin.url('/big.png')
+
+        for size, dimensions in SIZES.items():
+            path, digest = self.cache.get(url, size)
+            with Image.open(path) as image:
+                self.assertEqual(image.format, 'WEBP')
+                self.assertEqual(image.size, dimensions)
+
+        self.assertEqual(self.origin.hits, {'/big.png': 1})
+
+    def test_content_addressed(self):
+        """Tests if URLs with the same image share thumbnails"""
+        path, digest = self.cache.get(self.origin.url('/big.png'), 'avatar')
+        copy_path, copy_digest = self.cache.get(
+            self.origin.url('/copy.png'), 'avatar')
+
+        self.assertEqual(path, copy_path)
+        self.assertEqual(digest, copy_digest)
+
+    def test_eviction(self):
+        """Tests if the least recently used images go once over the limit"""
+        big = self.origin.url('/big.png')
+        other = self.origin.url('/other.png')
+
+        big_path, _ = self.cache.get(big, 'avatar')
+        size = self.cache._disk_usage()
+        self.cache.max_bytes = size + 1
+
+        # Needs room, so evicts the older image
+        other_path, _ = self.cache.get(other, 'avatar')
+
+        self.assertFalse(os.path.exists(big_path))
+        self.assertTrue(os.path.exists(other_path))
+        self.assertLessEqual(self.cache._disk_usage(), size + 1)
+
+    def test_fetch_errors(self):
+        """Tests if missing and non-image URLs raise ImageFetchError"""
+        with self.assertRaises(ImageFetchError):
+            self.cache.get(self.origin.url('/missing.png'), 'avatar')
+        with self.assertRaises(ImageFetchError):
+            self.cache.get(self.origin.url('/not-an-image'), 'avatar')
+
+    def test_private_hosts_refused(self):
+        """Tests if private addresses aren't fetched by default"""
+        with self.assertRaises(ImageFetchError):
+            check_host(self.origin.url('/big.png'))
+        with self.assertRaises(ImageFetchError):
+            ImageCache(self.directory).get(
+                self.origin.url('/big.png'), 'avatar')
+
+    def test_pinned_address(self):
+        """Tests if each hop connects to the address that was checked, not
+        to whatever its host resolves to then"""
+        port = self.origin.server.server_port
+        self.origin.redirects['/hop'] = f"http://second.test:{port}/big.png"
+
+        # *.test names don't resolve: only the checked address can be used
+        with patch.object(imageproxy, 'check_host',
+                          return_value='127.0.0.1') as check:
+            data = fetch(f"http://first.test:{port}/hop")
+
+        self.assertEqual(data, self.origin.files['/big.png'])
+        self.assertEqual(
+            [call.args[0] for call in check.call_args_list],
+            [f"http://first.test:{port}/hop",
+             f"http://second.test:{port}/big.png"])
+        self.assertEqual(self.origin.hosts,
+                         [f"first.test:{port}", f"second.test:{port}"])
+
+    def test_redirect_scheme(self):
+        """Tests if redirects to non-http(s) URLs aren't followed"""
+        self.origin.redirects['/hop'] = "ftp://127.0.0.1/big.png"
+
+        with self.assertRaises(ImageFetchError):
+            fetch(self.origin.url('/hop'), allow_private=True)
+
+    def test_thumbnail_url(self):
+        """Tests if only http(s) URLs are proxied"""
+        self.assertEqual(thumbnail_url('key', '/static/x.png', 'avatar'),
+                         '/static/x.png')
+        self.assertTrue(thumbnail_url('key', 'https://x.test/a.png', 'avatar')
+                        .startswith('/images/avatar/'))
+
+
+class ImageViewTestCase(TestCase):
+    def setUp(self):
+        self.origin = FakeOrigin({'/big.png': png(2000, 1000, 'red')})
+        self.directory = tempfile.mkdtemp()
+        app_module.image_cache = ImageCache(self.directory, allow_private=True)
+        self.client = app.test_client()
+
+    def tearDown(self):
+        self.origin.close()
+        shutil.rmtree(self.directory)
+
+    def test_show_image(self):
+        """Tests if signed image URLs are served with long-lived caching"""
+        with app.test_request_context():
+            url = app_module.thumbnail(self.origin.url('/big.png'), 'avatar')
+
+        resp = self.client.get(url)
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.mimetype, 'image/webp')
+        self.assertTrue(resp.cache_control.public)
+        self.assertTrue(resp.cache_control.immutable)
+        self.assertEqual(resp.cache_control.max_age, 365 * 24 * 60 * 60)
+        self.assertFalse(resp.cache_control.no_store)
+
+        resp = self.client.get(url, headers={'If-None-Match': resp.get_etag()[0]})
+        self.assertEqual(resp.status_code, 304)
+
+    def test_show_image_bad_signature(self):
+        """Tests if unsigned image URLs aren't fetched"""
+        resp = self.client.get(
+            f"/images/avatar/0123?url={self.origin.url('/big.png')}")
+
+        self.assertEqual(resp.status_code, 404)
+        self.assertEqual(self.origin.hits, {})
@@ -0,0 +1,255 @@
+"""Like buffer tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_likebuffer.py
+
+
+import os
+import subprocess
+import sys
+import tempfile
+from unittest import TestCase
+from unittest.mock import patch
+
+from flask import Response
+
+import app as app_module
+from app import app, CURR_USER_KEY
+from likebuffer import (
+    PENDING_KEY, PENDING_SECONDS, LikeBuffer, merge_pending, pending_changes,
+    read_log, remember_pending)
+from models import db, User, Message, Like, Follow
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+app.config['WTF_CSRF_ENABLED'] = False
+app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
+
+db.drop_all()
+db.create_all()
+
+# Logs likes in a process that then dies without flushing
+CRASH = """
+import os, sys
+from flask import Flask
+from likebuffer import LikeBuffer
+from models import db
+
+app = Flask(__name__)
+app.config['SQLALCHEMY_DATABASE_URI'] = sys.argv[1]
+db.init_app(app)
+
+buffer = LikeBuffer(sys.argv[2], flush_interval=3600)
+buffer.init_app(app)
+for event in sys.argv[3:]:
+    if event == 'flush':
+        buffer.flush()
+    else:
+        user_id, message_id, action = event.split(':')
+        getattr(buffer, action)(int(user_id), int(message_id))
+os._exit(1)
+"""
+
+
+class LikeBufferTestCase(TestCase):
+    def setUp(self):
+        Like.query.delete()
+        Follow.query.delete()
+        Message.query.delete()
+        User.query.delete()
+
+        u1 = User.signup("u1", "u1@email.com", "password", None)
+        u2 = User.signup("u2", "u2@email.com", "password", None)
+        db.session.flush()
+
+        m1 = Message(text="first message", user_id=u2.id)
+        m2 = Message(text="second message", user_id=u2.id)
+        db.session.add_all([m1, m2])
+        db.session.commit()
+
+        self.u1_id = u1.id
+        self.m1_id = m1.id
+        self.m2_id = m2.id
+
+        self.directory = tempfile.TemporaryDirectory()
+        self.buffers = []
+
+    def tearDown(self):
+        for buffer in self.buffers:
+            buffer.close()
+        app_module.like_buffer = None
+        self.directory.cleanup()
+
+    def buffer(self, directory=None):
+        buffer = LikeBuffer(directory or self.directory.name,
+                            flush_interval=3600)
+        buffer.init_app(app)
+        self.buffers.append(buffer)
+        return buffer
+
+    def liked_ids(self):
+        return set(db.session.scalars(
+            db.select(Like.message_id).where(Like.user_id == self.u1_id)))
+
+    def crash(self, *events):
+        """Log `events` ("user:message:like|unlike", or "flush") in another
+        process, which dies without writing what it buffered."""
+
+        subprocess.run(
+            [sys.executable, '-c', CRASH,
+             db.engine.url.render_as_string(hide_password=False),
+             self.directory.name, *events],
+            cwd=os.path.dirname(os.path.abspath(__file__)))
+
+    def test_flush(self):
+        """Tests if buffered events are written together, last one winning"""
+        buffer = self.buffer()
+        version = db.session.get(User, self.u1_id).state_version
+
+        buffer.like(self.u1_id, self.m1_id)
+        buffer.like(self.u1_id, self.m2_id)
+        buffer.unlike(self.u1_id, self.m2_id)
+
+        self.assertEqual(self.liked_ids(), set())
+        self.assertEqual(buffer.overlay(self.u1_id),
+                         ({self.m1_id}, {self.m2_id}))
+
+        buffer.flush()
+        db.session.expire_all()
+
+        self.assertEqual(self.liked_ids(), {self.m1_id})
+        self.assertIsNone(buffer.overlay(self.u1_id))
+        self.assertEqual(db.session.get(User, self.u1_id).state_version,
+                         version + 1)
+
+    def test_read_your_writes(self):
+        """Tests if a user sees their likes before they're written"""
+        app_module.like_buffer = self.buffer()
+
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            c.post(f'/messages/{self.m1_id}/like')
+            self.assertEqual(self.liked_ids(), set())
+
+            html = c.get(f'/users/{self.u1_id}/likes').get_data(as_text=True)
+            self.assertIn('first message', html)
+            self.assertNotIn('second message', html)
+            self.assertIn('bi-heart-fill', html)
+
+            app_module.like_buffer.flush()
+            self.assertEqual(self.liked_ids(), {self.m1_id})
+
+            c.post(f'/messages/{self.m1_id}/unlike')
+            html = c.get(f'/users/{self.u1_id}/likes').get_data(as_text=True)
+            self.assertNotIn('first message', html)
+
+    def test_read_your_writes_elsewhere(self):
+        """Tests if a user sees their likes on a process that didn't
+        buffer them"""
+        app_module.like_buffer = self.buffer()
+
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            c.post(f'/messages/{self.m1_id}/like')
+
+            # The redirect lands on another worker, with its own buffer
+            other = tempfile.TemporaryDirectory()
+            self.addCleanup(other.cleanup)
+            app_module.like_buffer = self.buffer(other.name)
+            self.assertIsNone(app_module.like_buffer.overlay(self.u1_id))
+
+            html = c.get(f'/users/{self.u1_id}/likes').get_data(as_text=True)
+            self.assertIn('first message', html)
+            self.assertNotIn('second message', html)
+
+    @patch.dict(app.session_interface.mergers, {PENDING_KEY: merge_pending})
+    def test_pending_concurrent_save(self):
+        """Tests if a like kept in the session survives another request of
+        that session saving it meanwhile"""
+        app_module.like_buffer = self.buffer()
+        interface = app.session_interface
+
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+            cookie = f"session={c.get_cookie('session').value}"
+
+            # Another tab's request opens the session before the like...
+            with app.test_request_context(headers={'Cookie': cookie}) as ctx:
+                other = interface.open_session(app, ctx.request)
+
+            c.post(f'/messages/{self.m1_id}/like')
+
+            # ...and saves it after
+            other['seen'] = True
+            with app.test_request_context():
+                interface.save_session(app, other, Response())
+
+            with c.session_transaction() as sess:
+                self.assertTrue(sess['seen'])
+                self.assertEqual(pending_changes(sess), {self.m1_id: True})
+
+    def test_pending_expire(self):
+        """Tests if a session forgets buffered likes after PENDING_SECONDS"""
+        session = {}
+        remember_pending(session, self.m1_id, True, now=0)
+        remember_pending(session, self.m2_id, True, now=1)
+        remember_pending(session, self.m1_id, False, now=2)
+
+        self.assertEqual(pending_changes(session, now=3),
+                         {self.m2_id: True, self.m1_id: False})
+        self.assertEqual(pending_changes(session, now=1 + PENDING_SECONDS),
+                         {self.m1_id: False})
+
+        self.assertEqual(
+            merge_pending([[self.m1_id, True, 10], [self.m2_id, True, 5]],
+                          [[self.m1_id, False, 12], [self.m2_id, False, 2]],
+                          now=3),
+            [[self.m2_id, True, 5], [self.m1_id, False, 12]])
+
+        remember_pending(session, self.m2_id, False,
+                         now=2 + PENDING_SECONDS)
+        self.assertEqual(session['pending_likes'],
+                         [[self.m2_id, False, 2 + 2 * PENDING_SECONDS]])
+
+    def test_crash_replay(self):
+        """Tests if events logged by a crashed process are written on start"""
+        self.crash(f"{self.u1_id}:{self.m1_id}:like",
+                   f"{self.u1_id}:{self.m2_id}:like",
+                   f"{self.u1_id}:{self.m2_id}:unlike")
+        self.assertEqual(self.liked_ids(), set())
+
+        self.buffer()
+
+        self.assertEqual(self.liked_ids(), {self.m1_id})
+        # Only this process's files are left
+        self.assertEqual(sorted(os.listdir(self.directory.name)),
+                         [f"likes.{os.getpid()}.0.log",
+                          f"likes.{os.getpid()}.lock"])
+
+    def test_crash_replay_after_flush(self):
+        """Tests if events written before a crash aren't replayed"""
+        self.crash(f"{self.u1_id}:{self.m1_id}:like", "flush",
+                   f"{self.u1_id}:{self.m2_id}:like")
+        self.assertEqual(self.liked_ids(), {self.m1_id})
+
+        # Unliked since, elsewhere
+        Like.query.delete()
+        db.session.commit()
+
+        self.buffer()
+
+        self.assertEqual(self.liked_ids(), {self.m2_id})
+
+    def test_torn_log(self):
+        """Tests if a last event cut short by a crash is skipped"""
+        path = os.path.join(self.directory.name, 'likes.1.0.log')
+        with open(path, 'w') as f:
+            f.write('[1, 2, true]\n[1, 3, tr')
+
+        self.assertEqual(read_log(path), [(1, 2, True)])
@@ -7,9 +7,12 @@
 
 from app import app, CURR_USER_KEY
 import os
+import re
+import threading
 from unittest import TestCase
+from unittest.mock import patch
 
-from models import db, Message, User
+from models import db, Message, User, Like
 
 # BEFORE we import our app, let's set an environmental variable
 # to use a different database for tests (we need to do this
@@ -41,6 +44,7 @@ app.config['WTF_CSRF_ENABLED'] = False
 
 class MessageBaseViewTestCase(TestCase):
     def setUp(self):
+        Like.query.delete()
         User.query.delete()
 
         u1 = User.signup("u1", "u1@email.com", "password", None)
@@ -77,6 +81,20 @@ class MessageAddViewTestCase(MessageBaseViewTestCase):
 
             Message.query.filter_by(text="Hello").one()
 
+    @patch('app.hub.publish', side_effect=OSError("broker down"))
+    def test_add_message_publish_fails(self, publish):
+        """Tests if a message is posted even if publishing it fails"""
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            with self.assertLogs(app.logger, 'ERROR'):
+                resp = c.post("/messages/new", data={"text": "Unpublished"})
+
+            self.assertEqual(resp.status_code, 302)
+            publish.assert_called_once()
+            Message.query.filter_by(text="Unpublished").one()
+
     def test_add_message_fail(self):
         """Tests if we are able to add a message when logged out. Should return authorization error."""
         with self.client as c:
@@ -118,6 +136,22 @@ class MessageAddViewTestCase(MessageBaseViewTestCase):
             self.assertEqual(resp.status_code, 200)
             self.assertIn('Access unauthorized', html)
 
+    def test_delete_message_not_owner(self):
+        """Tests if we are unable to delete another user's message. Returns
+        authorization error."""
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u2_id
+
+            resp = c.post(f'/messages/{self.m1_id}/delete',
+                          follow_redirects=True)
+
+            html = resp.get_data(as_text=True)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn('Access unauthorized', html)
+            self.assertIsNotNone(db.session.get(Message, self.m1_id))
+
     def test_show_message(self):
         """Tests if message details are shown when clicking on the message."""
         with self.client as c:
@@ -160,3 +194,279 @@ class MessageAddViewTestCase(MessageBaseViewTestCase):
 
     #         self.assertEqual(resp_unlike.status_code, 200)
     #         self.assertIn('<!-- test for showing likes', html)
+
+
+class MessageLikeViewTestCase(MessageBaseViewTestCase):
+    def test_like_message_twice(self):
+        """Tests if liking a message twice only records one like."""
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            c.post(f'/messages/{self.m2_id}/like')
+            resp = c.post(f'/messages/{self.m2_id}/like')
+
+            self.assertEqual(resp.status_code, 302)
+            self.assertEqual(
+                Like.query.filter_by(user_id=self.u1_id).count(), 1)
+
+    def test_like_message_missing(self):
+        """Tests if liking a message that doesn't exist is a 404."""
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            resp = c.post('/messages/0/like')
+
+            self.assertEqual(resp.status_code, 404)
+
+    def test_unlike_message_twice(self):
+        """Tests if unliking a message that isn't liked is a no-op."""
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            c.post(f'/messages/{self.m2_id}/like')
+            c.post(f'/messages/{self.m2_id}/unlike')
+            resp = c.post(f'/messages/{self.m2_id}/unlike',
+                          follow_redirects=True)
+
+            html = resp.get_data(as_text=True)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn('<!-- test for showing likes', html)
+            self.assertEqual(
+                Like.query.filter_by(user_id=self.u1_id).count(), 0)
+
+
+class MessageLikeFormTestCase(MessageBaseViewTestCase):
+    def setUp(self):
+        Message.query.delete()
+        super().setUp()
+        db.session.add_all([Message(text=f"more-text-{i}", user_id=self.u2_id)
+                            for i in range(5)])
+        db.session.commit()
+        app.config['WTF_CSRF_ENABLED'] = True
+
+    def tearDown(self):
+        app.config['WTF_CSRF_ENABLED'] = False
+
+    def test_one_like_form(self):
+        """Tests if like buttons share one form and CSRF token per page."""
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            html = c.get(f'/users/{self.u2_id}').get_data(as_text=True)
+
+            self.assertIn('<form id="like-form" method="POST">', html)
+            self.assertIn(f'form="like-form" formaction='
+                          f'"/messages/{self.m2_id}/like"', html)
+            self.assertEqual(html.count('form="like-form"'), 6)
+            self.assertIsNone(re.search('<form[^>]* action="/messages/', html))
+
+            # For the like, follow and logout forms
+            tokens = re.findall(r'name="csrf_token" type="hidden" '
+                                r'value="([^"]+)"', html)
+            self.assertEqual(len(tokens), 3)
+            self.assertEqual(len(set(tokens)), 1)
+
+            resp = c.post(f'/messages/{self.m2_id}/like',
+                          data={'csrf_token': tokens[0]})
+
+            self.assertEqual(resp.status_code, 302)
+            self.assertEqual(
+                Like.query.filter_by(user_id=self.u1_id).count(), 1)
+
+    def test_like_needs_csrf_token(self):
+        """Tests if likes without the page's CSRF token are refused."""
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            resp = c.post(f'/messages/{self.m2_id}/like',
+                          data={'csrf_token': 'forged'})
+
+            self.assertEqual(resp.status_code, 302)
+            self.assertEqual(
+                Like.query.filter_by(user_id=self.u1_id).count(), 0)
+
+
+class MessageBatchLikeViewTestCase(MessageBaseViewTestCase):
+    def test_like_messages(self):
+        """Tests if a batch of messages can be liked in one request."""
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            c.post(f'/messages/{self.m2_id}/like')
+            resp = c.post('/messages/like',
+                          json={'ids': [self.m1_id, self.m2_id, 0]})
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(resp.json['results'], [
+                {'id': self.m1_id, 'status': 'liked'},
+                {'id': self.m2_id, 'status': 'unchanged'},
+                {'id': 0, 'status': 'not_found'},
+            ])
+            self.assertEqual(
+                Like.query.filter_by(user_id=self.u1_id).count(), 2)
+
+    def test_unlike_messages(self):
+        """Tests if a batch of messages can be unliked in one request."""
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            c.post(f'/messages/{self.m2_id}/like')
+            resp = c.post('/messages/unlike',
+                          json={'ids': [self.m1_id, self.m2_id]})
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(resp.json['results'], [
+                {'id': self.m1_id, 'status': 'unchanged'},
+                {'id': self.m2_id, 'status': 'unliked'},
+            ])
+            self.assertEqual(
+                Like.query.filter_by(user_id=self.u1_id).count(), 0)
+
+    def test_like_messages_invalid(self):
+        """Tests if malformed batches are rejected."""
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            for body in ({'ids': []}, {'ids': ['1']}, {'ids': [1] * 501}):
+                resp = c.post('/messages/like', json=body)
+                self.assertEqual(resp.status_code, 400)
+
+            resp = c.post('/messages/like', data={'ids': self.m1_id})
+            self.assertEqual(resp.status_code, 400)
+
+    def test_like_messages_fail(self):
+        """Tests if batch likes are refused when logged out."""
+        with self.client as c:
+            resp = c.post('/messages/like', json={'ids': [self.m1_id]})
+
+            self.assertEqual(resp.status_code, 401)
+            self.assertEqual(Like.query.count(), 0)
+
+
+class MessageTrendingViewTestCase(MessageBaseViewTestCase):
+    def test_show_trending(self):
+        """Tests if liked messages show up on the trending page."""
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            c.post(f'/messages/{self.m2_id}/like')
+            resp = c.get('/messages/trending')
+
+            html = resp.get_data(as_text=True)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn('<!-- test for trending messages', html)
+            self.assertIn('m2-text', html)
+
+    def test_show_trending_fail(self):
+        """Tests if trending page is hidden when logged out."""
+        with self.client as c:
+            resp = c.get('/messages/trending', follow_redirects=True)
+
+            html = resp.get_data(as_text=True)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn('Access unauthorized', html)
+
+
+class MessageSearchViewTestCase(MessageBaseViewTestCase):
+    def test_search_messages(self):
+        """Tests if searching finds matching messages, including new ones."""
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            c.post("/messages/new", data={"text": "Searchable warble"})
+            resp = c.get('/messages/search?q=warble')
+
+            html = resp.get_data(as_text=True)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn('<!-- test for message search', html)
+            self.assertIn('Searchable warble', html)
+            self.assertNotIn('m2-text', html)
+
+    def test_search_messages_fail(self):
+        """Tests if search is hidden when logged out."""
+        with self.client as c:
+            resp = c.get('/messages/search?q=m1', follow_redirects=True)
+
+            html = resp.get_data(as_text=True)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn('Access unauthorized', html)
+
+
+class MessageStreamViewTestCase(MessageBaseViewTestCase):
+    @patch('app.stream_slots', threading.BoundedSemaphore(1))
+    def test_stream_messages(self):
+        """Tests if new messages are pushed to the timeline stream, with
+        the author's image through the proxy."""
+        db.session.get(User, self.u1_id).image_url = "https://images.test/a.png"
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            resp = c.get('/messages/stream')
+            events = iter(resp.response)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(resp.mimetype, 'text/event-stream')
+            self.assertIn(b'retry:', next(events))
+
+            c.post("/messages/new", data={"text": "Streamed warble"})
+
+            data = next(events)
+            self.assertIn(b'Streamed warble', data)
+            self.assertIn(b'/images/avatar/', data)
+            self.assertNotIn(b'"https://images.test/a.png"', data)
+            resp.close()
+
+            # Its slot is free again
+            resp = c.get('/messages/stream')
+            self.assertEqual(resp.status_code, 200)
+            resp.close()
+
+    @patch('app.stream_slots', threading.BoundedSemaphore(1))
+    def test_stream_messages_full(self):
+        """Tests if streams past MAX_WSGI_STREAMS get a 204."""
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            resp = c.get('/messages/stream')
+            self.assertEqual(c.get('/messages/stream').status_code, 204)
+            resp.close()
+
+    def test_homepage_stream(self):
+        """Tests if homepages only open a stream when streams are on."""
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            for enabled in (False, True):
+                with patch.dict(app.config, MESSAGE_STREAMS=enabled):
+                    html = c.get('/').get_data(as_text=True)
+                    self.assertEqual('EventSource' in html, enabled)
+
+    def test_stream_messages_fail(self):
+        """Tests if the stream is unavailable when logged out."""
+        with self.client as c:
+            resp = c.get('/messages/stream', follow_redirects=True)
+
+            html = resp.get_data(as_text=True)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn('Access unauthorized', html)
@@ -0,0 +1,163 @@
+"""Metrics tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_metrics.py
+
+
+import os
+import subprocess
+import sys
+import tempfile
+from unittest import TestCase
+
+from prometheus_client import REGISTRY
+
+import metrics
+from app import app, CURR_USER_KEY
+from models import db, User, Message, Like, Follow
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+app.config['WTF_CSRF_ENABLED'] = False
+app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
+
+db.drop_all()
+db.create_all()
+
+
+def sample(name, **labels):
+    return REGISTRY.get_sample_value(name, labels) or 0
+
+
+class MetricsTestCase(TestCase):
+    def setUp(self):
+        Like.query.delete()
+        Follow.query.delete()
+        Message.query.delete()
+        User.query.delete()
+
+        u1 = User.signup("u1", "u1@email.com", "password", None)
+        db.session.commit()
+
+        self.u1_id = u1.id
+        self.client = app.test_client()
+
+    def tearDown(self):
+        metrics.METRICS_TOKEN = None
+
+    def test_requests(self):
+        """Tests if requests are counted and timed by route and status"""
+        route = '/users/<int:user_id>'
+        before = sample('warbler_requests_total',
+                        method='GET', route=route, status='302')
+
+        # Timed until the response is closed, as servers do once it's sent
+        self.client.get(f'/users/{self.u1_id}').close()
+
+        self.assertEqual(sample('warbler_requests_total',
+                                method='GET', route=route, status='302'),
+                         before + 1)
+        self.assertGreater(sample('warbler_request_duration_seconds_count',
+                                  method='GET', route=route), 0)
+
+        resp = self.client.get('/metrics')
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn(
+            'warbler_requests_total{method="GET",route="/users/<int:user_id>"'
+            ',status="302"}', resp.get_data(as_text=True))
+
+    def test_unmatched_route(self):
+        """Tests if requests matching no route share one label"""
+        self.client.get('/no/such/page')
+
+        self.assertGreater(sample('warbler_requests_total', method='GET',
+                                  route='unmatched', status='404'), 0)
+
+    def test_queries_per_request(self):
+        """Tests if queries run by a request are counted"""
+        route = '/users/<int:user_id>'
+        before = sample('warbler_db_queries_per_request_sum', route=route)
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+            resp = c.get(f'/users/{self.u1_id}')
+            self.assertEqual(resp.status_code, 200)
+            resp.close()
+
+        self.assertGreaterEqual(
+            sample('warbler_db_queries_per_request_sum', route=route),
+            before + 3)
+
+    def test_bcrypt(self):
+        """Tests if password hashing is timed"""
+        before = sample('warbler_bcrypt_duration_seconds_count',
+                        operation='check')
+
+        User.authenticate("u1", "password")
+
+        self.assertEqual(sample('warbler_bcrypt_duration_seconds_count',
+                                operation='check'), before + 1)
+
+    def test_cache_lookups(self):
+        """Tests if cache hits and misses are counted"""
+        hits = sample('warbler_cache_lookups_total',
+                      cache='viewer_state', result='hit')
+        misses = sample('warbler_cache_lookups_total',
+                        cache='viewer_state', result='miss')
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+            c.get('/')
+            c.get('/')
+
+        self.assertEqual(sample('warbler_cache_lookups_total',
+                                cache='viewer_state', result='miss'),
+                         misses + 1)
+        self.assertEqual(sample('warbler_cache_lookups_total',
+                                cache='viewer_state', result='hit'),
+                         hits + 1)
+
+    def test_token(self):
+        """Tests if /metrics requires METRICS_TOKEN when it's set"""
+        metrics.METRICS_TOKEN = 'secret'
+
+        self.assertEqual(self.client.get('/metrics').status_code, 401)
+        resp = self.client.get('/metrics',
+                               headers={'Authorization': 'Bearer secret'})
+        self.assertEqual(resp.status_code, 200)
+
+
+WORKER = """
+import metrics
+metrics.REQUESTS.labels('GET', '/', '200').inc()
+"""
+
+COLLECTOR = """
+from prometheus_client import generate_latest
+import metrics
+print(generate_latest(metrics.registry()).decode())
+"""
+
+
+class MultiprocessTestCase(TestCase):
+    def run_python(self, code, env):
+        return subprocess.run(
+            [sys.executable, '-c', code], env=env, check=True,
+            capture_output=True, text=True,
+            cwd=os.path.dirname(os.path.abspath(__file__))).stdout
+
+    def test_multiprocess(self):
+        """Tests if /metrics sums metrics from every worker process"""
+        with tempfile.TemporaryDirectory() as directory:
+            env = {**os.environ, 'PROMETHEUS_MULTIPROC_DIR': directory}
+
+            self.run_python(WORKER, env)
+            self.run_python(WORKER, env)
+            output = self.run_python(COLLECTOR, env)
+
+        self.assertIn(
+            'warbler_requests_total{method="GET",route="/",status="200"} 2.0',
+            output)
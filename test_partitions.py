@@ -0,0 +1,97 @@
+"""Message partitioning tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_partitions.py
+
+
+import os
+from datetime import datetime, timedelta
+from unittest import TestCase
+
+from app import app
+from models import db, User, Message, Like, Follow
+from partitions import add_months, month_start, newest, partition_name
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
+
+db.drop_all()
+db.create_all()
+
+NOW = datetime(2023, 6, 15, 12, 0)
+
+
+class PartitionHelpersTestCase(TestCase):
+    def test_month_start(self):
+        """Tests if times are truncated to the start of their month"""
+        self.assertEqual(month_start(datetime(2023, 2, 28, 23, 59)),
+                         datetime(2023, 2, 1))
+
+    def test_add_months(self):
+        """Tests if month arithmetic wraps across years"""
+        month = datetime(2023, 11, 1)
+
+        self.assertEqual(add_months(month, 1), datetime(2023, 12, 1))
+        self.assertEqual(add_months(month, 2), datetime(2024, 1, 1))
+        self.assertEqual(add_months(month, -11), datetime(2022, 12, 1))
+        self.assertEqual(add_months(month, -23), datetime(2021, 12, 1))
+
+    def test_partition_name(self):
+        """Tests if partitions are named after their month"""
+        self.assertEqual(partition_name(datetime(2023, 3, 1)),
+                         "messages_2023_03")
+
+
+class NewestTestCase(TestCase):
+    def setUp(self):
+        Like.query.delete()
+        Follow.query.delete()
+        Message.query.delete()
+        User.query.delete()
+
+        user = User.signup("u1", "u1@email.com", "password", None)
+        db.session.commit()
+        self.user_id = user.id
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def add(self, *ages):
+        """Add messages `ages` days old; return their ids, newest first."""
+
+        messages = [Message(text=f"{age} days old", user_id=self.user_id,
+                            timestamp=NOW - timedelta(days=age))
+                    for age in ages]
+        db.session.add_all(messages)
+        db.session.commit()
+        return [message.id
+                for message in sorted(messages, key=lambda m: m.timestamp,
+                                      reverse=True)]
+
+    def newest_ids(self, limit):
+        return [message.id
+                for message in newest(Message.query, limit, now=NOW)]
+
+    def test_month(self):
+        """Tests if the newest messages come from the last 31 days when
+        there are enough of them"""
+        ids = self.add(1, 2, 10, 100, 500)
+
+        self.assertEqual(self.newest_ids(3), ids[:3])
+
+    def test_year(self):
+        """Tests if the last 366 days are searched when the last 31 don't
+        have enough messages"""
+        ids = self.add(1, 40, 300, 500)
+
+        self.assertEqual(self.newest_ids(3), ids[:3])
+
+    def test_everything(self):
+        """Tests if all messages are searched when the last 366 days don't
+        have enough"""
+        ids = self.add(1, 400, 800)
+
+        self.assertEqual(self.newest_ids(3), ids)
+        self.assertEqual(self.newest_ids(5), ids)
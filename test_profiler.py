@@ -0,0 +1,126 @@
+"""Sampling profiler tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_profiler.py
+
+
+import os
+import sys
+import tempfile
+import time
+from unittest import TestCase
+
+from flask import Flask
+
+from profiler import Profiler, check_token, collapse, sign_token
+
+
+def busy(seconds):
+    """Keep the CPU busy for `seconds`."""
+
+    end = time.perf_counter() + seconds
+    while time.perf_counter() < end:
+        pass
+
+
+def make_app(profiler):
+    app = Flask(__name__)
+    app.config['SECRET_KEY'] = 'secret'
+    profiler.init_app(app)
+
+    @app.get('/slow')
+    def slow():
+        busy(0.1)
+        return "done"
+
+    @app.get('/fast')
+    def fast():
+        return "done"
+
+    return app
+
+
+class TokenTestCase(TestCase):
+    def test_tokens(self):
+        """Tests if only unexpired tokens signed with the key are accepted"""
+        token = sign_token('secret', int(time.time()) + 60)
+
+        self.assertTrue(check_token('secret', token))
+        self.assertFalse(check_token('other', token))
+        self.assertFalse(check_token(
+            'secret', sign_token('secret', int(time.time()) - 1)))
+        self.assertFalse(check_token('secret', 'nonsense'))
+
+
+class ProfilerTestCase(TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def profiler(self, **kwargs):
+        return Profiler(directory=self.directory.name, interval=0.001,
+                        **kwargs)
+
+    def test_collapse(self):
+        """Tests if stacks are collapsed outermost first"""
+        stack = collapse(sys._getframe())
+
+        self.assertTrue(stack.endswith(
+            ';test_profiler:ProfilerTestCase.test_collapse'))
+
+    def test_wanted(self):
+        """Tests if requests are chosen by route, rate and token"""
+        profiler = self.profiler(routes={'homepage'}, sample_rate=1)
+        token = sign_token('secret', int(time.time()) + 60)
+
+        self.assertTrue(profiler.wanted('homepage'))
+        self.assertFalse(profiler.wanted('show_user'))
+        self.assertTrue(profiler.wanted('show_user', token, 'secret'))
+        self.assertFalse(profiler.wanted('show_user', 'bad', 'secret'))
+
+        profiler = self.profiler(sample_rate=0)
+        self.assertFalse(profiler.wanted('homepage'))
+        self.assertTrue(profiler.wanted('homepage', token, 'secret'))
+
+    def test_profile_route(self):
+        """Tests if a profiled route's stacks are written for flamegraphs"""
+        profiler = self.profiler(routes={'slow'}, sample_rate=1)
+        client = make_app(profiler).test_client()
+
+        client.get('/slow')
+        client.get('/fast')
+        profiler.dump()
+
+        self.assertEqual(os.listdir(self.directory.name),
+                         [f"slow.{os.getpid()}.folded"])
+
+        with open(os.path.join(self.directory.name,
+                               f"slow.{os.getpid()}.folded")) as f:
+            lines = f.read().splitlines()
+
+        samples = sum(int(line.rsplit(' ', 1)[1]) for line in lines)
+        self.assertGreater(samples, 10)
+        self.assertTrue(any('.slow;test_profiler:busy ' in line
+                            for line in lines))
+
+    def test_profile_signed_request(self):
+        """Tests if requests with a signed X-Profile header are profiled"""
+        profiler = self.profiler(sample_rate=0)
+        client = make_app(profiler).test_client()
+        token = sign_token('secret', int(time.time()) + 60)
+
+        client.get('/slow')
+        self.assertFalse(profiler.stacks['slow'])
+
+        client.get('/slow', headers={'X-Profile': token})
+        self.assertTrue(profiler.stacks['slow'])
+
+    def test_idle_sampler(self):
+        """Tests if no thread is sampled once profiled requests end"""
+        profiler = self.profiler(routes={'slow'}, sample_rate=1)
+        make_app(profiler).test_client().get('/slow')
+
+        self.assertFalse(profiler.sampler._active.is_set())
@@ -0,0 +1,159 @@
+"""Message pub/sub tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_pubsub.py
+
+
+import json
+import queue
+import socket
+import tempfile
+from types import SimpleNamespace
+from unittest import TestCase
+from unittest.mock import patch
+
+import psycopg2
+
+from pubsub import (
+    Hub, PostgresBackend, SocketBackend, backend_from_url, LocalBackend)
+
+
+def event(message_id, user_id):
+    return {'id': message_id, 'text': 'hi', 'user': {'id': user_id}}
+
+
+class HubTestCase(TestCase):
+    def setUp(self):
+        self.hub = Hub()
+
+    def test_publish(self):
+        """Tests if events reach only subscribers following the author"""
+        sub1 = self.hub.subscribe([1, 2])
+        sub2 = self.hub.subscribe([3])
+
+        self.hub.publish(event(10, 2))
+
+        self.assertEqual(sub1.get(timeout=0)['id'], 10)
+        self.assertIsNone(sub2.get(timeout=0))
+
+    def test_unsubscribe(self):
+        """Tests if unsubscribed subscribers stop receiving events"""
+        sub = self.hub.subscribe([1])
+        self.hub.unsubscribe(sub)
+
+        self.hub.publish(event(10, 1))
+
+        self.assertIsNone(sub.get(timeout=0))
+
+    def test_slow_subscriber(self):
+        """Tests if a subscriber that stops reading doesn't block publishing"""
+        sub = self.hub.subscribe([1])
+
+        for message_id in range(500):
+            self.hub.publish(event(message_id, 1))
+
+        self.assertEqual(sub.get(timeout=0)['id'], 0)
+
+
+class SocketBackendTestCase(TestCase):
+    def test_broadcast(self):
+        """Tests if events published by one hub reach another's subscribers"""
+        with tempfile.TemporaryDirectory() as directory:
+            publisher = Hub(SocketBackend(directory, name="publisher"))
+            subscriber = Hub(SocketBackend(directory, name="subscriber"))
+
+            sub = subscriber.subscribe([1])
+            publisher.publish(event(10, 1))
+
+            self.assertEqual(sub.get(timeout=5)['id'], 10)
+
+
+class FakeConnection:
+    """Stands in for a psycopg2 connection with `payloads` to notify;
+    `poll` raises once they're delivered, as a dropped connection does.
+    Without payloads, it never becomes readable."""
+
+    def __init__(self, payloads=()):
+        self._ready, self._writer = socket.socketpair()
+        if payloads:
+            self._writer.send(b'x')
+        self._payloads = list(payloads)
+        self.notifies = []
+
+    def fileno(self):
+        return self._ready.fileno()
+
+    def cursor(self):
+        return SimpleNamespace(execute=lambda sql: None)
+
+    def poll(self):
+        if not self._payloads:
+            raise OSError("connection dropped")
+        self.notifies = [SimpleNamespace(payload=json.dumps(payload))
+                         for payload in self._payloads]
+        self._payloads = []
+
+    def close(self):
+        self._ready.close()
+        self._writer.close()
+
+
+class PostgresBackendTestCase(TestCase):
+    @patch('pubsub.RECONNECT_DELAY', 0)
+    def test_reconnect(self):
+        """Tests if the listener reconnects after its connection drops"""
+        connections = iter([FakeConnection([event(10, 1)]),
+                            FakeConnection([event(11, 1)]),
+                            FakeConnection()])
+
+        backend = PostgresBackend("postgresql:///unused")
+        backend._connect = lambda: next(connections)
+        delivered = queue.Queue()
+
+        with self.assertLogs('pubsub', 'ERROR'):
+            backend.start(delivered.put)
+            self.assertEqual(delivered.get(timeout=5)['id'], 10)
+            self.assertEqual(delivered.get(timeout=5)['id'], 11)
+
+
+    def test_publish_reconnect(self):
+        """Tests if publishing on a dropped connection reconnects and
+        retries once, then logs instead of raising"""
+        sent = []
+
+        def connection(fails):
+            def execute(sql, params):
+                if fails:
+                    raise psycopg2.OperationalError("server closed")
+                sent.append(json.loads(params[1])['id'])
+
+            return SimpleNamespace(
+                closed=False, close=lambda: None,
+                cursor=lambda: SimpleNamespace(execute=execute))
+
+        connections = iter([connection(True), connection(False),
+                            connection(True), connection(True)])
+        backend = PostgresBackend("postgresql:///unused")
+        backend._connect = lambda: next(connections)
+
+        backend.publish(event(10, 1))
+        self.assertEqual(sent, [10])
+
+        backend._publisher = next(connections)
+        with self.assertLogs('pubsub', 'ERROR'):
+            backend.publish(event(11, 1))
+        self.assertEqual(sent, [10])
+
+
+class BackendFromUrlTestCase(TestCase):
+    def test_backend_from_url(self):
+        """Tests if PUBSUB_URL picks the right backend"""
+        self.assertIsInstance(backend_from_url(None), LocalBackend)
+        self.assertIsInstance(backend_from_url("unix:///tmp/warbler"),
+                              SocketBackend)
+        self.assertEqual(backend_from_url("unix:///tmp/warbler").directory,
+                         "/tmp/warbler")
+
+        with self.assertRaises(ValueError):
+            backend_from_url("redis://localhost")
@@ -0,0 +1,101 @@
+"""Read model tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_readmodels.py
+
+
+import os
+from unittest import TestCase
+
+from app import app
+from models import db, User, Message, Like, Follow
+from readmodels import (
+    FeedItem, ProfileCounts, UserCard, feed_items, feed_query, followers_of,
+    following_of, liked_by, profile_counts, streamed, user_card_query,
+    user_cards)
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+db.drop_all()
+db.create_all()
+
+
+class ReadModelTestCase(TestCase):
+    def setUp(self):
+        Like.query.delete()
+        Follow.query.delete()
+        Message.query.delete()
+        User.query.delete()
+
+        u1 = User.signup("u1", "u1@email.com", "password", None)
+        u2 = User.signup("u2", "u2@email.com", "password", None)
+        db.session.flush()
+
+        m1 = Message(text="m1-text", user_id=u1.id)
+        m2 = Message(text="m2-text", user_id=u2.id)
+        db.session.add_all([m1, m2])
+        db.session.flush()
+
+        Follow.add(u1.id, u2.id)
+        Like.add(u1.id, m2.id)
+        db.session.commit()
+
+        self.u1_id = u1.id
+        self.u2_id = u2.id
+        self.m2_id = m2.id
+
+    def tearDown(self):
+        db.session.rollback()
+        Like.query.delete()
+        Follow.query.delete()
+        db.session.commit()
+
+    def test_feed_items(self):
+        """Tests if feed items carry their message and author columns"""
+        [item] = feed_items(
+            feed_query().filter(Message.user_id == self.u2_id))
+
+        self.assertIsInstance(item, FeedItem)
+        self.assertEqual(item.id, self.m2_id)
+        self.assertEqual(item.text, "m2-text")
+        self.assertEqual(item.user_id, self.u2_id)
+        self.assertEqual(item.user.username, "u2")
+
+    def test_feed_items_immutable(self):
+        """Tests if read models can't be modified or given new attributes"""
+        [item] = feed_items(liked_by(feed_query(), self.u1_id))
+
+        with self.assertRaises(AttributeError):
+            item.text = "changed"
+        with self.assertRaises(AttributeError):
+            item.extra = 1
+
+    def test_user_cards(self):
+        """Tests if following and followers lists come back as user cards"""
+        following = user_cards(following_of(user_card_query(), self.u1_id))
+        followers = user_cards(followers_of(user_card_query(), self.u1_id))
+
+        self.assertEqual([card.username for card in following], ["u2"])
+        self.assertIsInstance(following[0], UserCard)
+        self.assertEqual(followers, [])
+
+    def test_profile_counts(self):
+        """Tests if profile counts are computed in one query"""
+        self.assertEqual(profile_counts(self.u1_id),
+                         ProfileCounts(messages=1, following=1,
+                                       followers=0, likes=1))
+        self.assertEqual(profile_counts(self.u2_id),
+                         ProfileCounts(messages=1, following=0,
+                                       followers=1, likes=0))
+
+    def test_streamed(self):
+        """Tests if streamed rows come back in batches of read models"""
+        batches = list(streamed(
+            user_card_query().order_by(User.username), user_cards,
+            batch_size=1))
+
+        self.assertEqual([[card.username for card in batch]
+                          for batch in batches], [["u1"], ["u2"]])
+        self.assertEqual(list(streamed(
+            user_card_query().filter(User.id == 0), user_cards)), [])
@@ -0,0 +1,122 @@
+"""Message search tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_search.py
+
+
+import os
+from unittest import TestCase
+
+from app import app
+from models import db, User, Message
+from search import InvertedIndex, MessageSearch, tokenize
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+app.config['WTF_CSRF_ENABLED'] = False
+app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
+
+db.drop_all()
+db.create_all()
+
+
+class TokenizeTestCase(TestCase):
+    def test_tokenize(self):
+        """Tests if text is split into lowercase words without stop words"""
+        self.assertEqual(tokenize("The Cat sat on the mat, 2 times!"),
+                         {"cat", "sat", "mat", "2", "times"})
+
+    def test_tokenize_empty(self):
+        """Tests if text with no searchable words gives no tokens"""
+        self.assertEqual(tokenize("the, and... of"), set())
+
+
+class InvertedIndexTestCase(TestCase):
+    def setUp(self):
+        self.index = InvertedIndex()
+        self.index.add(1, "Hello warbler world")
+        self.index.add(2, "Goodbye world")
+        self.index.add(3, "hello again, world")
+
+    def test_search(self):
+        """Tests if messages containing every word are found, newest first"""
+        self.assertEqual(self.index.search("world"), [3, 2, 1])
+        self.assertEqual(self.index.search("hello world"), [3, 1])
+        self.assertEqual(self.index.search("HELLO"), [3, 1])
+
+    def test_search_no_match(self):
+        """Tests if searches with unknown or no words return nothing"""
+        self.assertEqual(self.index.search("hello cat"), [])
+        self.assertEqual(self.index.search("the"), [])
+
+    def test_search_pagination(self):
+        """Tests if keyset cursors page through results"""
+        self.assertEqual(self.index.search("world", limit=2), [3, 2])
+        self.assertEqual(self.index.search("world", before=2, limit=2), [1])
+
+    def test_add_out_of_order(self):
+        """Tests if messages indexed out of id order are still sorted"""
+        self.index.add(0, "world")
+        self.index.add(0, "world")
+
+        self.assertEqual(self.index.search("world"), [3, 2, 1, 0])
+
+    def test_remove(self):
+        """Tests if removed messages are no longer found"""
+        self.index.remove(1, "Hello warbler world")
+
+        self.assertEqual(self.index.search("hello"), [3])
+        self.assertEqual(self.index.search("warbler"), [])
+        self.assertEqual(len(self.index), 4)
+
+
+class MessageSearchTestCase(TestCase):
+    def setUp(self):
+        Message.query.delete()
+        User.query.delete()
+
+        u1 = User.signup("u1", "u1@email.com", "password", None)
+        db.session.flush()
+        self.u1_id = u1.id
+
+        self.add("Hello warbler world")
+        self.search = MessageSearch()
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def add(self, text):
+        """Post a message without telling the search, as another worker
+        would."""
+        msg = Message(text=text, user_id=self.u1_id)
+        db.session.add(msg)
+        db.session.commit()
+        return msg
+
+    def texts(self, query):
+        messages, cursor = self.search.search(query)
+        return [msg.text for msg in messages]
+
+    def test_other_workers_posts(self):
+        """Tests if messages posted elsewhere are found by the next search"""
+        self.assertEqual(self.texts("world"), ["Hello warbler world"])
+
+        self.add("Goodbye world")
+
+        self.assertEqual(self.texts("world"),
+                         ["Goodbye world", "Hello warbler world"])
+
+    def test_rebuild(self):
+        """Tests if the index drops messages deleted elsewhere once it's
+        rebuilt, and never shows them before"""
+        self.assertEqual(self.texts("warbler"), ["Hello warbler world"])
+
+        Message.query.delete()
+        db.session.commit()
+        self.assertEqual(self.texts("warbler"), [])
+        self.assertEqual(len(self.search._fallback_index()), 3)
+
+        self.search.rebuild_interval = 0
+        self.assertEqual(self.texts("warbler"), [])
+        self.assertEqual(len(self.search._fallback_index()), 0)
@@ -0,0 +1,157 @@
+"""Server-side session tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_sessions.py
+
+
+import os
+from datetime import datetime, timedelta
+from unittest import TestCase
+
+from sqlalchemy import event
+
+from app import app, CURR_USER_KEY
+from models import db, User, Message, Like, Follow, StoredSession
+from sessions import MemoryStore
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+app.config['WTF_CSRF_ENABLED'] = False
+app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
+
+db.drop_all()
+db.create_all()
+
+
+class MemoryStoreTestCase(TestCase):
+    def test_store(self):
+        """Tests if sessions are saved, expire and are deleted by user"""
+        store = MemoryStore()
+        later = datetime.utcnow() + timedelta(hours=1)
+
+        store.save('a', {'x': b'bytes'}, 1, later)
+        store.save('b', {}, 1, later)
+        store.save('c', {}, 2, later)
+        store.save('d', {}, None, datetime.utcnow() - timedelta(seconds=1))
+
+        self.assertEqual(store.load('a').data, {'x': b'bytes'})
+        self.assertIsNone(store.load('d'))
+        self.assertEqual(store.purge(), 1)
+
+        store.delete_user(1)
+        self.assertIsNone(store.load('a'))
+        self.assertIsNone(store.load('b'))
+        self.assertIsNotNone(store.load('c'))
+
+
+class SessionViewsTestCase(TestCase):
+    def setUp(self):
+        StoredSession.query.delete()
+        Like.query.delete()
+        Follow.query.delete()
+        Message.query.delete()
+        User.query.delete()
+
+        u1 = User.signup("u1", "u1@email.com", "password", None)
+        db.session.commit()
+
+        self.u1_id = u1.id
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def log_in(self, client):
+        with client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.u1_id
+
+    def test_cookie_holds_id(self):
+        """Tests if the cookie holds only the id of a stored session"""
+        client = app.test_client()
+        self.log_in(client)
+        sid = client.get_cookie('session').value
+
+        self.assertNotIn('.', sid)
+        self.assertEqual(db.session.get(StoredSession, sid).user_id,
+                         self.u1_id)
+        self.assertIn('@u1', client.get('/').get_data(as_text=True))
+
+    def test_unknown_id(self):
+        """Tests if a made-up session id is replaced, not adopted"""
+        client = app.test_client()
+        client.set_cookie('session', 'made-up')
+        client.get('/login?next=x')
+
+        with client.session_transaction() as sess:
+            sess['x'] = 1
+
+        self.assertNotEqual(client.get_cookie('session').value, 'made-up')
+        self.assertIsNone(db.session.get(StoredSession, 'made-up'))
+
+    def test_login_rotates_id(self):
+        """Tests if logging in moves the session to a new id"""
+        client = app.test_client()
+        with client.session_transaction() as sess:
+            sess['seen'] = True
+        before = client.get_cookie('session').value
+
+        client.post('/login', data={'username': 'u1', 'password': 'password'})
+        after = client.get_cookie('session').value
+
+        self.assertNotEqual(before, after)
+        self.assertIsNone(db.session.get(StoredSession, before))
+        self.assertEqual(db.session.get(StoredSession, after).user_id,
+                         self.u1_id)
+
+    def test_header_without_user_reads(self):
+        """Tests if a logged-in page reads only the session, once cached"""
+        client = app.test_client()
+        self.log_in(client)
+        client.get('/messages/new')
+
+        statements = []
+
+        def record(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        event.listen(db.engine, 'before_cursor_execute', record)
+        try:
+            html = client.get('/messages/new').get_data(as_text=True)
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', record)
+
+        self.assertIn('alt="u1"', html)
+        self.assertEqual(len(statements), 1)
+        self.assertIn('FROM sessions', statements[0])
+
+    def test_snapshot_refreshed(self):
+        """Tests if a profile change shows in the user's other sessions"""
+        first = app.test_client()
+        second = app.test_client()
+        self.log_in(first)
+        self.log_in(second)
+        first.get('/')
+
+        second.post('/users/profile', data={
+            'username': 'renamed',
+            'email': 'u1@email.com',
+            'password': 'password',
+        })
+
+        html = first.get('/').get_data(as_text=True)
+        self.assertIn('@renamed', html)
+
+    def test_logout_everywhere(self):
+        """Tests if logging out everywhere ends the user's other sessions"""
+        first = app.test_client()
+        second = app.test_client()
+        self.log_in(first)
+        self.log_in(second)
+
+        resp = first.post('/logout/everywhere')
+        self.assertEqual(resp.location, '/login')
+
+        resp = second.get('/users/profile')
+        self.assertEqual(resp.status_code, 401)
+        self.assertEqual(
+            StoredSession.query.filter_by(user_id=self.u1_id).count(), 0)
@@ -0,0 +1,315 @@
+"""Sharding tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_shards.py
+
+
+import csv
+import os
+import tempfile
+from collections import Counter
+from datetime import datetime, timedelta
+from unittest import TestCase
+from unittest.mock import patch
+
+import app as app_module
+from app import app, CURR_USER_KEY
+from models import db, User, Message, Like, Follow
+from shards import HashRing, ShardSet, shard_messages
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+app.config['WTF_CSRF_ENABLED'] = False
+app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
+
+db.drop_all()
+db.create_all()
+
+HASH = "$2b$12$Q1PUFjhN/AWRQ21LbGYvjeLpZZB6lfZ1BPwifHALGO6oIbyC3CmJe"
+
+
+class HashRingTestCase(TestCase):
+    def test_balance(self):
+        """Tests if keys are spread evenly over the shards"""
+        ring = HashRing(['a', 'b', 'c'])
+        counts = Counter(ring.owner(key) for key in range(3000))
+
+        self.assertEqual(set(counts), {'a', 'b', 'c'})
+        for count in counts.values():
+            self.assertGreater(count, 750)
+
+    def test_add_shard(self):
+        """Tests if adding a shard only moves keys to it, about 1/N"""
+        before = HashRing(['a', 'b', 'c'])
+        after = HashRing(['a', 'b', 'c', 'd'])
+
+        moved = [key for key in range(4000)
+                 if before.owner(key) != after.owner(key)]
+
+        self.assertTrue(all(after.owner(key) == 'd' for key in moved))
+        self.assertLess(len(moved), 1500)
+
+
+class ShardTestCase(TestCase):
+    def setUp(self):
+        Like.query.delete()
+        Follow.query.delete()
+        Message.query.delete()
+        User.query.delete()
+
+        users = [User.signup(f"u{n}", f"u{n}@email.com", "password", None)
+                 for n in range(8)]
+        db.session.flush()
+        self.user_ids = [user.id for user in users]
+        self.reader_id = self.user_ids[0]
+        for user_id in self.user_ids[1:]:
+            db.session.add(Follow(user_following_id=self.reader_id,
+                                  user_being_followed_id=user_id))
+        db.session.commit()
+
+        self.directory = tempfile.TemporaryDirectory()
+        self.shard_set = self.shards('a', 'b')
+        self.shard_set.create_tables()
+        self.use(self.shard_set)
+
+    def tearDown(self):
+        app_module.shard_set = None
+        app.extensions.pop('shards', None)
+        self.shard_set.close()
+        self.directory.cleanup()
+
+        db.session.rollback()
+        Like.query.delete()
+        Follow.query.delete()
+        db.session.commit()
+
+    def url(self, name):
+        return f"sqlite:///{self.directory.name}/{name}.db"
+
+    def shards(self, *names):
+        return ShardSet({name: self.url(name) for name in names})
+
+    def use(self, shard_set):
+        app_module.shard_set = shard_set
+        shard_set.init_app(app)
+
+    def client(self, user_id):
+        client = app.test_client()
+        with client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = user_id
+        return client
+
+    def rows(self, shard_set, table):
+        """{shard name: [row, ...]} of `table` on each shard."""
+
+        rows = {}
+        for name, engine in shard_set.engines.items():
+            with engine.connect() as conn:
+                rows[name] = conn.execute(db.select(table)).all()
+        return rows
+
+    def add_messages(self, count):
+        """Add `count` messages, round-robin over the followed users and a
+        second apart; return their ids, newest first."""
+
+        start = datetime.utcnow() - timedelta(hours=1)
+        messages = [Message(text=f"message-{n}",
+                            user_id=self.user_ids[1 + n % 7],
+                            timestamp=start + timedelta(seconds=n))
+                    for n in range(count)]
+        db.session.add_all(messages)
+        db.session.commit()
+        return [message.id for message in reversed(messages)]
+
+    def shard_ids(self, shard_set):
+        """Ids of the messages on every shard of `shard_set`."""
+
+        return sorted(row.id for rows in
+                      self.rows(shard_set, shard_messages).values()
+                      for row in rows)
+
+    def assertPlaced(self, shard_set):
+        """Assert every shard's rows are its own users'."""
+
+        for name, rows in self.rows(shard_set, shard_messages).items():
+            for row in rows:
+                self.assertEqual(shard_set.shard_of(row.user_id), name)
+
+    def test_write_through(self):
+        """Tests if messages are copied to their user's shard, and removed
+        from it"""
+        author_id = self.user_ids[1]
+        self.client(author_id).post('/messages/new', data={'text': "hi"})
+        message_id = db.session.scalar(
+            db.select(Message.id).where(Message.text == "hi"))
+
+        owner = self.shard_set.shard_of(author_id)
+        self.assertEqual(
+            [row.id for row in self.rows(self.shard_set,
+                                         shard_messages)[owner]],
+            [message_id])
+        self.assertPlaced(self.shard_set)
+
+        self.client(author_id).post(f'/messages/{message_id}/delete')
+        self.assertEqual(self.shard_ids(self.shard_set), [])
+
+    def test_shard_down(self):
+        """Tests if a message is posted, and published, with its shard
+        unreachable"""
+        author_id = self.user_ids[1]
+        broken = ShardSet({name: f"sqlite:///{self.directory.name}/no/{name}"
+                           for name in self.shard_set.engines})
+        self.use(broken)
+        self.addCleanup(broken.close)
+
+        with patch.object(app_module.hub, 'publish') as publish:
+            resp = self.client(author_id).post('/messages/new',
+                                               data={'text': "hi"})
+
+        self.assertEqual(resp.status_code, 302)
+        self.assertIsNotNone(db.session.scalar(
+            db.select(Message.id).where(Message.text == "hi")))
+        publish.assert_called_once()
+
+    def test_import(self):
+        """Tests if imported messages are copied to the shards"""
+        directory = os.path.join(self.directory.name, 'import')
+        os.mkdir(directory)
+        for name, rows in (
+                ('users.csv', [['email', 'username', 'image_url',
+                                'password', 'bio', 'header_image_url',
+                                'location'],
+                               ['new@email.com', 'new', '', HASH, '',
+                                '', '']]),
+                ('messages.csv', [['text', 'timestamp', 'user_id'],
+                                  ["imported", '2023-01-01 10:00:00',
+                                   '1']])):
+            with open(os.path.join(directory, name), 'w', newline='') as f:
+                csv.writer(f).writerows(rows)
+
+        result = app.test_cli_runner().invoke(
+            args=['imports', 'run', directory])
+        self.assertEqual(result.exit_code, 0, result.output)
+
+        message_id = db.session.scalar(
+            db.select(Message.id).where(Message.text == "imported"))
+        self.assertEqual(self.shard_ids(self.shard_set), [message_id])
+        self.assertPlaced(self.shard_set)
+
+    def test_reconcile(self):
+        """Tests if reconciling copies messages the shards missed, and
+        removes deleted ones, from `since` on"""
+        ids = self.add_messages(6)[::-1]  # oldest first
+        self.shard_set.add_messages(
+            Message.query.filter(Message.id.in_(ids[:1] + ids[3:5])))
+        since = db.session.get(Message, ids[2]).timestamp
+
+        db.session.delete(db.session.get(Message, ids[4]))
+        db.session.commit()
+
+        self.assertEqual(self.shard_set.reconcile(since), (2, 1))
+
+        # ids[1] is older than `since`: left as it is
+        self.assertEqual(self.shard_ids(self.shard_set),
+                         sorted([ids[0], ids[2], ids[3], ids[5]]))
+        self.assertPlaced(self.shard_set)
+        self.assertEqual(self.shard_set.reconcile(since), (0, 0))
+
+    def test_reconciler(self):
+        """Tests if the background reconciler catches up on a message whose
+        copy failed"""
+        ids = self.add_messages(2)
+        self.shard_set.start_reconciler(app, interval=0.05,
+                                        window=2 * 60 * 60)
+
+        deadline = datetime.utcnow() + timedelta(seconds=5)
+        while (self.shard_ids(self.shard_set) != sorted(ids)
+               and datetime.utcnow() < deadline):
+            self.shard_set._closed.wait(0.05)
+
+        self.assertEqual(self.shard_ids(self.shard_set), sorted(ids))
+
+        result = app.test_cli_runner().invoke(
+            args=['shards', 'reconcile', '--minutes', '120'])
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertIn("added 0, removed 0", result.output)
+
+    def test_remove_between(self):
+        """Tests if an archived month's messages are removed from the
+        shards"""
+        ids = self.add_messages(3)
+        self.shard_set.add_messages(Message.query)
+        middle = db.session.get(Message, ids[1]).timestamp
+
+        self.shard_set.remove_between(middle, middle + timedelta(seconds=1))
+
+        self.assertEqual(self.shard_ids(self.shard_set),
+                         sorted([ids[0], ids[2]]))
+
+    def test_newest_ids(self):
+        """Tests if the newest messages are merged from every shard"""
+        ids = self.add_messages(30)
+        self.shard_set.add_messages(Message.query)
+
+        shard_counts = self.rows(self.shard_set, shard_messages)
+        self.assertTrue(all(shard_counts.values()))
+
+        self.assertEqual(
+            self.shard_set.newest_ids(self.user_ids, 10), ids[:10])
+        self.assertEqual(
+            self.shard_set.newest_ids(self.user_ids[1:3], 5),
+            [id for id in ids
+             if db.session.get(Message, id).user_id in self.user_ids[1:3]
+             ][:5])
+
+    def test_homepage(self):
+        """Tests if home timelines are read from the shards"""
+        self.add_messages(3)
+        self.shard_set.add_messages(Message.query.filter(
+            Message.text != "message-1"))
+
+        html = self.client(self.reader_id).get('/').get_data(as_text=True)
+
+        self.assertIn("message-2", html)
+        self.assertIn("message-0", html)
+        self.assertNotIn("message-1", html)
+        self.assertLess(html.index("message-2"), html.index("message-0"))
+
+    def test_rebalance(self):
+        """Tests if a shard added, then drained, gets its users' rows"""
+        ids = self.add_messages(40)
+
+        result = app.test_cli_runner().invoke(args=['shards', 'sync'])
+        self.assertEqual(result.exit_code, 0, result.output)
+
+        def total(shard_set):
+            return len(self.shard_ids(shard_set))
+
+        self.assertEqual(total(self.shard_set), 40)
+
+        grown = self.shards('a', 'b', 'c')
+        self.use(grown)
+        result = app.test_cli_runner().invoke(args=['shards', 'rebalance'])
+        self.assertEqual(result.exit_code, 0, result.output)
+
+        self.assertPlaced(grown)
+        self.assertEqual(total(grown), 40)
+        self.assertEqual(grown.newest_ids(self.user_ids, 5), ids[:5])
+
+        shrunk = self.shards('a', 'c')
+        self.use(shrunk)
+        result = app.test_cli_runner().invoke(
+            args=['shards', 'rebalance', '--drain', f"b={self.url('b')}"])
+        self.assertEqual(result.exit_code, 0, result.output)
+
+        self.assertPlaced(shrunk)
+        self.assertEqual(total(shrunk), 40)
+        drained = self.shards('b')
+        self.assertEqual(total(drained), 0)
+
+        status = app.test_cli_runner().invoke(args=['shards', 'status'])
+        self.assertIn("(0 misplaced)", status.output)
+
+        for shard_set in (grown, shrunk, drained):
+            shard_set.close()
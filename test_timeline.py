@@ -0,0 +1,127 @@
+"""Home timeline snapshot tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_timeline.py
+
+
+import os
+from datetime import datetime, timedelta
+from unittest import TestCase
+
+from prometheus_client import REGISTRY
+
+from app import app, CURR_USER_KEY
+from models import db, User, Message, Like, Follow
+from timeline import TIMELINE_KEY, TIMELINE_OVERLAP
+from viewer import decode_ids
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+app.config['WTF_CSRF_ENABLED'] = False
+app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
+
+db.drop_all()
+db.create_all()
+
+
+def lookups(result):
+    return REGISTRY.get_sample_value(
+        'warbler_cache_lookups_total',
+        {'cache': 'timeline', 'result': result}) or 0
+
+
+class TimelineTestCase(TestCase):
+    def setUp(self):
+        Like.query.delete()
+        Follow.query.delete()
+        Message.query.delete()
+        User.query.delete()
+
+        u1 = User.signup("u1", "u1@email.com", "password", None)
+        u2 = User.signup("u2", "u2@email.com", "password", None)
+        u3 = User.signup("u3", "u3@email.com", "password", None)
+        db.session.flush()
+
+        db.session.add(Follow(user_following_id=u1.id,
+                              user_being_followed_id=u2.id))
+        m1 = Message(text="m1-text", user_id=u2.id,
+                     timestamp=datetime.utcnow() - timedelta(minutes=5))
+        db.session.add(m1)
+        db.session.commit()
+
+        self.u1_id = u1.id
+        self.u2_id = u2.id
+        self.u3_id = u3.id
+        self.m1_id = m1.id
+
+        self.client = app.test_client()
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.u1_id
+
+    def tearDown(self):
+        db.session.rollback()
+        Like.query.delete()
+        Follow.query.delete()
+        db.session.commit()
+
+    def post(self, text, user_id, timestamp=None):
+        message = Message(text=text, user_id=user_id,
+                          timestamp=timestamp or datetime.utcnow())
+        db.session.add(message)
+        db.session.commit()
+        return message.id
+
+    def home(self):
+        return self.client.get('/').get_data(as_text=True)
+
+    def snapshot_ids(self):
+        with self.client.session_transaction() as sess:
+            return decode_ids(sess[TIMELINE_KEY]['ids'])
+
+    def test_delta(self):
+        """Tests if a repeat visit adds only what's new to its snapshot"""
+        self.assertIn('m1-text', self.home())
+        hits = lookups('hit')
+
+        m2_id = self.post("m2-text", self.u2_id)
+        self.post("not-followed-text", self.u3_id)
+        html = self.home()
+
+        self.assertIn('m1-text', html)
+        self.assertIn('m2-text', html)
+        self.assertNotIn('not-followed-text', html)
+        self.assertLess(html.index('m2-text'), html.index('m1-text'))
+        self.assertEqual(lookups('hit'), hits + 1)
+        self.assertEqual(self.snapshot_ids(), [self.m1_id, m2_id])
+
+    def test_late_message(self):
+        """Tests if messages stamped just before the mark are still found"""
+        self.home()
+
+        mark = db.session.get(Message, self.m1_id).timestamp
+        self.post("late-text", self.u2_id,
+                  mark - TIMELINE_OVERLAP / 2)
+
+        self.assertIn('late-text', self.home())
+
+    def test_deleted_message(self):
+        """Tests if a snapshot with deleted messages is rebuilt"""
+        self.home()
+        misses = lookups('miss')
+
+        Message.query.filter_by(id=self.m1_id).delete()
+        db.session.commit()
+
+        self.assertNotIn('m1-text', self.home())
+        self.assertEqual(lookups('miss'), misses + 1)
+
+    def test_follow(self):
+        """Tests if following someone rebuilds the snapshot"""
+        self.post("u3-text", self.u3_id,
+                  datetime.utcnow() - timedelta(hours=1))
+        self.assertNotIn('u3-text', self.home())
+
+        self.client.post(f'/users/follow/{self.u3_id}')
+
+        self.assertIn('u3-text', self.home())
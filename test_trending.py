@@ -0,0 +1,122 @@
+"""Trending index tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_trending.py
+
+
+import os
+from unittest import TestCase
+
+from app import app
+from models import db, TrendingScore
+from trending import TrendingIndex
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
+
+db.drop_all()
+db.create_all()
+
+HOUR = 60 * 60
+
+
+class TrendingIndexTestCase(TestCase):
+    def setUp(self):
+        TrendingScore.query.delete()
+        db.session.commit()
+
+        self.index = TrendingIndex(half_life=HOUR, k=3, now=0)
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def test_top_ordering(self):
+        """Tests if messages are ranked by number of likes"""
+        for _ in range(3):
+            self.index.like(1, now=0)
+        self.index.like(2, now=0)
+        for _ in range(2):
+            self.index.like(3, now=0)
+
+        self.assertEqual(self.index.top(), [1, 3, 2])
+        self.assertEqual(self.index.top(2), [1, 3])
+
+    def test_top_is_bounded(self):
+        """Tests if only K messages are returned"""
+        for message_id in range(10):
+            self.index.like(message_id, now=0)
+        self.index.like(7, now=0)
+
+        self.assertEqual(len(self.index.top()), 3)
+        self.assertEqual(self.index.top()[0], 7)
+
+    def test_decay(self):
+        """Tests if newer likes outrank older likes"""
+        self.index.like(1, now=0)
+        self.index.like(1, now=0)
+        self.index.like(2, now=3 * HOUR)
+
+        self.assertEqual(self.index.top(), [2, 1])
+        self.assertAlmostEqual(self.index.score(1, now=HOUR), 1)
+        self.assertAlmostEqual(self.index.score(2, now=4 * HOUR), 0.5)
+
+    def test_unlike(self):
+        """Tests if unliking lowers a message's rank and removes it at zero"""
+        self.index.like(1, now=0)
+        self.index.like(1, now=0)
+        self.index.like(2, now=0)
+
+        self.index.unlike(1, now=0)
+        self.index.unlike(1, now=0)
+
+        self.assertEqual(self.index.top(), [2])
+        self.assertEqual(len(self.index), 1)
+
+    def test_unlike_old_likes(self):
+        """Tests if an unlike removes an average like, not a new one"""
+        for _ in range(10):
+            self.index.like(1, now=0)
+
+        self.index.unlike(1, now=3 * HOUR)
+
+        # 10 likes decayed over 3 half-lives, less one of them
+        self.assertAlmostEqual(self.index.score(1, now=3 * HOUR), 9 / 8)
+
+    def test_forget(self):
+        """Tests if deleted messages are dropped from the index"""
+        self.index.like(1, now=0)
+        self.index.forget(1)
+
+        self.assertEqual(self.index.top(), [])
+        self.assertEqual(len(self.index), 0)
+
+    def test_shared(self):
+        """Tests if indexes in different workers rank the same likes"""
+        other = TrendingIndex(half_life=HOUR, k=3, now=0)
+
+        self.index.like(1, now=0)
+        other.like(2, now=0)
+        other.like(2, now=0)
+
+        self.assertEqual(self.index.top(), [2, 1])
+        self.assertEqual(other.top(), [2, 1])
+
+    def test_compaction(self):
+        """Tests if compaction keeps scores and drops fully decayed messages"""
+        self.index.like(1, now=0)
+        self.index.like(2, now=30 * HOUR)
+        self.index.compact(now=30 * HOUR)
+
+        self.assertEqual(self.index.top(), [2])
+        self.assertAlmostEqual(self.index.score(2, now=31 * HOUR), 0.5)
+
+    def test_long_running(self):
+        """Tests if scores stay in range over many half-lives"""
+        for day in range(400):
+            self.index.like(day % 5, now=day * 24 * HOUR)
+
+        self.assertEqual(self.index.top()[0], 399 % 5)
+        self.assertAlmostEqual(
+            self.index.score(399 % 5, now=399 * 24 * HOUR), 1)
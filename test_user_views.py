@@ -5,9 +5,12 @@
 #    python -m unittest test_user_views.py
 
 
-from app import app, do_login
+from app import (
+    app, do_login, unique_violations, CURR_USER_KEY, PASSWORD_CHECK_KEY)
 import os
+import re
 from unittest import TestCase
+from unittest.mock import patch
 from sqlalchemy.exc import IntegrityError
 
 from models import db, User, Message, Follow
@@ -157,10 +160,47 @@ class UserViewTestCase(TestCase):
                                            'password': 'password'})
 
             resp_search = client.get('/users')
+            self.assertTrue(resp_search.is_streamed)
             html = resp_search.get_data(as_text=True)
 
             self.assertEqual(resp_search.status_code, 200)
             self.assertIn('<!-- tests for search user', html)
+            self.assertIn('@u2', html)
+
+    @patch.dict(app.config, {'WTF_CSRF_ENABLED': True})
+    def test_streamed_page_session(self):
+        """Tests if a streamed page takes its flashes, and stores the CSRF
+        token its forms post"""
+        with self.client as client:
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+                sess['_flashes'] = [('info', "Flashed once")]
+
+            html = client.get('/users').get_data(as_text=True)
+            self.assertIn("Flashed once", html)
+            token = re.search(r'name="csrf_token" type="hidden" '
+                              r'value="([^"]+)"', html)[1]
+
+            html = client.get('/users').get_data(as_text=True)
+            self.assertNotIn("Flashed once", html)
+
+            resp = client.post('/logout', data={'csrf_token': token})
+
+            self.assertEqual(resp.status_code, 302)
+            self.assertEqual(resp.location, '/login')
+
+    def test_search_users_none_found(self):
+        """Tests if searching for no one says no users were found"""
+        with self.client as client:
+            client.post('/login',
+                        data={'username': 'u1',
+                              'password': 'password'})
+
+            resp = client.get('/users?q=nobody')
+            html = resp.get_data(as_text=True)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn('Sorry, no users found', html)
 
     def test_show_user_profile(self):
         """Tests if user profile is being displayed"""
@@ -219,6 +259,7 @@ class UserViewTestCase(TestCase):
                                            'password': 'password'})
 
             resp = client.get(f'/users/{self.u1_id}/likes')
+            self.assertTrue(resp.is_streamed)
             html = resp.get_data(as_text=True)
 
             self.assertEqual(resp.status_code, 200)
@@ -275,6 +316,47 @@ class UserViewTestCase(TestCase):
             self.assertEqual(resp.status_code, 200)
             self.assertIn('<!-- test for following', html)
 
+    def test_start_following_twice(self):
+        """Tests if following a user twice only records one follow."""
+        with self.client as client:
+            client.post('/login',
+                        data={'username': 'u1',
+                              'password': 'password'})
+
+            client.post(f'/users/follow/{self.u2_id}')
+            resp = client.post(f'/users/follow/{self.u2_id}')
+
+            self.assertEqual(resp.status_code, 302)
+            self.assertEqual(
+                Follow.query.filter_by(user_following_id=self.u1_id).count(),
+                1)
+
+    def test_follow_users(self):
+        """Tests if a batch of users can be followed in one request."""
+        with self.client as client:
+            client.post('/login',
+                        data={'username': 'u1',
+                              'password': 'password'})
+
+            resp = client.post('/users/follow',
+                               json={'ids': [self.u2_id, self.u2_id, 0]})
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(resp.json['results'], [
+                {'id': self.u2_id, 'status': 'followed'},
+                {'id': 0, 'status': 'not_found'},
+            ])
+
+            resp = client.post('/users/stop-following',
+                               json={'ids': [self.u2_id]})
+
+            self.assertEqual(resp.json['results'], [
+                {'id': self.u2_id, 'status': 'unfollowed'},
+            ])
+            self.assertEqual(
+                Follow.query.filter_by(user_following_id=self.u1_id).count(),
+                0)
+
     def test_edit_profile_form(self):
         """Tests to update profile form displays."""
         with self.client as client:
@@ -324,6 +406,82 @@ class UserViewTestCase(TestCase):
             self.assertEqual(resp.status_code, 200)
             self.assertIn('Username already exists!', html)
 
+    def test_edit_profile_email_taken(self):
+        """Tests to update profile with another user's email."""
+        with self.client as client:
+            client.post('/login',
+                        data={'username': 'u1',
+                              'password': 'password'})
+
+            resp = client.post('/users/profile',
+                               data={
+                                   'username': 'u1',
+                                   'email': 'u2@email.com',
+                                   'password': 'password'
+                               })
+            html = resp.get_data(as_text=True)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn('Email is already associated with a user!', html)
+            self.assertNotIn('Username already exists!', html)
+
+    def test_edit_profile_wrong_password(self):
+        """Tests to update profile with the wrong password."""
+        with self.client as client:
+            client.post('/login',
+                        data={'username': 'u1',
+                              'password': 'password'})
+
+            resp = client.post('/users/profile',
+                               data={
+                                   'username': 'u12',
+                                   'password': 'wrong-password'
+                               })
+            html = resp.get_data(as_text=True)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn('Incorrect password.', html)
+            self.assertEqual(User.query.get(self.u1_id).username, 'u1')
+
+    def test_edit_profile_remembers_password(self):
+        """Tests if a confirmed password is remembered, but only for itself."""
+        with self.client as client:
+            client.post('/login',
+                        data={'username': 'u1',
+                              'password': 'password'})
+
+            client.post('/users/profile',
+                        data={'bio': 'first', 'password': 'password'})
+
+            with client.session_transaction() as sess:
+                self.assertIn(PASSWORD_CHECK_KEY, sess)
+
+            resp = client.post('/users/profile',
+                               data={'bio': 'second',
+                                     'password': 'password'})
+            self.assertEqual(resp.status_code, 302)
+
+            resp = client.post('/users/profile',
+                               data={'bio': 'third',
+                                     'password': 'wrong-password'})
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(User.query.get(self.u1_id).bio, 'second')
+
+            client.post('/logout')
+
+            with client.session_transaction() as sess:
+                self.assertNotIn(PASSWORD_CHECK_KEY, sess)
+
+    def test_unique_violations(self):
+        """Tests if unique constraint errors are mapped to form fields."""
+        User.signup("u1", "u3@email.com", "password", None)
+
+        with self.assertRaises(IntegrityError) as cm:
+            db.session.commit()
+        db.session.rollback()
+
+        self.assertEqual(unique_violations(cm.exception), ['username'])
+
     def test_delete_user(self):
         """Tests to delete user."""
         with self.client as client:
@@ -0,0 +1,174 @@
+"""Per-viewer state tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_viewer.py
+
+
+import os
+from datetime import datetime, timedelta
+from unittest import TestCase
+
+from app import app, CURR_USER_KEY
+from models import db, User, Message, Like, Follow
+from viewer import VIEWER_STATE_KEY, decode_ids, encode_ids
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+app.config['WTF_CSRF_ENABLED'] = False
+app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
+
+db.drop_all()
+db.create_all()
+
+
+class EncodeIdsTestCase(TestCase):
+    def test_round_trip(self):
+        """Tests if encoded ids decode to the same ids"""
+        ids = [1, 2, 127, 128, 300, 16384, 2 ** 40]
+
+        self.assertEqual(decode_ids(encode_ids(ids)), ids)
+        self.assertEqual(decode_ids(encode_ids([])), [])
+
+    def test_compact(self):
+        """Tests if nearby ids take about a byte each"""
+        ids = list(range(1_000_000, 1_000_300))
+
+        self.assertLess(len(encode_ids(ids)), len(ids) + 10)
+
+
+class ViewerStateTestCase(TestCase):
+    def setUp(self):
+        Like.query.delete()
+        Follow.query.delete()
+        Message.query.delete()
+        User.query.delete()
+
+        u1 = User.signup("u1", "u1@email.com", "password", None)
+        u2 = User.signup("u2", "u2@email.com", "password", None)
+        db.session.flush()
+
+        m1 = Message(text="m1-text", user_id=u1.id)
+        m2 = Message(text="m2-text", user_id=u2.id)
+        db.session.add_all([m1, m2])
+        db.session.commit()
+
+        self.u1_id = u1.id
+        self.u2_id = u2.id
+        self.m1_id = m1.id
+        self.m2_id = m2.id
+
+        self.client = app.test_client()
+
+    def tearDown(self):
+        db.session.rollback()
+        Like.query.delete()
+        Follow.query.delete()
+        db.session.commit()
+
+    def login(self, c):
+        with c.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.u1_id
+
+    def state(self, c):
+        with c.session_transaction() as sess:
+            return sess.get(VIEWER_STATE_KEY)
+
+    def test_state_built(self):
+        """Tests if the viewer's state is cached in the session"""
+        Follow.add(self.u1_id, self.u2_id)
+        Like.add(self.u1_id, self.m2_id)
+        db.session.commit()
+
+        with self.client as c:
+            self.login(c)
+            resp = c.get('/')
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn('bi-heart-fill', resp.get_data(as_text=True))
+
+            state = self.state(c)
+            self.assertEqual(decode_ids(state['liked']), [self.m2_id])
+            self.assertEqual(decode_ids(state['following']), [self.u2_id])
+            self.assertEqual(state['counts'], [1, 1, 0])
+
+    def test_floor(self):
+        """Tests if only likes of the last RECENT_DAYS' messages are cached,
+        and older ones are still seen"""
+        db.session.get(Message, self.m1_id).timestamp = (
+            datetime.utcnow() - timedelta(days=40))
+        Like.add(self.u1_id, self.m1_id)
+        Like.add(self.u1_id, self.m2_id)
+        db.session.commit()
+
+        with self.client as c:
+            self.login(c)
+            html = c.get(f'/users/{self.u1_id}/likes').get_data(as_text=True)
+
+            state = self.state(c)
+            self.assertEqual(state['floor'], self.m2_id)
+            self.assertEqual(decode_ids(state['liked']), [self.m2_id])
+            self.assertEqual(html.count('bi-heart-fill'), 2)
+
+    def test_state_patched(self):
+        """Tests if the viewer's own changes patch the cached state"""
+        with self.client as c:
+            self.login(c)
+            c.get('/')
+            version = self.state(c)['version']
+
+            c.post(f'/messages/{self.m2_id}/like')
+            c.post(f'/users/follow/{self.u2_id}')
+            c.post('/messages/new', data={'text': 'new-text'})
+
+            state = self.state(c)
+            self.assertEqual(state['version'], version + 3)
+            self.assertEqual(decode_ids(state['liked']), [self.m2_id])
+            self.assertEqual(decode_ids(state['following']), [self.u2_id])
+            self.assertEqual(state['counts'], [2, 1, 0])
+            self.assertEqual(User.query.get(self.u1_id).state_version,
+                             version + 3)
+
+    def test_state_invalidated(self):
+        """Tests if changes made elsewhere make the cached state rebuild"""
+        Follow.add(self.u1_id, self.u2_id)
+        db.session.commit()
+
+        with self.client as c:
+            self.login(c)
+            c.get('/')
+
+            # e.g. from another device
+            with app.test_client() as other:
+                self.login(other)
+                other.post(f'/messages/{self.m2_id}/like')
+
+            resp = c.get('/')
+
+            self.assertIn('bi-heart-fill', resp.get_data(as_text=True))
+            self.assertEqual(decode_ids(self.state(c)['liked']),
+                             [self.m2_id])
+
+    def test_follower_count_invalidated(self):
+        """Tests if being followed invalidates the followed user's state"""
+        with self.client as c:
+            self.login(c)
+            c.get('/')
+
+            with app.test_client() as other:
+                with other.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = self.u2_id
+                other.post(f'/users/follow/{self.u1_id}')
+
+            c.get('/')
+
+            self.assertEqual(self.state(c)['counts'], [1, 0, 1])
+
+    def test_logout_forgets_state(self):
+        """Tests if logging out removes the cached state"""
+        with self.client as c:
+            self.login(c)
+            c.get('/')
+            c.post('/logout')
+
+            self.assertIsNone(self.state(c))
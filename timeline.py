@@ -0,0 +1,119 @@
+"""Home timeline snapshots.
+
+The homepage shows the TIMELINE_SIZE newest messages by the user and those
+they follow, which takes sorting all of those users' recent messages. So
+each session keeps a snapshot of the timeline it was last shown: the ids
+of its messages, and its high-water mark (the newest message's
+timestamp). The next visit only looks for messages newer than the mark
+(in the user's feed; see feed.py) and loads the rest by id:
+
+    delta   messages by the same users since `mark` - TIMELINE_OVERLAP
+    kept    the snapshot's messages, by primary key
+
+The overlap catches messages committed after a snapshot was taken but
+stamped a little before its mark. A snapshot is dropped, and the full
+query runs, when the user follows or unfollows someone (the snapshot
+records a digest of whose messages it holds) or when one of its messages
+has been deleted.
+
+Only the WSGI homepage uses snapshots; the native ASGI one (asgi.py)
+always runs the full query.
+"""
+
+import hashlib
+import os
+from datetime import datetime, timedelta
+
+from flask import session
+
+from feed import home_query
+from metrics import record_lookup
+from models import Message
+from partitions import newest
+from readmodels import feed_items, feed_query
+from viewer import decode_ids, encode_ids
+
+TIMELINE_KEY = "timeline"
+TIMELINE_SIZE = 100
+TIMELINE_OVERLAP = timedelta(
+    seconds=int(os.environ.get('TIMELINE_OVERLAP_SECONDS', 10)))
+
+
+def authors_digest(author_ids):
+    """Short digest of the set `author_ids`."""
+
+    ids = ','.join(str(id) for id in sorted(set(author_ids)))
+    return hashlib.sha1(ids.encode()).hexdigest()[:16]
+
+
+def newest_first(messages):
+    return sorted(messages,
+                  key=lambda message: (message.timestamp, message.id),
+                  reverse=True)
+
+
+def refresh(user_id, following_ids, snapshot, limit, shards=None):
+    """Return the timeline from `snapshot` and what's new since, or None
+    if some of its messages are gone (or it has none to go by)."""
+
+    if snapshot['mark'] is None:
+        return None
+
+    since = datetime.fromisoformat(snapshot['mark']) - TIMELINE_OVERLAP
+    new = feed_items(home_query(user_id, following_ids, limit, since, shards)
+                     .filter(Message.timestamp > since)
+                     .order_by(Message.timestamp.desc())
+                     .limit(limit))
+
+    new_ids = {message.id for message in new}
+    kept_ids = [id for id in decode_ids(snapshot['ids']) if id not in new_ids]
+
+    kept = []
+    if len(new) < limit and kept_ids:
+        kept = feed_items(feed_query().filter(Message.id.in_(kept_ids)))
+        if len(kept) < len(kept_ids):
+            return None
+
+    return newest_first(new + kept)[:limit]
+
+
+def home_timeline(user_id, following_ids, limit=TIMELINE_SIZE, shards=None):
+    """Return the `limit` newest FeedItems by user `user_id` and the users
+    in `following_ids`, updating the session's snapshot.
+
+    `shards` is passed on to `feed.home_query`."""
+
+    digest = authors_digest([user_id, *following_ids])
+
+    snapshot = session.get(TIMELINE_KEY)
+    messages = None
+
+    if (snapshot
+            and snapshot['user'] == user_id
+            and snapshot['authors'] == digest
+            and snapshot['limit'] == limit):
+        messages = refresh(user_id, following_ids, snapshot, limit, shards)
+        record_lookup('timeline', hit=messages is not None)
+
+    if messages is None:
+        messages = feed_items(
+            newest(home_query(user_id, following_ids, limit, shards=shards),
+                   limit))
+
+    mark = max((message.timestamp for message in messages), default=None)
+    updated = {
+        'user': user_id,
+        'authors': digest,
+        'limit': limit,
+        'ids': encode_ids(sorted(message.id for message in messages)),
+        'mark': mark and mark.isoformat(),
+    }
+    # Not saved again when nothing's new
+    if updated != snapshot:
+        session[TIMELINE_KEY] = updated
+
+    return messages
+
+
+def forget_timeline():
+    session.pop(TIMELINE_KEY, None)
@@ -0,0 +1,181 @@
+"""Trending messages, ranked by time-decayed like velocity.
+
+Scores live in the `trending_scores` table, so every worker ranks the same
+likes, and a restart loses none.
+
+Databases created before trending scores were stored need:
+
+    CREATE TABLE trending_scores (
+        message_id INTEGER PRIMARY KEY,
+        likes INTEGER NOT NULL,
+        log_score DOUBLE PRECISION NOT NULL);
+    CREATE INDEX ix_trending_scores_log_score
+        ON trending_scores (log_score);
+"""
+
+import math
+import time
+from threading import Lock
+
+from models import db, insert_ignore, TrendingScore
+
+DEFAULT_HALF_LIFE = 6 * 60 * 60
+DEFAULT_TOP_K = 50
+DEFAULT_COMPACT_INTERVAL = 60 * 60
+
+# Messages whose decayed like count falls below 2 ** DEAD_LOG_SCORE are
+# dropped by compaction.
+DEAD_LOG_SCORE = -20
+
+
+def log2_add(a, b):
+    """log2(2 ** a + 2 ** b), without overflowing."""
+
+    high, low = max(a, b), min(a, b)
+    return high + math.log2(1 + 2 ** (low - high))
+
+
+class TrendingIndex:
+    """Top-K of messages by decayed like count, maintained from like events.
+
+    A like at time `t` adds 2 ** (t / half_life) to its message's score.
+    Since every score is measured against the same epoch, scores never need
+    to be decayed in place: older likes are simply worth exponentially less
+    than newer ones, and the ordering is the same as if everything were
+    decayed to "now". The weights themselves would overflow a float within
+    weeks, so a score is stored as its base-2 log, `log_score`, which is
+    indexed: reading the top-K is an index scan of K rows, however many
+    likes there have been.
+
+    Likes aren't timestamped, so an unlike removes an average like of the
+    message: its score shrinks by 1/likes. Compaction drops messages that
+    have decayed to nothing; it runs from the write path at most once per
+    `compact_interval` seconds in each process.
+    """
+
+    def __init__(self, half_life=DEFAULT_HALF_LIFE, k=DEFAULT_TOP_K,
+                 compact_interval=DEFAULT_COMPACT_INTERVAL, now=None):
+        self.half_life = half_life
+        self.k = k
+        self.compact_interval = compact_interval
+
+        self._last_compact = time.time() if now is None else now
+        self._lock = Lock()
+
+    def __len__(self):
+        return db.session.scalar(
+            db.select(db.func.count()).select_from(TrendingScore))
+
+    def _log_weight(self, now):
+        """log2 of the weight of a single like at `now`."""
+
+        return now / self.half_life
+
+    def _maybe_compact(self, conn, now):
+        with self._lock:
+            if now - self._last_compact < self.compact_interval:
+                return
+            self._last_compact = now
+
+        self._compact(conn, now)
+
+    def _locked_score(self, conn, message_id):
+        return conn.execute(
+            db.select(TrendingScore.likes, TrendingScore.log_score)
+            .where(TrendingScore.message_id == message_id)
+            .with_for_update()).first()
+
+    def like(self, message_id, now=None):
+        """Record a like of `message_id`."""
+
+        now = time.time() if now is None else now
+        log_weight = self._log_weight(now)
+
+        with db.engine.begin() as conn:
+            self._maybe_compact(conn, now)
+
+            while True:
+                score = self._locked_score(conn, message_id)
+
+                if score is not None:
+                    conn.execute(
+                        db.update(TrendingScore)
+                        .where(TrendingScore.message_id == message_id)
+                        .values(likes=score.likes + 1,
+                                log_score=log2_add(score.log_score,
+                                                   log_weight)))
+                    return
+
+                # Lost a race with another first like, if nothing's added
+                if conn.execute(
+                        insert_ignore(TrendingScore, conn).values(
+                            message_id=message_id,
+                            likes=1,
+                            log_score=log_weight)).rowcount:
+                    return
+
+    def unlike(self, message_id, now=None):
+        """Record an unlike of `message_id`."""
+
+        now = time.time() if now is None else now
+
+        with db.engine.begin() as conn:
+            self._maybe_compact(conn, now)
+
+            score = self._locked_score(conn, message_id)
+            if score is None:
+                return
+
+            where = TrendingScore.message_id == message_id
+            if score.likes <= 1:
+                conn.execute(db.delete(TrendingScore).where(where))
+            else:
+                conn.execute(
+                    db.update(TrendingScore)
+                    .where(where)
+                    .values(likes=score.likes - 1,
+                            log_score=score.log_score + math.log2(
+                                (score.likes - 1) / score.likes)))
+
+    def forget(self, message_id):
+        """Drop `message_id` entirely (e.g. when the message is deleted)."""
+
+        with db.engine.begin() as conn:
+            conn.execute(
+                db.delete(TrendingScore)
+                .where(TrendingScore.message_id == message_id))
+
+    def top(self, n=None):
+        """Return up to `n` (default: K) trending message ids, best first."""
+
+        return db.session.scalars(
+            db.select(TrendingScore.message_id)
+            .order_by(TrendingScore.log_score.desc())
+            .limit(self.k if n is None else min(n, self.k))).all()
+
+    def score(self, message_id, now=None):
+        """Return the decayed like count of `message_id` as of `now`."""
+
+        now = time.time() if now is None else now
+
+        log_score = db.session.scalar(
+            db.select(TrendingScore.log_score)
+            .where(TrendingScore.message_id == message_id))
+        if log_score is None:
+            return 0
+
+        return 2 ** (log_score - self._log_weight(now))
+
+    def compact(self, now=None):
+        """Drop messages that have decayed to nothing."""
+
+        now = time.time() if now is None else now
+
+        with db.engine.begin() as conn:
+            self._compact(conn, now)
+
+    def _compact(self, conn, now):
+        conn.execute(
+            db.delete(TrendingScore)
+            .where(TrendingScore.log_score
+                   < self._log_weight(now) + DEAD_LOG_SCORE))
@@ -0,0 +1,411 @@
+"""Per-viewer state, cached in the session.
+
+Pages need a few things about the logged-in user: which of the messages
+shown they've liked, who they follow, and their message/following/follower
+counts. Rather than loading `g.user.liked_messages`, `.following`,
+`.followers` and `.messages` on every request, these are kept in the
+session as a `ViewerState`:
+
+    version     the user's `state_version` when the state was built
+    floor       lowest message id covered by `liked`: that of the first
+                message of the last RECENT_DAYS, found on the
+                `messages.timestamp` index (or higher, if the user liked
+                more than MAX_IDS messages since)
+    liked       ids >= floor of messages the user has liked
+    following   ids of users they follow (None if more than MAX_IDS)
+    counts      messages, following, followers
+
+Id lists are sorted and stored delta-encoded as varints, which keeps a few
+hundred ids to well under a kilobyte.
+
+Likes, unlikes, posts, deletes, follows and unfollows bump the affected
+users' `state_version` in the same transaction (see `record_change`); the
+acting session patches its own state, and any other session of those users
+rebuilds theirs on its next request. Liked-ness of messages below `floor`
+is looked up in the database (see `ViewerState.prefetch`). Likes not yet
+written by the like buffer are applied on top (see likebuffer.py).
+
+The user's display fields (SNAPSHOT_FIELDS) are kept in the session too,
+stamped with the same version, and `g.user` is a `CurrentUser` serving
+them from there: with the database session store, which loads the user's
+current version with the session, rendering the page header reads nothing
+else. Other attributes of `g.user` load the user's row on first use.
+
+Databases created before `users.state_version` existed need:
+
+    ALTER TABLE users ADD COLUMN state_version INTEGER NOT NULL DEFAULT 0;
+    CREATE INDEX ix_messages_timestamp ON messages (timestamp);
+"""
+
+from datetime import datetime, timedelta
+
+from flask import session
+
+from metrics import record_lookup
+from models import db, User, Message, Like, Follow
+
+VIEWER_STATE_KEY = "viewer"
+USER_SNAPSHOT_KEY = "user"
+
+SNAPSHOT_FIELDS = ('username', 'image_url', 'header_image_url', 'bio',
+                   'location')
+
+RECENT_DAYS = 31
+MAX_IDS = 300
+
+
+def encode_ids(ids):
+    """Encode sorted, distinct `ids` as delta varints."""
+
+    data = bytearray()
+    previous = 0
+
+    for id in ids:
+        delta = id - previous
+        previous = id
+        while delta >= 0x80:
+            data.append(delta & 0x7f | 0x80)
+            delta >>= 7
+        data.append(delta)
+
+    return bytes(data)
+
+
+def decode_ids(data):
+    """Decode ids encoded by `encode_ids`."""
+
+    ids = []
+    previous = delta = shift = 0
+
+    for byte in data:
+        delta |= (byte & 0x7f) << shift
+        shift += 7
+        if not byte & 0x80:
+            previous += delta
+            ids.append(previous)
+            delta = shift = 0
+
+    return ids
+
+
+class ViewerState:
+    """What pages need to know about the logged-in user."""
+
+    def __init__(self, user, version, floor, liked, following, counts,
+                 overlay=None):
+        self.user = user
+        self.version = version
+        self.floor = floor
+        self.liked = set(liked)
+        self.following = None if following is None else set(following)
+        self.message_count, self.following_count, self.follower_count = counts
+        self.overlay = overlay
+        self._older_likes = {}
+
+        if overlay:
+            self.liked.update(id for id in overlay.liked if id >= floor)
+            self.liked.difference_update(overlay.unliked)
+
+    @classmethod
+    def build(cls, user, session=None, overlay=None):
+        """Build `user`'s state from the database."""
+
+        session = session or db.session
+        cutoff = datetime.utcnow() - timedelta(days=RECENT_DAYS)
+
+        counts_and_floor = session.execute(db.select(
+            db.select(db.func.count()).where(Message.user_id == user.id)
+            .scalar_subquery(),
+            db.select(db.func.count())
+            .where(Follow.user_following_id == user.id).scalar_subquery(),
+            db.select(db.func.count())
+            .where(Follow.user_being_followed_id == user.id)
+            .scalar_subquery(),
+            db.func.coalesce(
+                db.select(Message.id)
+                .where(Message.timestamp >= cutoff)
+                .order_by(Message.timestamp)
+                .limit(1).scalar_subquery(),
+                db.select(db.func.max(Message.id) + 1).scalar_subquery(),
+                1),
+        )).one()
+        *counts, floor = counts_and_floor
+
+        # Newest first, so that only the newest MAX_IDS are kept
+        liked = session.scalars(
+            db.select(Like.message_id)
+            .where(Like.user_id == user.id, Like.message_id >= floor)
+            .order_by(Like.message_id.desc())
+            .limit(MAX_IDS + 1)).all()
+        if len(liked) > MAX_IDS:
+            liked = liked[:MAX_IDS]
+            floor = liked[-1]
+
+        following = session.scalars(
+            db.select(Follow.user_being_followed_id)
+            .where(Follow.user_following_id == user.id)
+            .limit(MAX_IDS + 1)).all()
+        if len(following) > MAX_IDS:
+            following = None
+
+        return cls(user, user.state_version, floor, liked, following, counts,
+                   overlay)
+
+    @classmethod
+    def load(cls, user, overlay=None):
+        """Return `user`'s state from the session, or None if absent/stale."""
+
+        data = session.get(VIEWER_STATE_KEY)
+
+        if (not data
+                or data['user'] != user.id
+                or data['version'] != user.state_version):
+            return None
+
+        following = data['following']
+        return cls(
+            user,
+            data['version'],
+            data['floor'],
+            decode_ids(data['liked']),
+            None if following is None else decode_ids(following),
+            data['counts'],
+            overlay)
+
+    def save(self):
+        session[VIEWER_STATE_KEY] = {
+            'user': self.user.id,
+            'version': self.version,
+            'floor': self.floor,
+            'liked': encode_ids(sorted(self.liked)),
+            'following': (None if self.following is None
+                          else encode_ids(sorted(self.following))),
+            'counts': [self.message_count,
+                       self.following_count,
+                       self.follower_count],
+        }
+
+    def has_liked(self, message):
+        """Has the user liked `message`?"""
+
+        return self.has_liked_id(message.id)
+
+    def has_liked_id(self, message_id):
+        """Has the user liked message `message_id`?"""
+
+        if message_id >= self.floor:
+            return message_id in self.liked
+
+        if message_id not in self._older_likes:
+            self.prefetch_ids([message_id])
+
+        return self._older_likes[message_id]
+
+    def prefetch(self, messages, session=None, keep=True):
+        """Look up, in one query, likes of those `messages` below `floor`.
+
+        With keep=False, earlier lookups are forgotten, so pages streaming
+        messages in batches hold only the current batch's."""
+
+        if not keep:
+            self._older_likes.clear()
+
+        self.prefetch_ids([message.id for message in messages], session)
+
+    def prefetch_ids(self, message_ids, session=None):
+        """Look up, in one query, likes of messages `message_ids` below
+        `floor`."""
+
+        ids = [id for id in message_ids
+               if id < self.floor and id not in self._older_likes]
+        if not ids:
+            return
+
+        liked = set((session or db.session).scalars(
+            db.select(Like.message_id)
+            .where(Like.user_id == self.user.id, Like.message_id.in_(ids))))
+
+        if self.overlay:
+            liked = (liked | self.overlay.liked) - self.overlay.unliked
+
+        for id in ids:
+            self._older_likes[id] = id in liked
+
+    def is_following(self, other_user):
+        """Is the user following `other_user`?"""
+
+        if self.following is None:
+            return self.user.is_following(other_user)
+
+        return other_user.id in self.following
+
+    def following_ids(self):
+        """Return ids of the users the user follows."""
+
+        if self.following is None:
+            return [user.id for user in self.user.following]
+
+        return list(self.following)
+
+    def apply(self, liked=(), unliked=(), posted=0, deleted=0,
+              followed=(), unfollowed=()):
+        """Update the state for changes made by the user."""
+
+        self.liked.update(id for id in liked if id >= self.floor)
+        self.liked.difference_update(unliked)
+
+        if len(self.liked) > MAX_IDS:
+            newest = sorted(self.liked)[-MAX_IDS:]
+            self.liked = set(newest)
+            self.floor = newest[0]
+            self._older_likes.clear()
+
+        self.message_count += posted - deleted
+        self.following_count += len(followed) - len(unfollowed)
+
+        if self.following is not None:
+            self.following.update(followed)
+            self.following.difference_update(unfollowed)
+            if len(self.following) > MAX_IDS:
+                self.following = None
+
+
+def get_viewer_state(user, session=None, overlay=None):
+    """Return `user`'s state, from the session if it's current.
+
+    `overlay` is the user's unwritten likes, if any (see likebuffer.py)."""
+
+    state = ViewerState.load(user, overlay)
+    record_lookup('viewer_state', hit=state is not None)
+
+    if state is None:
+        state = ViewerState.build(user, session, overlay)
+        state.save()
+
+    return state
+
+
+def bump_versions(user_ids):
+    """Invalidate cached state of users in `user_ids`; return new versions."""
+
+    if not user_ids:
+        return {}
+
+    rows = db.session.execute(
+        db.update(User)
+        .where(User.id.in_(user_ids))
+        .values(state_version=User.state_version + 1)
+        .returning(User.id, User.state_version))
+
+    return dict(rows.all())
+
+
+def record_change(state, liked=(), unliked=(), posted=0, deleted=0,
+                  followed=(), unfollowed=()):
+    """Record changes made by `state`'s user, before committing them.
+
+    Bumps the state version of the user, and of users they followed or
+    unfollowed (whose follower counts change), and patches `state` to
+    match, so this session needn't rebuild it."""
+
+    user = state.user
+    versions = bump_versions({user.id, *followed, *unfollowed})
+
+    # If another session of the user's changed things meanwhile, patching
+    # wouldn't cover their change; rebuild next time instead.
+    if versions[user.id] != state.version + 1:
+        forget_state()
+        return
+
+    state.apply(liked, unliked, posted, deleted, followed, unfollowed)
+    state.version = versions[user.id]
+    state.save()
+
+    snapshot = session.get(USER_SNAPSHOT_KEY)
+    if (snapshot
+            and snapshot['id'] == user.id
+            and snapshot['version'] == state.version - 1):
+        session[USER_SNAPSHOT_KEY] = {**snapshot, 'version': state.version}
+
+
+def forget_state():
+    session.pop(VIEWER_STATE_KEY, None)
+
+
+class CurrentUser:
+    """The logged-in user, as `g.user`.
+
+    SNAPSHOT_FIELDS come from the session's snapshot; anything else loads
+    the User (once per request). `version` is the user's current
+    `state_version`, if the session store knew it."""
+
+    def __init__(self, snapshot, version=None, user=None):
+        self.id = snapshot['id']
+        self._snapshot = snapshot
+        self._version = version
+        self._user = user
+
+    @property
+    def state_version(self):
+        if self._version is None:
+            return self.load().state_version
+
+        return self._version
+
+    def load(self):
+        """Return the User."""
+
+        if self._user is None:
+            self._user = db.session.get(User, self.id)
+
+            if (self._user is not None
+                    and self._user.state_version != self._snapshot['version']):
+                self._snapshot = remember_user(self._user)
+
+        return self._user
+
+    def __getattr__(self, name):
+        if name in SNAPSHOT_FIELDS:
+            return self._snapshot[name]
+
+        return getattr(self.load(), name)
+
+    def __repr__(self):
+        return f"<CurrentUser #{self.id}: {self.username}>"
+
+
+def remember_user(user):
+    """Keep a snapshot of `user`'s display fields in the session."""
+
+    snapshot = {
+        'id': user.id,
+        'version': user.state_version,
+        **{field: getattr(user, field) for field in SNAPSHOT_FIELDS},
+    }
+    session[USER_SNAPSHOT_KEY] = snapshot
+    return snapshot
+
+
+def get_current_user(user_id, version=None):
+    """Return logged-in user `user_id` as a CurrentUser, or None if they
+    no longer exist.
+
+    `version` is their current `state_version`, if known; a snapshot of
+    another version is replaced."""
+
+    snapshot = session.get(USER_SNAPSHOT_KEY)
+
+    if (snapshot
+            and snapshot['id'] == user_id
+            and version in (None, snapshot['version'])):
+        return CurrentUser(snapshot, version)
+
+    user = db.session.get(User, user_id)
+    if user is None:
+        return None
+
+    return CurrentUser(remember_user(user), user.state_version, user)
+
+
+def forget_user():
+    session.pop(USER_SNAPSHOT_KEY, None)